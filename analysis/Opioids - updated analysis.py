@@ -20,7 +20,7 @@
 # +
 import pandas as pd
 import numpy as np
-from ebmdatalab import bq
+from caching import cached_read
 
 GBQ_PROJECT_ID = "620265099307"
 
@@ -43,7 +43,7 @@ GROUP BY
   Is_LA, 
   Is_High_LA"""
 
-dfl = bq.cached_read(q4, csv_path="chemical_summary.zip").fillna(0)
+dfl = cached_read(q4, csv_path="chemical_summary.zip").fillna(0)
 dfl.head()
 # -
 
@@ -56,69 +56,25 @@ dfl.drop("Is_LA",axis=1).groupby(["year","Is_High_LA"]).sum()
 
 # +
 # Summary results table by year
-tab = dfl.fillna(0)
-tab.loc[tab["Is_High_LA"]=="High dose","OME per 1000_High Dose"] = tab["total_ome_per_1000"]
-tab.loc[tab["Is_High_LA"]=="High dose","Items per 1000_High Dose"] = tab["items_per_1000"]
-tab.loc[tab["Is_High_LA"]=="High dose","Cost per 1000_High Dose"] = tab["cost_per_1000"]
+from summary import aggregate, rollup, top_chemicals
 
-tab.loc[tab["Is_LA"]==True,"OME per 1000_Long Acting"] = tab["total_ome_per_1000"]
-tab.loc[tab["Is_LA"]==True,"Items per 1000_Long Acting"] = tab["items_per_1000"]
-tab.loc[tab["Is_LA"]==True,"Cost per 1000_Long Acting"] = tab["cost_per_1000"]
-
-tab = tab.fillna(0)
-tab = tab.groupby(["year"]).sum().drop(["Is_LA","quantity_per_1000"],axis=1)
-tab = tab.rename(columns={"total_ome_per_1000":"OME per 1000_Total","items_per_1000":"Items per 1000_Total","cost_per_1000":"Cost per 1000_Total"})
-
-
-tab["OME per 1000_% High Dose"] = (100*tab["OME per 1000_High Dose"]/tab["OME per 1000_Long Acting"])
-tab["Items per 1000_% High Dose"] = (100*tab["Items per 1000_High Dose"]/tab["Items per 1000_Long Acting"])
-tab["Cost per 1000_% High Dose"] = (100*tab["Cost per 1000_High Dose"]/tab["Cost per 1000_Long Acting"])
-
-tab.columns = tab.columns.str.split('_',expand=True)
-tab.sort_index(axis=1, ascending=False)
+# sum once by year and chemical; each table below is rolled up from this
+base = aggregate(dfl, ["year", "chem_substance"])
+rollup(base, ["year"])
+# -
 
-# +
 # Summary by chemical substance
-tab = dfl.copy().fillna(0)
-tab.loc[tab["Is_High_LA"]=="High dose","OME per 1000_High Dose"] = tab["total_ome_per_1000"]
-tab.loc[tab["Is_High_LA"]=="High dose","Items per 1000_High Dose"] = tab["items_per_1000"]
-tab.loc[tab["Is_High_LA"]=="High dose","Cost per 1000_High Dose"] = tab["cost_per_1000"]
-
-tab.loc[tab["Is_LA"]==True,"OME per 1000_Long Acting"] = tab["total_ome_per_1000"]
-tab.loc[tab["Is_LA"]==True,"Items per 1000_Long Acting"] = tab["items_per_1000"]
-tab.loc[tab["Is_LA"]==True,"Cost per 1000_Long Acting"] = tab["cost_per_1000"]
-
-tab = tab.fillna(0)
-tab = tab.groupby(["chem_substance"]).sum().drop(["year","Is_LA","quantity_per_1000"],axis=1).sort_values(by="total_ome_per_1000",ascending=False)
-tab = tab.rename(columns={"total_ome_per_1000":"OME per 1000_Total","items_per_1000":"Items per 1000_Total","cost_per_1000":"Cost per 1000_Total"})
-
-
-tab["OME per 1000_% High Dose"] = (100*tab["OME per 1000_High Dose"]/tab["OME per 1000_Long Acting"])
-tab["Items per 1000_% High Dose"] = (100*tab["Items per 1000_High Dose"]/tab["Items per 1000_Long Acting"])
-tab["Cost per 1000_% High Dose"] = (100*tab["Cost per 1000_High Dose"]/tab["Cost per 1000_Long Acting"])
-
-tab.columns = tab.columns.str.split('_',expand=True)
-tab.sort_index(axis=1, ascending=False).fillna(0).head()
+tab = rollup(base, ["chem_substance"]).sort_values(by=("OME per 1000", "Total"), ascending=False)
+tab.fillna(0).head()
 
 # +
 # Summary by chemical substance and year (OME only)
-tab = dfl.fillna(0)
-tab.loc[tab["Is_High_LA"]=="High dose","OME per 1000_High Dose"] = tab["total_ome_per_1000"]
-
-tab.loc[tab["Is_LA"]==True,"OME per 1000_Long Acting"] = tab["total_ome_per_1000"]
-
-grp = tab.loc[tab["year"]==2017]
-grp = grp[["chem_substance","OME per 1000_Long Acting"]].groupby(["chem_substance"]).sum().fillna(0).sort_values(by="OME per 1000_Long Acting",ascending=False).reset_index()
-grp["chemical"] = np.where(grp.index>5,"Other",grp.chem_substance)
-grp = grp.drop(["OME per 1000_Long Acting"], axis=1)
-tab2 = tab.reset_index().merge(grp,on="chem_substance")
-tab2 = tab2[["year","chemical","total_ome_per_1000","OME per 1000_Long Acting","OME per 1000_High Dose"]].fillna(0)
+chemical = top_chemicals(base, 2017, 6)  # top 6 by long acting OME in 2017, others grouped
+tab2 = rollup(base, ["year", "chemical"], derived={"chemical": ("chem_substance", chemical)})
+tab2 = tab2["OME per 1000"].drop("% High Dose", axis=1).add_prefix("OME per 1000_")
 
-tab2 = tab2.groupby(["year","chemical"]).sum().sort_values(by="total_ome_per_1000",ascending=False)
-tab2 = tab2.rename(columns={"total_ome_per_1000":"OME per 1000_Total"})
-
-tab2 = pd.DataFrame(tab2.stack()).reset_index().rename(columns={"level_2": 'measure', 0:"value"})
-tab2 = tab2.set_index(["measure","year","chemical"]).unstack().fillna(0)
+tab2 = tab2.rename_axis("measure", axis=1).stack().rename("value").to_frame()
+tab2 = tab2.reorder_levels(["measure", "year", "chemical"]).unstack().fillna(0).sort_index()
 tab2["Total"] = tab2.sum(axis=1)
 tab2
 # -
@@ -127,276 +83,43 @@ tab2
 
 # +
 import matplotlib.pyplot as plt
-import seaborn as sns
 import matplotlib
+from figures import aggregate as figure_aggregate, stacked_area_figure
 matplotlib.rcParams['pdf.fonttype'] = 42
 matplotlib.rcParams['ps.fonttype'] = 42
 
-sns.set_style("whitegrid",{'grid.color': '.9'})
-sns.set_palette("tab20",n_colors=14)
-
-dft = dfl.groupby("chem_substance")["total_ome_per_1000"].sum().sort_values(ascending=False).reset_index().rename(columns={"total_ome_per_1000":"total_ome_all_years"})
-sort_order = pd.Series(dft.chem_substance.drop_duplicates())
-
-grp = pd.DataFrame(sort_order).reset_index()
-grp["chemical"] = np.where(grp.index>10,"Other",grp.chem_substance)
-grp["other_flag"] = np.where(grp.index>10,0,1)
-dfl2 = dfl.merge(grp,on="chem_substance")
-
-dfs = dfl2.groupby(["other_flag","chemical"])["total_ome_per_1000"].sum().sort_values(ascending=False).reset_index().rename(columns={"total_ome_per_1000":"total_ome_all_years"}).sort_values(by=["other_flag","total_ome_all_years"],ascending=False)
-sort_order = pd.Series(dfs.chemical)
-
-
-s=[(0,'(a)  Total prescriptions for all opioid-containing preparations','Prescriptions per 1000 population','items_per_1000'),
-   (1,'(b)  Total Oral Morphine Equivalency (mg) for all opioid-containing preparations','Oral Morphine equivalency (mg) per 1000 population',"total_ome_per_1000"),
-   (2,'(c)  Total cost of all opioid-containing preparations','Cost per 1000 population (2017 equivalent GBP)','cost_per_1000')]
-
-fig = plt.figure(figsize=(15,20))
-   
-for i in s:
-    ax = plt.subplot(3,1,i[0]+1)  # layout and position of subplot
-    if i[0]==0:
-        dfp = dfl2.groupby(['year','chemical'])[i[3]].sum().unstack()
-        dfp = dfp.reindex(columns=sort_order)
-    if i[0]==1:
-        dfp = dfl2.groupby(['year','chemical'])[i[3]].sum().unstack()
-        dfp = dfp.reindex(columns=sort_order)
-    if i[0]==2:
-        dfp = dfl2.groupby(['year','chemical'])[i[3]].sum().unstack()
-        dfp = dfp.reindex(columns=sort_order)
-    dfp.plot(ax=ax, kind='area',  linewidth=0)
-    ax.set_xticks(np.arange(1998, 2017, step=1))
-    ax.set_xlabel('Year', size="14")
-    ax.set_ylabel(i[2], size="14")
-    ax.tick_params(labelsize=12)
-    ax.set_title(i[1], size="17")
-    handles, labels = ax.get_legend_handles_labels()
-    box = ax.get_position()
-    ax.set_position([box.x0, box.y0, box.width * 0.8, box.height])
-    ax.legend(reversed(handles), reversed(labels),loc='center left', fontsize="12",bbox_to_anchor=(1, .62))
-    
+# one aggregate of dfl is shared by all the stacked area figures below
+agg = figure_aggregate(dfl)
+
+fig = stacked_area_figure(agg, "all")
 #plt.savefig("opioids_Figure1_revisedv2.pdf", transparent=True, dpi=300)    
 plt.show()
-
-
 # -
 
 # ## Plot data - long acting preparations
 
-# +
-la_df = dfl.loc[(dfl['Is_LA'] == True)]
-
-import matplotlib.pyplot as plt
-import seaborn as sns
-
-sns.set_style("whitegrid",{'grid.color': '.9'})
-sns.set_palette("Set3",n_colors=14)
-
-dft = la_df.groupby("chem_substance")["total_ome_per_1000"].sum().sort_values(ascending=False).reset_index().rename(columns={"total_ome_per_1000":"total_ome_all_years"})
-sort_order = pd.Series(dft.chem_substance.drop_duplicates())
-
-grp = pd.DataFrame(sort_order).reset_index()
-grp["chemical"] = np.where(grp.index>11,"Other",grp.chem_substance)
-dfl2 = la_df.merge(grp,on="chem_substance")
-
-dfs = dfl2.groupby("chemical")["total_ome_per_1000"].sum().sort_values(ascending=False).reset_index().rename(columns={"total_ome_per_1000":"total_ome_all_years"})
-sort_order = pd.Series(dfs.chemical)
-
-
-s=[(0,'(a)  Total prescriptions for long-acting opioid preparations','Prescriptions per 1000 population','items_per_1000'),
-   (1,'(b)  Total Oral Morphine Equivalency (mg) for long-acting opioid preparations','Oral Morphine equivalency (mg) per 1000 population',"total_ome_per_1000"),
-   (2,'(c)  Total cost of long-acting opioid preparations','Cost per 1000 population (2017 equivalent GBP)','cost_per_1000')]
-
-fig = plt.figure(figsize=(15,20))
-   
-for i in s:
-    ax = plt.subplot(3,1,i[0]+1)  # layout and position of subplot
-    if i[0]==0:
-        dfp = dfl2.groupby(['year','chemical'])[i[3]].sum().unstack()
-        dfp = dfp.reindex(columns=sort_order)
-    if i[0]==1:
-        dfp = dfl2.groupby(['year','chemical'])[i[3]].sum().unstack()
-        dfp = dfp.reindex(columns=sort_order)
-    if i[0]==2:
-        dfp = dfl2.groupby(['year','chemical'])[i[3]].sum().unstack()
-        dfp = dfp.reindex(columns=sort_order)
-    dfp.plot(ax=ax, kind='area',  linewidth=0)
-    ax.set_xticks(np.arange(1998, 2017, step=1))
-    ax.set_xlabel('Year', size="14")
-    ax.set_ylabel(i[2], size="14")
-    ax.tick_params(labelsize=12)
-    ax.set_title(i[1], size="17")
-    handles, labels = ax.get_legend_handles_labels()
-    box = ax.get_position()
-    ax.set_position([box.x0, box.y0, box.width * 0.8, box.height])
-    ax.legend(reversed(handles), reversed(labels),loc='center left', fontsize="12",bbox_to_anchor=(1, .62))
-
+fig = stacked_area_figure(agg, "long_acting")
 plt.show()
 
-
-# -
-
 # ## Plot data - High dose opioids
 
-# +
-high_df = dfl.loc[(dfl['Is_High_LA'] == "High dose")]
-
-import matplotlib.pyplot as plt
-import seaborn as sns
-
-sns.set_style("whitegrid",{'grid.color': '.9'})
-sns.set_palette("Set3",n_colors=14)
-
-dft = high_df.groupby("chem_substance")["total_ome_per_1000"].sum().sort_values(ascending=False).reset_index().rename(columns={"total_ome_per_1000":"total_ome_all_years"})
-sort_order = pd.Series(dft.chem_substance.drop_duplicates())
-
-grp = pd.DataFrame(sort_order).reset_index()
-grp["chemical"] = np.where(grp.index>11,"Other",grp.chem_substance)
-dfl2 = high_df.merge(grp,on="chem_substance")
-
-dfs = dfl2.groupby("chemical")["total_ome_per_1000"].sum().sort_values(ascending=False).reset_index().rename(columns={"total_ome_per_1000":"total_ome_all_years"})
-
-s=[(0,'(a)  Total prescriptions for high-dose, long-acting opioid preparations','Prescriptions per 1000 population','items_per_1000'),
-   (1,'(b)  Total Oral Morphine Equivalency (mg) for high-dose, long-acting opioid preparations','Oral Morphine equivalency (mg) per 1000 population',"total_ome_per_1000"),
-   (2,'(c)  Total cost of high-dose, long-acting opioid preparations','Cost per 1000 population (2017 equivalent GBP)', 'cost_per_1000')]
-
-fig = plt.figure(figsize=(15,20))
-   
-for i in s:
-    ax = plt.subplot(3,1,i[0]+1)  # layout and position of subplot
-    if i[0]==1:
-        dfp = dfl2.groupby(['year','chemical'])[i[3]].sum().unstack()
-        dfp = dfp.reindex(columns=sort_order)
-    if i[0]==0:
-        dfp = dfl2.groupby(['year','chemical'])[i[3]].sum().unstack()
-        dfp = dfp.reindex(columns=sort_order)
-    if i[0]==2:
-        dfp = dfl2.groupby(['year','chemical'])[i[3]].sum().unstack()
-        dfp = dfp.reindex(columns=sort_order)
-    dfp.plot(ax=ax, kind='area',  linewidth=0)
-    ax.set_xticks(np.arange(1998, 2017, step=1))
-    ax.set_xlabel('Year', size="14")
-    ax.set_ylabel(i[2], size="14")
-    ax.tick_params(labelsize=12)
-    ax.set_title(i[1], size="17")
-    handles, labels = ax.get_legend_handles_labels()
-    box = ax.get_position()
-    ax.set_position([box.x0, box.y0, box.width * 0.8, box.height])
-    ax.legend(reversed(handles), reversed(labels),loc='center left', fontsize="12",bbox_to_anchor=(1, .62))
-
+fig = stacked_area_figure(agg, "high_dose")
 #plt.savefig("opioids_Figure2_revised.pdf", transparent=True, dpi=300)   
 plt.show()
 
-# -
-
 # ## Plot data - less popular opioids (expand "Other" group)
 
-# +
-import matplotlib.pyplot as plt
-import seaborn as sns
-
-sns.set_style("whitegrid",{'grid.color': '.9'})
-sns.set_palette("Set3",n_colors=14)
-
-dft = dfl.groupby("chem_substance")["total_ome_per_1000"].sum().sort_values(ascending=False).reset_index().rename(columns={"total_ome_per_1000":"total_ome_all_years"})
-sort_order = pd.Series(dft.chem_substance.drop_duplicates())
-
-grp = pd.DataFrame(sort_order).reset_index()
-grp = grp.loc[grp.index>=11].reset_index()
-grp["chemical"] = np.where(grp.index>10,"Others",grp.chem_substance)
-grp["other_flag"] = np.where(grp.index>10,0,1)
-dfl2 = dfl.merge(grp,on="chem_substance")
-
-dfs = dfl2.groupby(["other_flag","chemical"])["total_ome_per_1000"].sum().sort_values(ascending=False).reset_index().rename(columns={"total_ome_per_1000":"total_ome_all_years"}).sort_values(by=["other_flag","total_ome_all_years"],ascending=False)
-sort_order = pd.Series(dfs.chemical)
-
-
-s=[(0,'(a)  Total prescriptions for opioid-containing preparations','Prescriptions per 1000 population','items_per_1000'),
-   (1,'(b)  Total Oral Morphine Equivalency (mg) for opioid-containing preparations','Oral Morphine equivalency (mg) per 1000 population',"total_ome_per_1000"),
-   (2,'(c)  Total cost of opioid-containing preparations','Cost per 1000 population (2017 equivalent GBP)','cost_per_1000')]
-
-fig = plt.figure(figsize=(15,20))
-   
-for i in s:
-    ax = plt.subplot(3,1,i[0]+1)  # layout and position of subplot
-    if i[0]==0:
-        dfp = dfl2.groupby(['year','chemical'])[i[3]].sum().unstack()
-        dfp = dfp.reindex(columns=sort_order)
-    if i[0]==1:
-        dfp = dfl2.groupby(['year','chemical'])[i[3]].sum().unstack()
-        dfp = dfp.reindex(columns=sort_order)
-    if i[0]==2:
-        dfp = dfl2.groupby(['year','chemical'])[i[3]].sum().unstack()
-        dfp = dfp.reindex(columns=sort_order)
-    dfp.plot(ax=ax, kind='area',  linewidth=0)
-    ax.set_xticks(np.arange(1998, 2017, step=1))
-    ax.set_xlabel('Year', size="14")
-    ax.set_ylabel(i[2], size="14")
-    ax.tick_params(labelsize=12)
-    ax.set_title(i[1], size="17")
-    handles, labels = ax.get_legend_handles_labels()
-    box = ax.get_position()
-    ax.set_position([box.x0, box.y0, box.width * 0.8, box.height])
-    ax.legend(reversed(handles), reversed(labels),loc='center left', fontsize="12",bbox_to_anchor=(1, .62))
-    
-
+fig = stacked_area_figure(agg, "expand_other")
 plt.show()
 
-# -
-
 # ## Plot data - low-dose opioids
 
-# +
-low_df = dfl.loc[(dfl['Is_LA'] == True)&(dfl['Is_High_LA'] != "High dose")]
-
-import matplotlib.pyplot as plt
-import seaborn as sns
-
-sns.set_style("whitegrid",{'grid.color': '.9'})
-sns.set_palette("Set3",n_colors=14)
-
-dft = low_df.groupby("chem_substance")["total_ome_per_1000"].sum().sort_values(ascending=False).reset_index().rename(columns={"total_ome_per_1000":"total_ome_all_years"})
-sort_order = pd.Series(dft.chem_substance.drop_duplicates())
-
-grp = pd.DataFrame(sort_order).reset_index()
-grp["chemical"] = np.where(grp.index>11,"Other",grp.chem_substance)
-dfl2 = low_df.merge(grp,on="chem_substance")
-
-dfs = dfl2.groupby("chemical")["total_ome_per_1000"].sum().sort_values(ascending=False).reset_index().rename(columns={"total_ome_per_1000":"total_ome_all_years"})
-
-s=[(0,'(a)  Total prescriptions for non-high-dose, long-acting opioid preparations','Prescriptions per 1000 population','items_per_1000'),
-   (1,'(b)  Total Oral Morphine Equivalency (mg) for non-high-dose, long-acting opioid preparations','Oral Morphine equivalency (mg) per 1000 population',"total_ome_per_1000"),
-   (2,'(c)  Total cost of non-high-dose, long-acting opioid preparations','Cost per 1000 population (2017 equivalent GBP)', 'cost_per_1000')]
-
-fig = plt.figure(figsize=(15,20))
-   
-for i in s:
-    ax = plt.subplot(3,1,i[0]+1)  # layout and position of subplot
-    if i[0]==1:
-        dfp = dfl2.groupby(['year','chemical'])[i[3]].sum().unstack()
-        dfp = dfp.reindex(columns=sort_order)
-    if i[0]==0:
-        dfp = dfl2.groupby(['year','chemical'])[i[3]].sum().unstack()
-        dfp = dfp.reindex(columns=sort_order)
-    if i[0]==2:
-        dfp = dfl2.groupby(['year','chemical'])[i[3]].sum().unstack()
-        dfp = dfp.reindex(columns=sort_order)
-    dfp.plot(ax=ax, kind='area',  linewidth=0)
-    ax.set_xticks(np.arange(1998, 2017, step=1))
-    ax.set_xlabel('Year', size="14")
-    ax.set_ylabel(i[2], size="14")
-    ax.tick_params(labelsize=12)
-    ax.set_title(i[1], size="17")
-    handles, labels = ax.get_legend_handles_labels()
-    box = ax.get_position()
-    ax.set_position([box.x0, box.y0, box.width * 0.8, box.height])
-    ax.legend(reversed(handles), reversed(labels),loc='center left', fontsize="12",bbox_to_anchor=(1, .62))
-
+fig = stacked_area_figure(agg, "low_dose")
 plt.show()
 
-# -
-
 # ## Find first appearances in prescribing data for each opioid (broken down by formulation)
+#
+# The formulations are classified in the query; `formulations.py` is the same classification in Python, and `python formulations.py` rebuilds this table from local Parquet copies of the tables and checks it against `by_formulation.zip`.
 
 # +
 
@@ -442,7 +165,7 @@ GROUP BY
    GROUP BY chem_substance,  formulation
    ORDER BY chem_substance'''
 
-tbl = bq.cached_read(q, csv_path='by_formulation.zip')
+tbl = cached_read(q, csv_path='by_formulation.zip')
 tbl.head()
 # -
 
@@ -520,62 +243,12 @@ GROUP BY
 
 
 # +
-import glob
 import pandas as pd
 import numpy as np
+from caching import cached_shards
 
-schema = {
-    "pct": "category",
-    "practice": "category",
-    "status_code": "category",
-    "chem_substance": "category",
-    "Is_LA": "category",
-    "Is_High_LA": "category",
-    "items": pd.Int16Dtype(),
-    "quantity": pd.Int64Dtype(),
-    "total_ome": np.float16,
-    "net_cost": np.float16,
-    "actual_cost": np.float16,
-}
-
-
-def as_true_false(val):
-    "Convert to true/false strings"
-    if isinstance(val, str):
-        if not val:
-            val = None
-        elif str(val).lower() == "true":
-            val = True
-        else:
-            val = False
-    else:
-        if np.isnan(val):
-            val = None
-        else:
-            if val:
-                val = True
-            else:
-                val = False
-    return val
-
-
-converters = {"Is_LA": as_true_false, "Is_High_LA": as_true_false}
-df1 = None
-for path in sorted(glob.glob("opioid*gz")):
-    print("loading {}....".format(path))
-    if df1 is None:
-        df1 = pd.read_csv(path, dtype=schema, parse_dates=["month"], date_parser=lambda col: pd.to_datetime(col, utc=True), converters=converters, low_memory=False)
-    else:
-        df1 = pd.concat([df1, pd.read_csv(path, dtype=schema, parse_dates=["month"], date_parser=lambda col: pd.to_datetime(col, utc=True), converters=converters, low_memory=False)], ignore_index=True)
-
-#for col in ['pct', 'practice', 'status_code', 'chem_substance', 'Is_LA', 'Is_High_LA']:
-#    # Because of the concat above, some of these are converted to objects where new categories are introduced
-#    # between loop iterations
-#    df1[col] = df1[col].astype("category")
-for col in ['Is_LA', 'Is_High_LA']:
-    # Because of the concat above, some of these are converted to objects where new categories are introduced
-    # between loop iterations
-    df1[col] = df1[col].astype("category")
+# reads each shard in chunks and concatenates once, keeping the categories
+df1 = cached_shards(q, "opioid*gz")
 # + {}
 # import practice list size data
 
@@ -588,8 +261,7 @@ q2 = '''SELECT practice,
 from ebmdatalab.hscic.practice_statistics_all_years 
 '''
 
-pop = bq.cached_read(q2, csv_path='practice_list_size.zip', use_bqstorage_api=True)
-pop['month'] = pd.to_datetime(pop['month'])
+pop = cached_read(q2, csv_path='practice_list_size.zip', parse_dates=['month'], use_bqstorage_api=True)
 pop.head()
 # -
 
@@ -611,9 +283,9 @@ import numpy as np
 #df1["LA"] = False
 #df1.loc[df1["Is_LA"].astype(str)=="True","LA"] = True
   
-from pandas.api.types import is_numeric_dtype  
+from pandas.api.types import is_bool_dtype, is_numeric_dtype
 for y in df1.columns:
-    if is_numeric_dtype(df1[y].dtype):
+    if is_numeric_dtype(df1[y].dtype) and not is_bool_dtype(df1[y].dtype):  # Is_LA/Is_High_LA keep their blanks
           df1[y].fillna(0,inplace=True)
 
 
@@ -623,16 +295,20 @@ print (df1.practice.nunique()," total practices")
 
 # Filter to latest 6 months only and currently active practices with standard CCG codes (for regression and mapping)
 
-dftest = df1.loc[(df1["month"]>df1["month"].max()-pd.DateOffset(months=6))]
+from rolling import in_window
+
+dftest = df1.loc[in_window(df1["month"], months=6)]
 print ("Latest ", dftest.month.nunique()," months only (" , df1["month"].max()-pd.DateOffset(months=5), " to ", df1["month"].max(), "):") 
 print (dftest.practice.nunique()," practices including those not active / without valid CCG")
 
-dftestc = dftest.loc[dftest["status_code"] == "C"]
+from orgs import select
+
+dftestc = select(dftest, "closed")
 print (dftestc.practice.nunique()," practices closed")
-dftestd = dftest.loc[dftest["status_code"] == "D"]
+dftestd = select(dftest, "dormant")
 print (dftestd.practice.nunique()," practices dormant")
 
-dftest = dftest.loc[(dftest["pct"].str.match(r"([0-9]{2})([A-Za-z])")) & (dftest["status_code"] == "A")]
+dftest = select(dftest, "standard_ccg", "active")
 print (dftest.practice.nunique()," practices included")
 print (dftest.pct.nunique()," CCGs")
 # -
@@ -650,102 +326,52 @@ df1.info()
 # ### (a) Create calculated fields e.g total OME per 1000 population
 
 # +
+from listsizes import index_list_sizes
+from measures import practice_measures
 
-df = df1.copy()
-
-# tidy data
-df = df.drop(["pct","quantity","net_cost"],axis=1).reset_index(drop=True)
-
-# create columns for high dose and long acting OME
-df.loc[df["Is_LA"]==True,"Items Long Acting"] = df["items"]
-df.loc[df["Is_High_LA"]==True,"Items High Dose"] = df["items"]
-df.loc[df["Is_LA"]==True,"OME Long Acting"] = df["total_ome"]
-df.loc[df["Is_High_LA"]==True,"OME High Dose"] = df["total_ome"]
-df.loc[df["Is_LA"]==True,"Cost Long Acting"] = df["actual_cost"]
-df.loc[df["Is_High_LA"]==True,"Cost High Dose"] = df["actual_cost"]
-
-
-
-# +
-df2 = df.rename(columns={"total_ome":"Total OME",
-                          "items":"Total Items",
-                          "actual_cost":"Total Cost"})
-
-df2 = df2.merge(pop[["practice","month","total_list_size"]], on=["practice","month"])
-df2["Percent high dose (by OME)"] = 100*df2["OME High Dose"]/df2["OME Long Acting"]
-df2["Percent high dose (by items)"] = 100*df2["Items High Dose"]/df2["Items Long Acting"]
-df2["Total OME (per 1000)"] = 1000*df2["Total OME"]/df2.total_list_size
-df2["Total items (per 1000)"] = 1000*df2["Total Items"]/df2.total_list_size
-df2["Total cost (per 1000)"] = 1000*df2["Total Cost"]/df2.total_list_size
-df2["Cost high dose opioids (per 1000)"] = 1000*df2["Cost High Dose"]/df2.total_list_size
-df2["Cost high dose opioids (per item)"] = df2["Cost High Dose"]/df2["Items High Dose"]
-
-df2["High dose items (per 1000)"] = 1000*df2["Items High Dose"]/df2.total_list_size
-df2["Long acting items (per 1000)"] = 1000*df2["Items Long Acting"]/df2.total_list_size
-df2["High dose OME (per 1000)"] = 1000*df2["OME High Dose"]/df2.total_list_size
-df2["Long acting OME (per 1000)"] = 1000*df2["OME Long Acting"]/df2.total_list_size
+# list sizes by practice and month, looked up by position rather than merged
+pop_index = index_list_sizes(pop)
+df2 = practice_measures(df1, pop_index)
 df2.head()
 # -
 
 # ### (b) Calculate deciles
 
-df3 = df2
-x = np.arange(0.1, 1, 0.1) # set range of deciles required (0.1-0.9)
-pc = df3.groupby('month').quantile(x)  # calculate deciles for each month
-pc = pd.DataFrame(pc.stack()).reset_index().rename(columns={"level_1": 'percentile',"level_2": 'measure', 0:"value"}) # rearrange
-pc["index"] = (pc.percentile*10).map(int) # create integer range of percentiles as integers are better for charts
+# +
+from deciles import deciles, to_long
+
+# deciles (0.1-0.9) for each month, only for the measures we chart or use for savings
+dec = deciles(df2)
+pc = to_long(dec)
 pc.head(12)
 
 # +
-
 import matplotlib.pyplot as plt
-import datetime
-import matplotlib.gridspec as gridspec
-import seaborn as sns
-
-sns.set_style("whitegrid",{'grid.color': '.9'})
-dfp = pc.sort_values(by=["month","measure"])
-#dfp['month'] = dfp['month'].astype(str)
-# set format for dates:
-#dfp['dates'] = [datetime.datetime.strptime(date, '%Y-%m-%d').date() for date in dfp['month']]
-
-
-# set sort order of measures manually, and add grid refs to position each subplot:
-s = [(0,'Total OME (per 1000)',0,0,"Oral Morphine Equivalency (mg) per 1000 patients", "(a)  Total OME for all opioid-containing preparations"), 
-     (1,'High dose items (per 1000)',0,1,"Items per 1000 patients", "(b)  High dose items"), 
-     (2,'Percent high dose (by items)',1,0,"Percent",'(c)  Percent long-acting opioids prescribed as high dose (by items)'), 
-     (3,'Percent high dose (by OME)',1,1,"Percent",'(d)  Percent long-acting opioids prescribed as high dose (by OME)'), 
-     (4,'Total cost (per 1000)',2,0,"Cost per 1000 patients (GBP)", "(e)  Total cost for all opioid-containing preparations"), 
-     (5,'Cost high dose opioids (per 1000)',2,1,"Cost per 1000 patients (GBP)", "(f)  Cost for all high dose opioids")
-    ]
-
-
-fig = plt.figure(figsize=(18,20)) 
-gs = gridspec.GridSpec(3,2)  # grid layout for subplots
-
-# Plot each subplot using a loop
-for i in s:
-    ax = plt.subplot(gs[i[2], i[3]])  # position of subplot in grid using coordinates listed in s
-    for decile in range(1,10):   # plot each decile line
-        data = dfp.loc[(dfp['measure']==i[1]) & (dfp['index']==decile)]
-        if decile == 5:
-            ax.plot(data["month"],data['value'],'b-',linewidth=0.7)
-        else:
-            ax.plot(data["month"],data['value'],'b--',linewidth=0.4)
-    ax.set_ylabel(i[4], size =14, alpha=0.6)
-    ax.set_title(i[5],size = 17)
-    ax.set_ylim([0,1.05*data["value"].max()])
-    if  i[4]=="Percent":    # set y axis limit only for percentage measure
-        ax.set_ylim([0, 70])
-    ax.tick_params(labelsize=12)
-    ax.set_xlim([dfp['month'].min(), dfp['month'].max()]) # set x axis range as full date range
-
-plt.subplots_adjust(wspace = 0.13,hspace = 0.16)
+from figures import plot_deciles
 
+fig = plot_deciles(dec)
 #plt.savefig("opioids_Figure4_revised.pdf", transparent=True, dpi=300)  
 plt.show()
+# -
+
+# ## Practice and CCG dimension tables
+
+# +
+from dimensions import ccg_dimension, map_names, practice_dimension
+
+qc = '''
+SELECT 
+  code, name
+FROM  `hscic.ccgs` c 
+WHERE org_type = "CCG"
+'''
 
+names = cached_read(qc, csv_path='ccg_names.csv')
 
+# one int32 key per CCG and practice, with their codes, names and months with a list size
+ccg_dim = ccg_dimension(names, pd.read_csv('ccg_for_map.csv'), map_names('ccgs.json'), pop)
+practice_dim = practice_dimension(pop, ccg_dim)
+ccg_dim.head()
 # -
 
 # ## Variation by CCG (maps)
@@ -753,60 +379,23 @@ plt.show()
 # ### (a) Aggregate data, create calculated fields
 
 # +
-# filter to latest 6 months only
-df4 = dftest
-df4 = df4.drop(["quantity","net_cost"],axis=1)
-
-# group to ccg level and combine the 6 months
-df4 = pd.DataFrame(df4.groupby(["pct","chem_substance","Is_LA","Is_High_LA"])["items","total_ome","actual_cost"].sum()).reset_index()
-
-df4["fent_ome"] = np.where((df4["chem_substance"] == "Fentanyl")& (df4["Is_High_LA"]==True),df4["total_ome"],0)
-df4["morph_ome"] = np.where((df4["chem_substance"] == "Morphine Sulfate")& (df4["Is_High_LA"]==True),df4["total_ome"],0)
-df4["oxyco_ome"] = np.where((df4["chem_substance"] == "Oxycodone Hydrochloride")& (df4["Is_High_LA"]==True),df4["total_ome"],0)
-df4["practice_count"] = 1
-
-# aggregate chem substances
-df = pd.DataFrame(df4.groupby(["pct","Is_LA","Is_High_LA"]).sum()).reset_index()
-
-# create columns for high dose and long acting OME
-df.loc[df["Is_LA"]==True,"Items Long Acting"] = df["items"]
-df.loc[df["Is_High_LA"]==True,"Items High Dose"] = df["items"]
-df.loc[df["Is_LA"]==True,"OME Long Acting"] = df["total_ome"]
-df.loc[df["Is_High_LA"]==True,"OME High Dose"] = df["total_ome"]
-df.loc[df["Is_LA"]==True,"Cost Long Acting"] = df["actual_cost"]
-df.loc[df["Is_High_LA"]==True,"Cost High Dose"] = df["actual_cost"]
-
-df = df.drop(["Is_LA","Is_High_LA"],axis=1)
-df = df.groupby(["pct"]).sum().reset_index()
-
-df3 = df.rename(columns={"total_ome":"Total OME",
-                          "items":"Total Items",
-                          "actual_cost":"Total Cost"})
-
-#aggregate list sizes up to CCG level and get population sizes averaged over latest 6 months
-popccg = pop.loc[pop["month"]> df1["month"].max()-pd.DateOffset(months=6)]
-popccg = popccg.groupby(["CCG","month"])["total_list_size"].sum() # sum across CCGs
-popccg = pd.DataFrame(popccg.groupby("CCG").mean()).reset_index() # average across months
-df3 = df3.merge(popccg[["CCG","total_list_size"]], right_on="CCG", left_on="pct").drop("CCG",axis=1)
-
-df3["Percent high dose (by items)"] = 100*df3["Items High Dose"]/df3["Items Long Acting"]
-df3["Percent high dose (by OME)"] = 100*df3["OME High Dose"]/df3["OME Long Acting"]
-df3["Total OME (per 1000)"] = 1000*df3["Total OME"]/df3.total_list_size
-df3["Total items (per 1000)"] = 1000*df3["Total Items"]/df3.total_list_size
-df3["High dose items (per 1000)"] = 1000*df3["Items High Dose"]/df3.total_list_size
-df3["Long acting items (per 1000)"] = 1000*df3["Items Long Acting"]/df3.total_list_size
-df3["High dose OME (per 1000)"] = 1000*df3["OME High Dose"]/df3.total_list_size
-df3["Long acting OME (per 1000)"] = 1000*df3["OME Long Acting"]/df3.total_list_size
-df3["Total cost (per 1000)"] = 1000*df3["Total Cost"]/df3.total_list_size
-df3["Cost high dose opioids (per 1000)"] = 1000*df3["Cost High Dose"]/df3.total_list_size
-df3.head()
-
-df4 = df3.copy()
-
-df4["% Fentanyl of high dose OME"] = 100*df4["fent_ome"]/df4["OME High Dose"]
-df4["% Morphine of high dose OME"] = 100*df4["morph_ome"]/df4["OME High Dose"]
-df4["% Oxycodone of high dose OME"] = 100*df4["oxyco_ome"]/df4["OME High Dose"]
-
+import glob
+from caching import cached_build
+from cube import build_cube, build_list_sizes, ccg_measures_at, rolling_ccg_sums
+from dimensions import add_keys
+
+# sum the practice data by CCG and month once; the CCG tables below are built from these sums
+sources = sorted(glob.glob("opioid*gz")) + ["practice_list_size.zip"]
+cube = cached_build("ccg_cube", q + q2, sources, lambda: build_cube(df1))
+ccg_pop = cached_build("ccg_list_sizes", q + q2, sources, lambda: build_list_sizes(df1, pop))
+cube = add_keys(cube, ccgs=ccg_dim)
+
+# rolling sums for active practices with standard CCG codes, and CCG list sizes;
+# any window can be read from these, e.g. ccg_measures_at(ccg_sums, 6, end="2017-06-01")
+ccg_sums = rolling_ccg_sums(cube, ccg_pop)
+
+# latest 6 months (as dftest), CCG population sizes averaged over the same months
+df4 = ccg_measures_at(ccg_sums, months=6)
 df4.head()
 # -
 
@@ -822,19 +411,11 @@ table
 # ### (c) Join to geographical data
 
 # +
+from dimensions import label
 
-spending = df4.copy()
-names = pd.read_csv('ccg_for_map.csv')
-qc = '''
-SELECT 
-  code, name
-FROM  `hscic.ccgs` c 
-WHERE org_type = "CCG"
-'''
-
-names = bq.cached_read(qc, csv_path='ccg_names.csv')
-spending2 = spending.merge(names[['code','name']],left_on="pct",right_on="code")
-spending2 = spending2.drop(["code","fent_ome","morph_ome","oxyco_ome"],axis=1).set_index('name')
+# CCG names by key; any CCG without one is listed
+spending = add_keys(df4.copy(), ccgs=ccg_dim)
+spending2 = label(spending, ccg_dim).drop(["ccg_key"],axis=1).set_index('name')
 spending2 = spending2.round(0)
 
 spending2.sort_values(by="Total OME (per 1000)") # 195 rows
@@ -843,269 +424,174 @@ spending2.sort_values(by="Total OME (per 1000)") # 195 rows
 # ### (d) Plot maps
 
 # +
-import matplotlib.gridspec as gridspec
-import geopandas as gpd
 import matplotlib.pyplot as plt
-import pandas as pd
-#from matplotlib import verbose
-#verbose.level = 'helpful'    
-
-# from our API https://openprescribing.net/api/1.0/org_location/?org_type=ccg
-ccgs = gpd.read_file('ccgs.json').set_index('name')
-
-ccgs = ccgs[~ccgs['geometry'].isnull()]  # remove ones without geometry - these are federations rather than individual CCGs
-gdf = ccgs.join(spending2)
-
-# set sort order of measures manually, and add grid refs to position each subplot:
-s = [(0,'Total OME (per 1000)',0,0,'(a)  '),      (1,'Total cost (per 1000)',0,1,'(b)  '), 
-     (2,'High dose items (per 1000)',1,0,'(c)  '),      (3,'Percent high dose (by items)',1,1,'(d)  ')
-    ]
-
-fig = plt.figure(figsize=(16,30))
-gs = gridspec.GridSpec(4,2)  # grid layout for subplots
-
-for i in s:
-    ax = plt.subplot(gs[i[2], i[3]])  # position of subplot in grid using coordinates listed in s
-    gdf.plot(ax=ax,column=i[1],  edgecolor='black', linewidth=0.1, legend=True, cmap='OrRd')
-    ax.set_aspect(1.63)
-    ax.set_title(i[4]+i[1],size = 20)
-    cb_ax = fig.axes[2*(i[0])+1] # extract legend labels from list of axis/legend labels
-    cb_ax.tick_params(labelsize=14)
-    plt.axis('off')
-
-plt.subplots_adjust(wspace = 0.05,hspace = 0.05)
+from figures import plot_map_figure, plot_maps, plot_share_maps
 
+# the boundaries are converted to paths once and every map below reuses them (see choropleth.py)
+fig = plot_maps(spending2)
 #plt.savefig("opioids_Figure3ad_revised.pdf", transparent=True, dpi=300)  
 plt.show()
 # -
 
 # ### (e) Plot additional maps for some percentage measures
 
-# +
-import matplotlib.gridspec as gridspec
-import geopandas as gpd
-import matplotlib.pyplot as plt
-import pandas as pd
-
-# set sort order of measures manually, and add grid refs to position each subplot:
-s = [(0,'% Fentanyl of high dose OME',0,0,'(e)  ',False),      (1,'% Morphine of high dose OME',0,1,'(f)  ',False), 
-     (2,'% Oxycodone of high dose OME',0,2,'(g)  ',True)
-    ]
-
-fig = plt.figure(figsize=(17,6))
-#plt.subplots(ncols=3)
-gs = gridspec.GridSpec(1,3, width_ratios=[4,4,5])  # grid layout for subplots; 
-# adjust ratios to allow all plots to appear same size despite the third having a legend.
-
-# set common value limits for colour scale
-vmin = 0
-vmax = gdf[["% Fentanyl of high dose OME","% Morphine of high dose OME","% Oxycodone of high dose OME"]].max().max()*1.05
-
-for i in s:
-    ax = plt.subplot(gs[0,i[0]])  # position of subplot in grid using coordinates listed in s
-    gdf.plot(ax=ax,column=i[1],  edgecolor='black', linewidth=0.1, cmap='OrRd', legend = i[5], vmin=vmin, vmax=vmax)   
-    ax.set_title(i[4]+i[1],size = 20)
-    ax.set_aspect(1.63)  # aspect for correct lat/long
-    plt.axis('off')
-cb_ax = fig.axes[3] # take legend label (4th item in list of axis/legend labels for all plots)
-cb_ax.tick_params(labelsize=16) # set label size for legend
-
-plt.tight_layout()
+fig = plot_share_maps(spending2)
 #plt.savefig("opioids_Figure3eg_revised.pdf", transparent=True, dpi=300)  
 plt.show()
 
 # +
-import matplotlib.gridspec as gridspec
-import geopandas as gpd
-import matplotlib.pyplot as plt
-import pandas as pd
-#from matplotlib import verbose
-#verbose.level = 'helpful'    
-
-# from our API https://openprescribing.net/api/1.0/org_location/?org_type=ccg
-ccgs = gpd.read_file('ccgs.json').set_index('name')
-
-ccgs = ccgs[~ccgs['geometry'].isnull()]  # remove ones without geometry - these are federations rather than individual CCGs
-gdf = ccgs.join(spending2)
-
-# set sort order of measures manually, and add grid refs to position each subplot:
-s = [(0,'Total OME (per 1000)',0,0,'(a)  '),      (1,'Total cost (per 1000)',0,1,'(b)  '), 
-     (2,'High dose items (per 1000)',1,0,'(c)  '),      (3,'Percent high dose (by items)',1,1,'(d)  ')
-    ]
-
-fig = plt.figure(figsize=(16,30))
-gs1 = gridspec.GridSpec(4,2)  # grid layout for subplots
-
-gs1.update(bottom=0.3, wspace=0.05,hspace = 0.05)
-
-for i in s:
-    ax = plt.subplot(gs1[i[2], i[3]])  # position of subplot in grid using coordinates listed in s
-    gdf.plot(ax=ax,column=i[1],  edgecolor='black', linewidth=0.1, legend=True, cmap='OrRd')
-    ax.set_aspect(1.63)
-    ax.set_title(i[4]+i[1],size = 20)
-    cb_ax = fig.axes[2*(i[0])+1] # extract legend labels from list of axis/legend labels
-    cb_ax.tick_params(labelsize=14)
-    plt.axis('off')
-
-#plt.savefig("opioids_Figure3ad_revised.pdf", transparent=True, dpi=300)  
-#plt.show()
-
-
-
-# set sort order of measures manually, and add grid refs to position each subplot:
-s = [(0,'% Fentanyl of high dose OME',0,0,'(e)  ',False),      (1,'% Morphine of high dose OME',0,1,'(f)  ',False), 
-     (2,'% Oxycodone of high dose OME',0,2,'(g)  ',True)
-    ]
-
-#fig = plt.figure(figsize=(17,6))
-#plt.subplots(ncols=3)
-gs2 = gridspec.GridSpec(1,3, width_ratios=[4,4,5])  # grid layout for subplots; 
-# adjust ratios to allow all plots to appear same size despite the third having a legend.
-gs2.update(top=0.3,wspace=0.05)
+# maps (a)-(g) in one figure; panels and colour scales are set in figures.map_figures
+fig = plot_map_figure(spending2, "all_maps")
+#plt.savefig("opioids_Figure3eg_revised.png", format='png', dpi=300)
+plt.show()
+# -
 
-# set common value limits for colour scale
-vmin = 0
-vmax = gdf[["% Fentanyl of high dose OME","% Morphine of high dose OME","% Oxycodone of high dose OME"]].max().max()*1.05
+# ### (f) Interactive web map
+#
+# Every CCG measure, for each 6 month window, as a static site to browse
+# with `python -m http.server --directory web` (see webmap.py).
 
-for i in s:
-    ax = plt.subplot(gs2[0,i[0]])  # position of subplot in grid using coordinates listed in s
-    gdf.plot(ax=ax,column=i[1],  edgecolor='black', linewidth=0.1, cmap='OrRd', legend = i[5], vmin=vmin, vmax=vmax)   
-    ax.set_title(i[4]+i[1],size = 18)
-    ax.set_aspect(1.63)  # aspect for correct lat/long
-    plt.axis('off')
-cb_ax = fig.axes[3] # take legend label (4th item in list of axis/legend labels for all plots)
-cb_ax.tick_params(labelsize=16) # set label size for legend
+# +
+from webmap import export
 
-plt.tight_layout()
-#plt.savefig("opioids_Figure3eg_revised.png", format='png', dpi=300)
-plt.show()
+web = export("web", ccg_sums, ccg_dim, months=6)
+len(web["windows"]), len(web["measures"])
 # -
 
 # ## Potential cost savings
 
 # +
 # Extract lowest practice percentile for both high-dose items and cost per 1000 population for latest 6 months
-lowest_dec = pc[["month","measure","value"]].loc[(pc["month"]>pc["month"].max() - pd.DateOffset(months=6)) 
-       & (pc["percentile"] == 0.1)].fillna(0)
-lowest_dec.loc[lowest_dec["measure"]=="High dose items (per 1000)","measure"] = "high dose items"
-lowest_dec.loc[lowest_dec["measure"]=="Cost high dose opioids (per 1000)","measure"] = "high dose cost"
-lowest_dec.loc[lowest_dec["measure"]=="Cost high dose opioids (per item)","measure"] = "high dose costperitem"
-
-# extract data on high dose items
-dfs = pd.DataFrame(df2[["practice","month","total_list_size","Items High Dose","Total Cost","Cost High Dose", "Cost high dose opioids (per item)"]].set_index(["practice","month","total_list_size"]).stack()).reset_index().rename(columns={"level_3":"measure",0:"actual_value"})
-dfs.loc[dfs["measure"]=="Items High Dose","measure"] = "high dose items"
-dfs.loc[dfs["measure"]=="Cost High Dose","measure"] = "high dose cost"
-dfs.loc[dfs["measure"]=="Cost high dose opioids (per item)","measure"] = "high dose costperitem"
-
-# merge with lowest decile data (inner join, this restricts data to latest 6 months)
-savings = dfs.merge(lowest_dec,on=["month","measure"])
-
-savings["target_value"] = savings["total_list_size"]*savings["value"]/1000
-savings["potential_saving"] = savings["actual_value"] - savings["target_value"]
-savings = savings.fillna(0)
-savings.loc[savings["potential_saving"]<0,"potential_saving"] = 0
+from deciles import series
+
+recent = in_window(dec.months, months=6)
+lowest_dec = pd.concat({"high dose items": series(dec, "High dose items (per 1000)", 0.1)[recent],
+                        "high dose cost": series(dec, "Cost high dose opioids (per 1000)", 0.1)[recent],
+                        "high dose costperitem": series(dec, "Cost high dose opioids (per item)", 0.1)[recent]},
+                       names=["measure","month"]).rename("value").reset_index().fillna(0)
+
+# potential savings of each scenario by CCG, over the latest 6 months, in one pass over df2
+from savings import savings, scenarios, totals
+
+all_scenarios = dict(scenarios)
+all_scenarios["high dose cost, lowest decile within CCG"] = dict(scenarios["high dose cost"], within="ccg")
+all_scenarios["high dose cost at cost per item of each chemical"] = dict(scenarios["high dose cost at cost per item"], within="chem_substance")
+all_scenarios["high dose cost at median"] = dict(scenarios["high dose cost"], percentile=0.5)
+
+by_ccg = savings(df2, all_scenarios, months=6)  # by the CCG each row was prescribed under
+saving_totals = totals(by_ccg)
 
 print("Practices at the lowest decile over the latest 6 months prescribed: ", lowest_dec.loc[lowest_dec["measure"]=="high dose items"].mean().round(2).value, 
       "items / £", lowest_dec.loc[lowest_dec["measure"]=="high dose cost"].mean().round(2).value, " per 1,000 patients")
 
-print(savings.groupby("measure")["actual_value","potential_saving"].sum())
+print(saving_totals)
 
 # +
 # Compare best cost-per-item prices
-dfs2 = pd.DataFrame(df2[["practice","month","Items High Dose","Total Cost","Cost High Dose", "Cost high dose opioids (per item)"]])
-#dfs2.loc[dfs2["measure"]=="Cost high dose opioids (per item)","measure"] = "high dose costperitem"
-savings = dfs2.merge(lowest_dec.loc[lowest_dec.measure=="high dose costperitem"],on=["month"])
-savings["target_value"] = savings["Items High Dose"]*savings["value"]
-savings["potential_saving"] = savings["Cost High Dose"] - savings["target_value"]
-
-savings = savings.fillna(0).drop("measure",axis=1)
-savings.loc[savings["potential_saving"]<0,"potential_saving"] = 0
-
-
+total = saving_totals.loc["high dose cost at cost per item"]
 
 print("If each practice prescribed at the lowest decile cost-per-item over the latest six months (£", 
       lowest_dec.loc[lowest_dec["measure"]=="high dose costperitem"].mean().round(2).value, 
-      "per item), in total they could have saved £", round(savings["potential_saving"].sum(),-3), " out of a total £",
-      round(savings["Cost High Dose"].sum(),-3), "(",
-      round(100*savings["potential_saving"].sum()/savings["Cost High Dose"].sum(),1), "%)" )
-
+      "per item), in total they could have saved £", round(total["potential_saving"],-3), " out of a total £",
+      round(total["actual_value"],-3), "(",
+      round(100*total["potential_saving"]/total["actual_value"],1), "%)" )
 # -
 
+# scenario x CCG potential savings
+by_ccg.potential
+
 # ## Change by CCG
+#
+# OME per 1000 for every CCG and every full calendar year, and for the 12
+# months to each month, from one CCG x month table; the change between any
+# two periods is a column of `changes` (see change.py).
 
 # +
-yr1 = df1.loc[(df1["pct"].str.match(r"([0-9]{2})([A-Za-z])"))& (df1['month'].dt.year>=2016)].reset_index()
-yr1["year"] = yr1['month'].dt.year
+from change import changes, monthly_ome, ome_per_1000, pair, year_on_year
 
-yr1.head()
+monthly = monthly_ome(cube, ccg_pop)
+yr2 = ome_per_1000(monthly)
+# CCG names by key, as for the maps
+yr2 = label(add_keys(yr2.reset_index(), ccgs=ccg_dim), ccg_dim).drop(["pct", "ccg_key"], axis=1).set_index("name")
+yr2.head()
 # -
 
-df1.info()
+# change and % change between every pair of years
+moves = changes(yr2)
+year_on_year(moves).change.describe()
 
-yr1 = df1.loc[(df1["pct"].str.match(r"([0-9]{2})([A-Za-z])"))& (df1['month'].dt.year>=2016)].reset_index()
-yr1["year"] = yr1['month'].dt.year
-yr1.head()
+# +
+change2 = pair(moves, 2016, 2017)
 
-# + {"active": ""}
-#
-# -
+change2.sort_values(by="change") # 195 rows
 
-yr2 = yr1[["pct","practice","month","year","total_ome"]].groupby(["pct","practice","month","year"])['total_ome'].sum()
-yr2 = yr2.reset_index().merge(pop[["practice","month","total_list_size"]], on=["practice","month"]).groupby(["pct","month","year"]).sum()
-yr2.head()
+# +
+from figures import plot_change_map
 
-yr2 = yr2.reset_index().groupby(['pct','year']).agg({'total_list_size':'mean','total_ome':"sum"})
-yr2["OME_per_1000"] = 1000*yr2["total_ome"]/yr2.total_list_size
-yr2 = yr2.drop(['total_list_size','total_ome'],axis=1).unstack().reset_index(col_level=1)
-yr2.columns = yr2.columns.droplevel()
-yr2 = yr2.drop(2018,axis=1)
-yr2["change"] = yr2[2017]-yr2[2016]
-yr2["%change"] = 100*(yr2["change"])/yr2[2016]
-yr2 = yr2.sort_values(by="change").reset_index(drop=True)
-yr2.head()
+fig = plot_change_map(change2)
+plt.show()
+# -
 
 # +
-change = yr2.copy()
-
-change2 = change.merge(names[['code','name']],left_on="pct",right_on="code")
-change2 = change2.drop([2016,2017,"code"],axis=1).set_index('name')
+# the latest 12 months against the 12 months before, which includes the part
+# year left out of the calendar years
+by_window = ome_per_1000(monthly, by="window")
+by_window = label(add_keys(by_window.reset_index(), ccgs=ccg_dim), ccg_dim).drop(["pct", "ccg_key"], axis=1).set_index("name")
+start, end = by_window.columns[-13], by_window.columns[-1]
+change_window = pair(changes(by_window[[start, end]]), start, end)
+fig = plot_change_map(change_window)
+plt.show()
+# -
 
-change2.sort_values(by="change") # 195 rows
+# ## CCGs at one boundary vintage
+#
+# The prescribing data has each practice under the CCG code of the month, so
+# the CCGs merged before April 2018 (the vintage of `ccgs.json`) have no
+# boundary and drop out of the maps. `crosswalk.py` restates the practice
+# rows on the CCGs of one vintage, from each practice's CCG that month and
+# the mergers in `ccg_successors.csv`.
 
 # +
-import matplotlib.gridspec as gridspec
-import geopandas as gpd
-import matplotlib.pyplot as plt
-import pandas as pd
-#from matplotlib import verbose
-#verbose.level = 'helpful'    
-import matplotlib.colors as colors
-
-cmap = 'coolwarm'
-#bounds = np.array([-60000,-45000, -30000, -15000, 0, 0, 5000, 10000,15000, 20000])
-#norm = colors.BoundaryNorm(boundaries=bounds, ncolors=256)
+from crosswalk import boundary_vintage, crosswalk, read_successors, reconcile, restate
 
+walk = crosswalk(pop, read_successors(), boundary_vintage)
+codes = reconcile(ccg_dim, walk, df1["pct"])
+codes.loc[codes["in_data"]].groupby("status").size()
+# -
 
-# from our API https://openprescribing.net/api/1.0/org_location/?org_type=ccg
-ccgs = gpd.read_file('ccgs.json').set_index('name')
+# codes in the data without a boundary of their own
+codes.loc[codes["in_data"] & (codes["status"] != "mapped")]
 
-ccgs = ccgs[~ccgs['geometry'].isnull()]  # remove ones without geometry - these are federations rather than individual CCGs
-gdf = ccgs.join(change2)
+# +
+# the practice rows and list sizes restated on the April 2018 CCGs, and the change from 2016 to 2017 on them
+df1_2018 = restate(df1, walk)
+cube_2018 = build_cube(df1_2018)
+ccg_pop_2018 = build_list_sizes(df1_2018, restate(pop, walk, column="CCG"))
+
+yr2_2018 = ome_per_1000(monthly_ome(cube_2018, ccg_pop_2018))
+yr2_2018 = label(add_keys(yr2_2018.reset_index(), ccgs=ccg_dim), ccg_dim).drop(["pct", "ccg_key"], axis=1).set_index("name")
+change2_2018 = pair(changes(yr2_2018), 2016, 2017)
+change2_2018.sort_values(by="change")
+# -
 
-vmax = -gdf["change"].min() # set max of scale to reflect minimum such that zero falls in centre of scale.
+fig = plot_change_map(change2_2018)
+plt.show()
 
-fig, ax = plt.subplots(figsize=(12, 7))
-g = gdf.plot(ax=ax,column="change",  edgecolor='black', linewidth=0.1, legend=True, cmap=cmap, vmax=vmax)
-ax.set_aspect(1.63)
-#cb_ax = fig.axes[2*(i[0])+1] # extract legend labels from list of axis/legend labels
-#cb_ax.tick_params(labelsize=14)
-plt.axis('off')
-#fig.colorbar(g, ax=ax, extend='both', orientation='vertical')
+# ## Confidence intervals
+#
+# Practices are resampled within CCGs, and the potential savings, the fold-differences between CCGs and the change in OME per 1000 from 2016 to 2017 recalculated for each resample.
 
-plt.show()
+# +
+from bootstrap import cached_bootstrap, intervals
 
+# the resamples are cached as the CCG cube is, and drawn again when the extracts, seed or resamples change
+boot = cached_bootstrap(q + q2, sources, df1, df2, ccg_pop, resamples=1000, seed=2018, years=(2016, 2017))
+ci = intervals(boot)
+ci.loc[["saving", "fold-difference"]]
 # -
 
+ci.loc["change"].sort_values(by="estimate")
+
 # # All practice types
 
 # +
@@ -1117,18 +603,18 @@ WITH q2 AS (
     s.practice, 
     s.pct_id AS pct,
     CAST(s.month AS DATE) AS year_mon, 
-    CASE WHEN prac.setting = 4 THEN "GP" ELSE "other" END AS type,
+    prac.setting,
     MAX(total_list_size) AS total_list_size
   FROM ebmdatalab.hscic.practice_statistics_all_years s
   INNER JOIN  ebmdatalab.hscic.practices prac ON prac.code=s.practice 
 
-  GROUP BY practice, pct, type, year_mon )
+  GROUP BY practice, pct, setting, year_mon )
 
 -- join practices to opioid prescribing data and group to CCGs
 SELECT 
   COALESCE(p.pct,q2.pct) AS pct,
   q2.year_mon AS month,
-  type,
+  setting,
   l.chem_substance,
   Is_LA,
   Is_High_LA,
@@ -1144,7 +630,7 @@ INNER JOIN `hscic.ccgs` c ON c.code = p.pct AND org_type = "CCG"
 
 GROUP BY 
   pct,
-  type,
+  setting,
   month,
   chem_substance,
   Is_LA,
@@ -1157,15 +643,16 @@ FROM ebmdatalab.hscic.normalised_prescribing_standard p
 WHERE SUBSTR(p.bnf_code,1,6) IN ("040201","040702","100101")'''
 
 
-ccg = bq.cached_read(q5, 'opiods_by_practice_setting.csv.gz', use_bqstorage_api=True)
+ccg = cached_read(q5, 'opiods_by_practice_setting.csv.gz', parse_dates=['month'], use_bqstorage_api=True)
 ccg.head()
 # -
 
-c2 = ccg.copy()#.loc[ccg["Is_High_LA"]=="TRUE"]
-c2["month"] = pd.to_datetime(c2.month)
-c2 = c2.loc[c2["month"]>c2["month"].max() - pd.DateOffset(months=6)]
-c2 = pd.DataFrame(c2.groupby(["pct","type"])["total_ome"].sum()).unstack() #.sort_values(by="total_ome").transpose()    # "pct","Is_LA","Is_High_LA"c
-c2.columns = c2.columns.droplevel()
+from orgs import mask
+from rolling import cumulate, window_sums
+
+ccg["type"] = np.where(mask(ccg, "gp"), "GP", "other")
+c2 = cumulate(ccg, ["pct","type"], ["total_ome"])  # monthly OME by CCG and setting, summed cumulatively
+c2 = window_sums(c2, months=6)["total_ome"].unstack()  # latest 6 months
 c2["ome_percent_nongp"] = 100*c2.other / (c2.other+c2.GP)
 print(c2["ome_percent_nongp"].count(), 'CCGs have data on opioid prescribing from non-standard practices,')
 print('accounting for a maximum of ',c2["ome_percent_nongp"].max().round(3), '% of CCG opioid prescribing')
@@ -1194,8 +681,110 @@ order by chem_substance, dose_per_unit desc
     '''
 
 
-tbl = bq.cached_read(q, csv_path='opioids_high_dose_formulations.csv')
+tbl = cached_read(q, csv_path='opioids_high_dose_formulations.csv')
 tbl.head()
 # -
 
+# ### OME conversion by BNF code
+#
+# The converter is loaded once and indexed by BNF code, so OME can be recalculated locally from quantities, and with other multipliers, without a new extract (see `ome.py`)
+
+# +
+from ome import converter_sql, index_converter
+
+converter_table = cached_read(converter_sql, csv_path='opioid_converter.csv')
+converter = index_converter(converter_table)
+print(len(converter.codes), "BNF codes in the converter,", int(converter.is_high_la.sum()), "high dose")
+# -
+
+# ## Sensitivity analysis
+#
+# The summary tables and CCG measures with high dose defined at other daily OME thresholds, and with other OME multipliers, recalculated from one extract of practice prescribing by BNF code
+#
+# The extract of `q6` is exported from BigQuery as the practice-level extract of `q` is: save the query result to a table, export the table to Cloud Storage as gzipped CSV with a `bnf_opioid_*.csv.gz` wildcard URI, and download the shards to this directory. With `OPIOIDS_LOCAL_DATA` set the shards are written locally instead (see `localsql.py`). Without either this section is skipped, and nothing after it depends on it.
+
+# +
+q6 = '''
+-- opioids by BNF code - including practices open/prescribing but not prescribing opioids
+WITH opioid_prescribing AS (
+select p.*
+FROM ebmdatalab.hscic.normalised_prescribing_standard p
+INNER JOIN (SELECT DISTINCT bnf_code FROM `richard.opioid_converter`) o
+ON p.bnf_code = o.bnf_code
+),
+
+-- create a table of all prescribing by practice by month.
+A AS (
+  SELECT practice, pct,
+    CAST(month AS DATE) AS year_mon,
+    sum(items) AS items
+  FROM ebmdatalab.hscic.normalised_prescribing_standard p
+  GROUP BY  practice, pct, year_mon),
+
+-- inner join to practice list to filter for type 4 practices, and for months they had more than zero patients and more than zero total prescribing. 
+q2 AS (
+  SELECT a.practice, 
+    a.pct,
+    prac.status_code,
+    a.year_mon, 
+    MAX(a.items) AS items, 
+    MAX(total_list_size) AS total_list_size
+  FROM ebmdatalab.hscic.practice_statistics_all_years s
+  LEFT JOIN A ON  a.practice = s.practice AND a.year_mon = CAST(s.month AS DATE)  
+  INNER JOIN  ebmdatalab.hscic.practices prac ON prac.code=a.practice AND prac.setting = 4 
+  WHERE total_list_size > 0 and items > 0
+  GROUP BY practice, pct, status_code, year_mon )
+
+-- join practices to opioid prescribing data, by BNF code
+SELECT 
+  COALESCE(p.pct,q2.pct) AS pct,
+  q2.practice,
+  q2.status_code,
+  q2.year_mon AS month,
+  p.bnf_code,
+  sum(p.items) as items, 
+  sum(quantity) as quantity,
+  sum(net_cost) as net_cost,
+  sum(actual_cost) as actual_cost
+FROM q2 
+LEFT JOIN opioid_prescribing p ON p.practice = q2.practice AND CAST(p.month AS DATE) = q2.year_mon  
+GROUP BY 
+  pct,
+  practice,
+  status_code,
+  month,
+  bnf_code
+'''
+
+import localsql
+from sensitivity import by_bnf_code, sensitivity
+
+sens_summary = None
+if glob.glob("bnf_opioid*gz") or localsql.data_directory:
+    # the extract is summed by CCG, status, month and BNF code once; every grid point is converted from those sums
+    rx = cached_shards(q6, "bnf_opioid*gz", name="opioid_bnf_practice")
+    rows = by_bnf_code(rx)
+    multiplier_sets = {
+        "converter": None,
+        "tramadol 0.2": pd.Series({"Tramadol Hydrochloride": 0.2}).rename_axis("chem_substance"),
+    }
+    sens = sensitivity(rows, converter_table, ccg_pop, thresholds=(None, 90, 120), multiplier_sets=multiplier_sets)
+
+    # national percent high dose, and the range across CCGs, at each grid point
+    sens_summary = pd.concat({
+        "% high dose OME (national)": sens.by_year[("OME", "% High Dose")].groupby(level=[0, 1], sort=False).last(),
+        "% high dose OME (CCG min)": sens.ccg["Percent high dose (by OME)"].groupby(level=[0, 1], sort=False).min(),
+        "% high dose OME (CCG max)": sens.ccg["Percent high dose (by OME)"].groupby(level=[0, 1], sort=False).max(),
+    }, axis=1)
+else:
+    print("no bnf_opioid*gz shards: skipping the sensitivity analysis")
+sens_summary
+# -
+
+# ## Save data for rendering the figures
+#
+# `python render.py` then draws every figure in parallel and saves them as PDF and PNG in `figures/`
 
+from render import save_figure_data
+save_figure_data(agg=agg, dec=dec, spending2=spending2, change2=change2,
+                 change_window=change_window, change2_2018=change2_2018)
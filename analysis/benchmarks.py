@@ -0,0 +1,473 @@
+"""Timings for the faster analysis steps against the code they replace.
+
+Run from this directory, where the extracts are cached:
+
+    python benchmarks.py [name ...]
+
+With no names every benchmark is run. Each one checks that the old and new
+code give the same answer before reporting the timings.
+"""
+import glob
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    "Register a benchmark under its function name"
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def timed(func, *args, **kwargs):
+    "Call `func`, returning its result and the wall time taken"
+    start = time.time()
+    result = func(*args, **kwargs)
+    return result, time.time() - start
+
+
+def report(name, old, new):
+    print("{}: old {:.2f}s, new {:.2f}s ({:.1f}x)".format(name, old, new, old / new))
+
+
+@benchmark
+def boolean_flags():
+    "Per-cell `as_true_false` converter vs `as_boolean` on the opioid*gz shards"
+    from loading import as_boolean, as_true_false, boolean_columns, schema
+
+    converters = {col: as_true_false for col in boolean_columns}
+    dtype = {col: t for col, t in schema.items() if col not in converters}
+    old_time = new_time = 0
+    for path in sorted(glob.glob("opioid*gz")):
+        old, elapsed = timed(
+            pd.read_csv, path, dtype=dtype, converters=converters, low_memory=False
+        )
+        old_time += elapsed
+        new, elapsed = timed(pd.read_csv, path, dtype=schema, low_memory=False)
+        for col in boolean_columns:
+            flags, extra = timed(as_boolean, new[col])
+            new[col] = flags
+            elapsed += extra
+        new_time += elapsed
+        for col in boolean_columns:
+            expected = old[col].astype("boolean")
+            pd.testing.assert_series_equal(new[col], expected)
+    report("load with boolean flags", old_time, new_time)
+
+
+def _summary_tables_by_cell(dfl):
+    "The three summary table cells as they were, one groupby per table"
+    columns = {
+        "total_ome_per_1000": "OME per 1000",
+        "items_per_1000": "Items per 1000",
+        "cost_per_1000": "Cost per 1000",
+    }
+    tables = []
+    for key in ["year", "chem_substance"]:
+        tab = dfl.copy().fillna(0)
+        for col, measure in columns.items():
+            tab.loc[tab["Is_High_LA"] == "High dose", measure + "_High Dose"] = tab[col]
+            tab.loc[tab["Is_LA"] == True, measure + "_Long Acting"] = tab[col]  # noqa: E712
+        tab = tab.fillna(0)
+        tab = tab.groupby([key]).sum(numeric_only=True)
+        tab = tab.drop([c for c in ["year", "Is_LA", "quantity_per_1000"] if c in tab], axis=1)
+        tab = tab.rename(columns={col: measure + "_Total" for col, measure in columns.items()})
+        for measure in columns.values():
+            tab[measure + "_% High Dose"] = (
+                100 * tab[measure + "_High Dose"] / tab[measure + "_Long Acting"]
+            )
+        tab.columns = tab.columns.str.split("_", expand=True)
+        tables.append(tab.sort_index(axis=1, ascending=False))
+    tab = dfl.fillna(0)
+    tab.loc[tab["Is_High_LA"] == "High dose", "OME per 1000_High Dose"] = tab["total_ome_per_1000"]
+    tab.loc[tab["Is_LA"] == True, "OME per 1000_Long Acting"] = tab["total_ome_per_1000"]  # noqa: E712
+    grp = tab.loc[tab["year"] == 2017]
+    grp = grp[["chem_substance", "OME per 1000_Long Acting"]].groupby(["chem_substance"]).sum()
+    grp = grp.fillna(0).sort_values(by="OME per 1000_Long Acting", ascending=False).reset_index()
+    grp["chemical"] = np.where(grp.index > 5, "Other", grp.chem_substance)
+    tab2 = tab.merge(grp.drop(["OME per 1000_Long Acting"], axis=1), on="chem_substance")
+    tab2 = tab2[["year", "chemical", "total_ome_per_1000", "OME per 1000_Long Acting",
+                 "OME per 1000_High Dose"]].fillna(0)
+    tab2 = tab2.groupby(["year", "chemical"]).sum().rename(columns={"total_ome_per_1000": "OME per 1000_Total"})
+    tab2.columns = tab2.columns.str.split("_", expand=True)
+    tables.append(tab2)
+    return tables
+
+
+@benchmark
+def summary_tables():
+    "Three summary table cells vs one aggregation rolled up three ways"
+    from summary import aggregate, rollup, top_chemicals
+
+    dfl = pd.read_csv("chemical_summary.zip").fillna(0)
+    dfl["Is_High_LA"] = np.where(dfl["Is_High_LA"] == "TRUE", "High dose", "Others")
+
+    def by_rollup():
+        base = aggregate(dfl, ["year", "chem_substance"])
+        chemical = {"chemical": ("chem_substance", top_chemicals(base, 2017, 6))}
+        return [
+            rollup(base, ["year"]),
+            rollup(base, ["chem_substance"]),
+            rollup(base, ["year", "chemical"], derived=chemical),
+        ]
+
+    repeat = 20
+    old, old_time = timed(lambda: [_summary_tables_by_cell(dfl) for _ in range(repeat)])
+    new, new_time = timed(lambda: [by_rollup() for _ in range(repeat)])
+    for before, after in zip(old[0], new[0]):
+        # the table by chemical has only the OME columns
+        pd.testing.assert_frame_equal(
+            before, after[before.columns], check_dtype=False, check_names=False, check_like=True
+        )
+    report("summary tables (x{})".format(repeat), old_time, new_time)
+
+
+def _practice_measures():
+    "Practice measures for the full history in the opioid*gz shards"
+    from loading import read_shards
+    from measures import practice_measures
+
+    df1 = read_shards("opioid*gz", verbose=False)
+    pop = pd.read_csv("practice_list_size.zip")
+    pop["month"] = pd.to_datetime(pop["month"])
+    return practice_measures(df1, pop)
+
+
+@benchmark
+def deciles():
+    "groupby(month).quantile over all columns plus a scan per line vs `deciles`"
+    from deciles import deciles
+    from figures import decile_panels
+
+    df2 = _practice_measures()
+    measures = [panel[0] for panel in decile_panels]
+
+    def by_groupby():
+        pc = df2.groupby("month").quantile(np.arange(0.1, 1, 0.1), numeric_only=True)
+        pc = pd.DataFrame(pc.stack()).reset_index()
+        pc = pc.rename(columns={"level_1": "percentile", "level_2": "measure", 0: "value"})
+        pc["index"] = (pc.percentile * 10).map(int)
+        lines = {}
+        for measure in measures:
+            for decile in range(1, 10):
+                data = pc.loc[(pc["measure"] == measure) & (pc["index"] == decile)]
+                lines[(measure, decile)] = data["value"].to_numpy()
+        return lines
+
+    def by_sorting():
+        dec = deciles(df2, measures)
+        return {
+            (measure, j + 1): dec.values[:, i, j]
+            for i, measure in enumerate(measures)
+            for j in range(len(dec.percentiles))
+        }
+
+    old, old_time = timed(by_groupby)
+    new, new_time = timed(by_sorting)
+    for key, values in old.items():
+        np.testing.assert_allclose(values, new[key])
+    report("practice deciles for {:,} rows".format(len(df2)), old_time, new_time)
+
+
+@benchmark
+def list_size_join():
+    "Merge with the list size table vs a gather from `index_list_sizes`"
+    from listsizes import index_list_sizes, join_list_sizes
+    from loading import read_shards
+
+    df1 = read_shards("opioid*gz", verbose=False)
+    pop = pd.read_csv("practice_list_size.zip")
+    pop["month"] = pd.to_datetime(pop["month"])
+
+    old, old_time = timed(
+        df1.merge, pop[["practice", "month", "total_list_size"]], on=["practice", "month"]
+    )
+    index, index_time = timed(index_list_sizes, pop)
+    new, new_time = timed(join_list_sizes, df1, index)
+    pd.testing.assert_frame_equal(old, new, check_categorical=False, check_dtype=False)
+    report("list sizes for {:,} rows".format(len(df1)), old_time, new_time)
+    print("  (building the index: {:.2f}s, once per session)".format(index_time))
+
+
+@benchmark
+def savings():
+    "Stacked merges with the lowest decile, one per scenario, vs `savings.savings`"
+    from savings import savings, scenarios, totals
+
+    df2 = _practice_measures()
+
+    def by_merge():
+        pc = df2.groupby("month").quantile(np.arange(0.1, 1, 0.1), numeric_only=True)
+        pc = pd.DataFrame(pc.stack()).reset_index()
+        pc = pc.rename(columns={"level_1": "percentile", "level_2": "measure", 0: "value"})
+        lowest = pc[["month", "measure", "value"]].loc[
+            (pc["month"] > pc["month"].max() - pd.DateOffset(months=6)) & (pc["percentile"] == 0.1)
+        ].fillna(0)
+        lowest["measure"] = lowest["measure"].replace({
+            "High dose items (per 1000)": "high dose items",
+            "Cost high dose opioids (per 1000)": "high dose cost",
+            "Cost high dose opioids (per item)": "high dose costperitem",
+        })
+        columns = ["practice", "month", "total_list_size", "Items High Dose", "Cost High Dose"]
+        dfs = df2[columns].set_index(columns[:3]).stack().rename("actual_value").reset_index()
+        dfs["measure"] = dfs["level_3"].map({"Items High Dose": "high dose items", "Cost High Dose": "high dose cost"})
+        result = dfs.merge(lowest, on=["month", "measure"])
+        result["potential_saving"] = result["actual_value"] - result["total_list_size"]*result["value"]/1000
+        result = result.fillna(0)
+        result.loc[result["potential_saving"] < 0, "potential_saving"] = 0
+        totals = result.groupby("measure")[["actual_value", "potential_saving"]].sum()
+        per_item = df2[["month", "Items High Dose", "Cost High Dose"]].merge(
+            lowest.loc[lowest["measure"] == "high dose costperitem"], on="month"
+        )
+        per_item["potential_saving"] = per_item["Cost High Dose"] - per_item["Items High Dose"]*per_item["value"]
+        per_item = per_item.fillna(0)
+        per_item.loc[per_item["potential_saving"] < 0, "potential_saving"] = 0
+        totals.loc["high dose cost at cost per item"] = [per_item["Cost High Dose"].sum(), per_item["potential_saving"].sum()]
+        return totals
+
+    old, old_time = timed(by_merge)
+    new, new_time = timed(lambda: totals(savings(df2, scenarios)))
+    pd.testing.assert_frame_equal(old.sort_index(), new.sort_index(), check_names=False)
+    report("savings for {} scenarios".format(len(scenarios)), old_time, new_time)
+
+
+@benchmark
+def bootstrap_estimates():
+    "The CCG, change and savings tables vs the bootstrap's point estimates of them"
+    from bootstrap import estimates, fold_measures, prepare
+    from change import changes, monthly_ome, ome_per_1000, pair
+    from cube import build_cube, build_list_sizes, ccg_measures_at, rolling_ccg_sums
+    from loading import read_shards
+    from measures import practice_measures
+    from savings import savings, scenarios, totals
+
+    df1 = read_shards("opioid*gz", verbose=False)
+    pop = pd.read_csv("practice_list_size.zip")
+    pop["month"] = pd.to_datetime(pop["month"])
+    df2 = practice_measures(df1, pop)
+    cube = build_cube(df1)
+    ccg_pop = build_list_sizes(df1, pop)
+    years = (2016, 2017)
+
+    def by_tables():
+        df4 = ccg_measures_at(rolling_ccg_sums(cube, ccg_pop), months=6)[list(fold_measures)]
+        df4 = df4.replace([np.inf, -np.inf], np.nan)  # as the bootstrap leaves them out
+        change = pair(changes(ome_per_1000(monthly_ome(cube, ccg_pop))), *years)["change"]
+        return {
+            "fold-difference": df4.max() / df4.min(),
+            "change": change.replace([np.inf, -np.inf], np.nan),
+            "saving": totals(savings(df2, scenarios))["potential_saving"],
+        }
+
+    tables, old_time = timed(by_tables)
+    point, new_time = timed(lambda: estimates(prepare(df1, df2, ccg_pop, years=years)))
+    for name, table in tables.items():
+        np.testing.assert_allclose(point[name][table.index].astype("float64"), table, rtol=1e-5)
+    np.testing.assert_allclose(point[("change", "mean")], tables["change"].mean(), rtol=1e-5)
+    report("tables vs bootstrap point estimates", old_time, new_time)
+
+
+@benchmark
+def formulations():
+    "The formulation CASE evaluated on every row vs `classify` once per drug name"
+    from formulations import classify, form, rules
+
+    names = pd.read_csv("opioids_high_dose_formulations.csv")["drug_name"]
+    names = names.sample(1000000, replace=True, random_state=2018).reset_index(drop=True)
+
+    def by_row():
+        mid = names.str.extract(form.pattern, expand=False).str.rstrip()
+        conditions = []
+        for _, values, likes in rules:
+            matched = mid.isin(values)
+            for like in likes:
+                text = like.strip("%")
+                matched |= mid.str.endswith(text) if like.startswith("%") and not like.endswith("%") else mid.str.contains(text, regex=False)
+            conditions.append(matched.fillna(False).to_numpy())
+        result = np.select(conditions, [formulation for formulation, _, _ in rules], None)
+        return pd.Series(np.where(result == None, mid, result), name="formulation")  # noqa: E711
+
+    old, old_time = timed(by_row)
+    new, new_time = timed(classify, names)
+    pd.testing.assert_series_equal(old.fillna(np.nan), new.fillna(np.nan))
+    report("formulation of {:,} rows".format(len(names)), old_time, new_time)
+
+
+@benchmark
+def ome_conversion():
+    "Merge with opioid_converter and multiply vs `ome.convert` by indexed gather"
+    from ome import convert, index_converter
+
+    converter = pd.read_csv("opioid_converter.csv")
+    rng = np.random.default_rng(2018)
+    rx = pd.DataFrame({
+        "bnf_code": converter["bnf_code"].sample(5000000, replace=True, random_state=2018).to_numpy(),
+        "quantity": rng.integers(1, 200, 5000000),
+    })
+
+    def by_merge():
+        columns = ["bnf_code", "chem_substance", "Is_High_LA", "Is_LA", "dose_per_unit", "new_ome_multiplier"]
+        df = rx.merge(converter[columns].drop_duplicates(), on="bnf_code", how="left")
+        return df["quantity"] * df["dose_per_unit"] * df["new_ome_multiplier"]
+
+    old, old_time = timed(by_merge)
+    new, new_time = timed(lambda: convert(rx, index_converter(converter))["total_ome"])
+    np.testing.assert_allclose(old.to_numpy(), new.to_numpy())
+    report("OME of {:,} rows".format(len(rx)), old_time, new_time)
+
+
+@benchmark
+def ccg_boundaries():
+    "`gpd.read_file` in each of the three map cells vs `geometry.boundaries` cached"
+    import geopandas as gpd
+    import shapely
+
+    import geometry
+
+    def by_read_file():
+        ccgs = gpd.read_file("ccgs.json").set_index("name")
+        return ccgs[~ccgs["geometry"].isnull()]
+
+    geometry.boundary_table()  # the cache is written once, as by the first notebook run
+    old, old_time = timed(lambda: [by_read_file() for _ in range(3)])
+    new, new_time = timed(lambda: [geometry.boundaries(0) for _ in range(3)])
+    pd.testing.assert_index_equal(old[0].index, new[0].index)
+    assert shapely.equals_exact(np.asarray(old[0].geometry), np.asarray(new[0].geometry), 0).all()
+    report("CCG boundaries for 3 maps", old_time, new_time)
+
+
+@benchmark
+def maps():
+    "`GeoDataFrame.plot` per panel vs `choropleth` panels sharing one set of paths"
+    import io
+    import pickle
+
+    import matplotlib
+    import shapely
+
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    from matplotlib.collections import PathCollection
+
+    import figures
+    from choropleth import ccg_shapes, plot_choropleths
+    from geometry import boundaries, join
+
+    with open("figure_data.pickle", "rb") as f:
+        data = pickle.load(f)
+    specs = [
+        (figures.map_figures["maps"], data["spending2"]),
+        (figures.map_figures["share_maps"], data["spending2"]),
+        (figures.map_figures["change_map"], data["change2"]),
+    ]
+
+    def by_geopandas():
+        colours = []
+        for spec, table in specs:
+            gdf = join(table)
+            measures = [panel["measure"] for panel in spec["panels"]]
+            vmax = gdf[measures].max().max() * 1.05
+            vmax, vmin = (-gdf["change"].min(), gdf["change"].min()) if measures == ["change"] else (vmax, 0)
+            fig, axes = plt.subplots(1, len(measures), figsize=spec["figsize"], squeeze=False)
+            for ax, measure in zip(axes[0], measures):
+                shared = {"vmin": vmin, "vmax": vmax} if "group" in spec["panels"][0] or measure == "change" else {}
+                gdf.plot(ax=ax, column=measure, edgecolor="black", linewidth=0.1, legend=True, cmap=spec.get("cmap", "OrRd"), **shared)
+            fig.savefig(io.BytesIO(), dpi=100)
+            colours.append([ax.collections[0].get_facecolors() for ax in axes[0]])
+            plt.close(fig)
+        return colours
+
+    def by_choropleth():
+        shapes = ccg_shapes()
+        colours = []
+        for spec, table in specs:
+            fig = plot_choropleths(table, spec, shapes)
+            fig.savefig(io.BytesIO(), dpi=100)
+            maps = [c for ax in fig.axes for c in ax.collections if isinstance(c, PathCollection)]
+            # geopandas draws each part of a multipolygon as a patch
+            parts = shapely.get_num_geometries(np.asarray(boundaries().geometry))
+            panels = []
+            for collection, panel in zip(maps, spec["panels"]):
+                shown = table[panel["measure"]].reindex(shapes.names).notnull().to_numpy()
+                panels.append(np.repeat(collection.get_facecolors()[shown], parts[shown], axis=0))
+            colours.append(panels)
+            plt.close(fig)
+        return colours
+
+    old, old_time = timed(by_geopandas)
+    new, new_time = timed(by_choropleth)
+    for old_panels, new_panels in zip(old, new):
+        for a, b in zip(old_panels, new_panels):
+            np.testing.assert_allclose(a, b, atol=1e-6)
+    report("map figures (a)-(g) and change", old_time, new_time)
+
+
+@benchmark
+def ccg_changes():
+    "The change cells' regrouping of practice rows, once per pair of years, vs `change.changes` of the cube"
+    from change import changes, monthly_ome, ome_per_1000
+    from cube import build_cube, build_list_sizes
+    from loading import read_shards
+
+    df1 = read_shards("opioid*gz", verbose=False)
+    pop = pd.read_csv("practice_list_size.zip")
+    pop["month"] = pd.to_datetime(pop["month"])
+    years = sorted(df1["month"].dt.year.unique())[:-1]  # the last a part year
+    pairs = [(a, b) for i, a in enumerate(years) for b in years[i + 1:]]
+    cube, list_sizes = build_cube(df1), build_list_sizes(df1, pop)
+
+    def by_regrouping():
+        result = {}
+        for start, end in pairs:
+            yr1 = df1.loc[df1["pct"].str.match(r"([0-9]{2})([A-Za-z])") & (df1["month"].dt.year >= start)].reset_index()
+            yr1["year"] = yr1["month"].dt.year
+            yr2 = yr1[["pct", "practice", "month", "year", "total_ome"]].groupby(
+                ["pct", "practice", "month", "year"], observed=True)["total_ome"].sum()
+            yr2 = yr2.reset_index().merge(pop[["practice", "month", "total_list_size"]], on=["practice", "month"])
+            yr2 = yr2.groupby(["pct", "month", "year"], observed=True)[["total_ome", "total_list_size"]].sum()
+            yr2 = yr2.reset_index().groupby(["pct", "year"], observed=True).agg({"total_list_size": "mean", "total_ome": "sum"})
+            per_1000 = (1000*yr2["total_ome"]/yr2["total_list_size"]).unstack()
+            result[(start, end)] = per_1000[end] - per_1000[start]
+        return pd.DataFrame(result)
+
+    old, old_time = timed(by_regrouping)
+    new, new_time = timed(lambda: changes(ome_per_1000(monthly_ome(cube, list_sizes))).change)
+    old.index = old.index.astype(str)
+    # OME is float32 in the cube: to within 0.1 OME per 1000, of tens of thousands
+    np.testing.assert_allclose(old.to_numpy(), new.reindex(index=old.index, columns=old.columns).to_numpy(), atol=0.1)
+    report("change by CCG for {} pairs of years (new from the cached cube)".format(len(pairs)), old_time, new_time)
+
+
+@benchmark
+def ccg_restate():
+    "Merge of the practice rows with the crosswalk vs `crosswalk.restate` by category"
+    from crosswalk import crosswalk, read_successors, restate
+    from loading import read_shards
+    from orgs import mask
+
+    df1 = read_shards("opioid*gz", verbose=False)
+    pop = pd.read_csv("practice_list_size.zip")
+    pop["month"] = pd.to_datetime(pop["month"])
+    walk = crosswalk(pop, read_successors())
+
+    def by_merge():
+        practices = walk.practices.rename("vintage_pct").rename_axis("practice").reset_index()
+        merged = df1.assign(practice=df1["practice"].astype(str)).merge(practices, on="practice", how="left")
+        own = merged["pct"].astype(str)
+        carried = own.map(walk.codes).fillna(own)
+        return merged["vintage_pct"].where(mask(merged, "standard_ccg") & merged["vintage_pct"].notnull(), carried)
+
+    old, old_time = timed(by_merge)
+    new, new_time = timed(restate, df1, walk)
+    np.testing.assert_array_equal(old.to_numpy(dtype=object), new["pct"].astype(object).to_numpy())
+    report("CCGs restated for {:,} rows".format(len(df1)), old_time, new_time)
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -0,0 +1,370 @@
+"""Bootstrap confidence intervals for the savings, CCG variation and change.
+
+Each resample draws, within each CCG, as many practices as the CCG has,
+with replacement, and recomputes from the practice rows:
+
+    saving            total potential saving of each savings scenario
+    fold-difference   max / min across CCGs of each CCG measure (`fold_measures`)
+    change            change in OME per 1000 of each CCG between two years,
+                      and its mean across CCGs
+
+A practice is drawn within the CCG of its rows' `pct`, as the tables sum
+it; a practice that moved CCG is drawn in each CCG it prescribed under,
+with its rows there. The CCG sums are of the rows of `df1`, as in the CCG
+cube, and the list sizes are those of `cube.build_list_sizes`. A CCG's
+list size over the map window is shared between its practices by their
+own list sizes, so that with every practice drawn once the statistics are
+those of the tables (see `estimates`).
+
+A resample is a vector of how many times each practice is drawn. The CCG
+sums of a batch of resamples are one matrix product of those counts with
+the practice sums. The savings targets are percentiles of the practice
+rows weighted by those counts, read for the whole batch from one sort of
+the rows. Batches run in a process pool, each with its own child of one
+`SeedSequence`, so the results depend on the seed and the batch size but
+not on the number of processes:
+
+    result = bootstrap(df1, df2, ccg_pop, resamples=2000, seed=2018)
+    intervals(result)
+
+`cached_bootstrap` keeps the resamples with the other cached tables, so
+the notebook draws them again only when its inputs or arguments change.
+"""
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from compact import decode
+from measures import add_flag_columns, high_dose_shares
+from orgs import evaluate, mask, rules
+from rolling import cumulate, in_window, window_means
+from savings import scenarios, target_groups
+
+Bootstrap = namedtuple("Bootstrap", ["point", "samples"])
+
+# practice sums from which the CCG measures are calculated
+components = [
+    "Total Items", "Total OME", "Total Cost", "Items High Dose", "Items Long Acting",
+    "OME High Dose", "OME Long Acting",
+] + list(high_dose_shares.values())
+
+# CCG measures whose fold-difference (max / min across CCGs) is bootstrapped
+fold_measures = {
+    "Total items (per 1000)": lambda s: 1000*s["Total Items"]/s["list size"],
+    "Total OME (per 1000)": lambda s: 1000*s["Total OME"]/s["list size"],
+    "High dose items (per 1000)": lambda s: 1000*s["Items High Dose"]/s["list size"],
+    "Percent high dose (by items)": lambda s: 100*s["Items High Dose"]/s["Items Long Acting"],
+    "Percent high dose (by OME)": lambda s: 100*s["OME High Dose"]/s["OME Long Acting"],
+    "Total cost (per 1000)": lambda s: 1000*s["Total Cost"]/s["list size"],
+}
+fold_measures.update({
+    share: (lambda share: lambda s: 100*s[share]/s["OME High Dose"])(share)
+    for share in high_dose_shares.values()
+})
+
+# resample x row cells the savings hold at once
+chunk_cells = 2**22
+
+
+def _categories(col):
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        return col.cat.categories
+    return pd.Index(pd.unique(col.dropna()))
+
+
+def _codes(col, categories):
+    "Position of each of `col` in `categories`, -1 where it is missing"
+    return np.asarray(pd.Categorical(col, categories=categories).codes, dtype="int64")
+
+
+def _unit_keys(df, practices, ccgs):
+    "Key of the practice and the CCG (0 where missing) of each row of `df`"
+    return _codes(df["practice"], practices) * (len(ccgs) + 1) + _codes(df["pct"], ccgs) + 1
+
+
+def _ccg_months(pct, month, ccgs):
+    "Key of the CCG (0 where missing) and the month of each row"
+    month = pd.Series(month)
+    return (_codes(pct, ccgs) + 1) * 100000 + (month.dt.year * 12 + month.dt.month).to_numpy()
+
+
+def _practice_sums(rows, practice, n_practices, columns):
+    return np.stack([
+        np.bincount(practice, weights=rows[col].to_numpy(dtype="float64", na_value=0), minlength=n_practices)
+        for col in columns
+    ], axis=1)
+
+
+def _list_sizes(df, unit, n_units):
+    "Sum over each unit's months of its list size, once a month"
+    months = df[["month", "total_list_size"]].assign(unit=unit).drop_duplicates(["unit", "month"])
+    return np.bincount(months["unit"], weights=months["total_list_size"].to_numpy(dtype="float64", na_value=0), minlength=n_units)
+
+
+def prepare(df1, df2, list_sizes, months=6, end=None, years=(2016, 2017), scenarios=scenarios):
+    """Practice sums and rows needed for each resample.
+
+    `df1` is the practice-level data, `df2` its practice measures and
+    `list_sizes` the CCG list sizes of `cube.build_list_sizes`. The CCG
+    measures are for active practices with standard CCG codes over the
+    `months` months up to `end`, as the maps; the change is between the
+    two `years`, for practices with standard CCG codes, as
+    `change.ome_per_1000`; the savings are over the same months, as
+    `savings.savings`.
+    """
+    practices, ccgs = _categories(df1["practice"]), _categories(df1["pct"])
+    unit, keys = pd.factorize(_unit_keys(df1, practices, ccgs), sort=True)
+    keys = pd.Index(keys)
+    unit2 = keys.get_indexer(_unit_keys(df2, practices, ccgs))
+    if (unit2 < 0).any():
+        raise ValueError("df2 has practices and CCGs that aren't in df1")
+    labels = pd.Index([np.nan] + list(ccgs), dtype=object)  # 0 for rows without a CCG
+    ccg = keys.to_numpy() % (len(ccgs) + 1)
+    n = len(keys)
+
+    # CCG measures: sums of active practices over the window, as the maps;
+    # each CCG's mean list size over the window, of closed and dormant
+    # practices too, is shared between its practices by their list sizes
+    standard = mask(df1, "standard_ccg")
+    active = standard & mask(df1, "active")
+    last = end if end is not None else df1.loc[active, "month"].max()
+    window = np.asarray(in_window(df1["month"], months, last))
+    rows = add_flag_columns(decode(df1.loc[window & active])).rename(columns={
+        "total_ome": "Total OME", "items": "Total Items", "actual_cost": "Total Cost",
+    })
+    high = (rows["Is_High_LA"] == True).fillna(False).to_numpy()  # noqa: E712
+    for chem, share in high_dose_shares.items():
+        rows[share] = np.where((rows["chem_substance"] == chem).to_numpy() & high, rows["Total OME"], 0)
+    rows["rows"] = 1
+    sums = _practice_sums(rows, unit[window & active], n, components + ["rows"])
+
+    sizes = cumulate(list_sizes.dropna(subset=["total_list_size"]), ["pct"], ["total_list_size"])
+    ccg_size = window_means(sizes, months, last)["total_list_size"].reindex(labels).to_numpy()
+    in_window2 = np.asarray(in_window(df2["month"], months, last))
+    own = _list_sizes(df2.loc[in_window2], unit2[in_window2], n)
+    ccg_own = np.bincount(ccg, weights=own, minlength=len(labels))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        share = np.where(ccg_own[ccg] > 0, own / ccg_own[ccg], 1 / np.bincount(ccg, minlength=len(labels))[ccg])
+    sums = np.column_stack([sums, np.nan_to_num(ccg_size[ccg] * share)])
+
+    # change: OME of each practice in each year, in the months its CCG has a
+    # list size, the prescribing list size of each practice month, and the
+    # number of months each CCG has both
+    listed = np.isin(_ccg_months(df1["pct"], df1["month"], ccgs), _ccg_months(list_sizes["pct"], list_sizes["month"], ccgs))
+    year, year2 = df1["month"].dt.year.to_numpy(), df2["month"].dt.year.to_numpy()
+    standard2 = mask(df2, "standard_ccg")
+    change, month_counts = [], []
+    for y in years:
+        in_year = standard & listed & (year == y)
+        in_year2 = standard2 & (year2 == y)
+        change.append(np.column_stack([
+            np.bincount(unit[in_year], weights=df1.loc[in_year, "total_ome"].to_numpy(dtype="float64", na_value=0), minlength=n),
+            _list_sizes(df2.loc[in_year2], unit2[in_year2], n),
+        ]))
+        cells = np.unique(_ccg_months(df1.loc[in_year, "pct"], df1.loc[in_year, "month"], ccgs))
+        month_counts.append(np.bincount(cells // 100000, minlength=len(labels)))
+
+    # savings: the rows in the window and, for each scenario, the rows with
+    # a rate sorted by the group its percentile is taken in and then by rate
+    in_savings = np.asarray(in_window(df2["month"], months, end))
+    rows = df2.loc[in_savings]
+    specs = list(scenarios.values())
+    targets = []
+    for spec in specs:
+        group = pd.factorize(target_groups(rows, spec.get("within"), rows["pct"].to_numpy(dtype=object)), sort=True)[0]
+        rate = rows[spec["rate"]].to_numpy(dtype="float64", na_value=np.nan)
+        present = np.flatnonzero(~np.isnan(rate))
+        order = present[np.lexsort((rate[present], group[present]))]
+        targets.append({
+            "group": group,
+            "bounds": np.searchsorted(group[order], np.arange(group.max() + 2)),
+            "order": order,
+            "rate": rate[order],
+            "percentile": spec["percentile"],
+        })
+
+    return {
+        "ccg": ccg,
+        "ccgs": labels,
+        "standard": evaluate(pd.Series(labels), rules["standard_ccg"][1]),
+        "has_list_size": ~np.isnan(ccg_size),
+        "sums": sums,
+        "change": np.stack(change, axis=1),
+        "month_counts": np.stack(month_counts, axis=1),
+        "years": years,
+        "savings": {
+            "unit": unit2[in_savings],
+            "actual": np.stack([rows[spec["actual"]].to_numpy(dtype="float64", na_value=np.nan) for spec in specs]),
+            "basis": np.stack([
+                rows[spec["basis"][0]].to_numpy(dtype="float64", na_value=np.nan) / spec["basis"][1] for spec in specs
+            ]),
+            "targets": targets,
+        },
+        "scenarios": scenarios,
+    }
+
+
+def draw(rng, ccg, n):
+    "`n` resamples of practices within their CCGs, as (resample x practice) counts"
+    order = np.argsort(ccg, kind="stable")
+    sizes = np.bincount(ccg)
+    starts = np.concatenate([[0], np.cumsum(sizes)[:-1]])
+    slot_ccg = ccg[order]
+    picks = starts[slot_ccg] + np.floor(rng.random((n, len(ccg))) * sizes[slot_ccg]).astype("int64")
+    cells = (np.arange(n)[:, None] * len(ccg) + order[picks]).ravel()
+    return np.bincount(cells, minlength=n * len(ccg)).reshape(n, len(ccg))
+
+
+def _ccg_sums(data, weights, values):
+    "(resample x CCG x value) sums of practice `values` weighted by `weights`"
+    onehot = np.zeros((len(data["ccg"]), len(data["ccgs"])))
+    onehot[np.arange(len(data["ccg"])), data["ccg"]] = 1
+    return np.stack([(weights * values[:, k]) @ onehot for k in range(values.shape[1])], axis=-1)
+
+
+def _percentiles(target, weights):
+    """(resample x group) percentile of the rate in each group, over the rows
+    repeated as many times as `weights` (resample x row), as `deciles.deciles`
+    would give for the repeated rows
+    """
+    n, rows = len(weights), len(target["order"])
+    if rows == 0:
+        return np.full((n, len(target["bounds"]) - 1), np.nan)
+    counts = np.zeros((n, rows + 1), dtype="int64")
+    np.cumsum(weights[:, target["order"]], axis=1, out=counts[:, 1:])
+    before = counts[:, target["bounds"][:-1]]
+    size = counts[:, target["bounds"][1:]] - before
+    position = (size - 1) * target["percentile"]
+    lower = np.floor(position).astype("int64")
+    upper = np.minimum(lower + 1, size - 1)
+    fraction = position - lower
+
+    # the sorted row holding each position of the repeated rows, for every
+    # resample at once: the cumulative counts of each resample are offset
+    # past those of the one before, so that all of them are one sorted array
+    offsets = np.arange(n)[:, None] * (counts[:, -1].max() + 1)
+    flat = (counts[:, 1:] + offsets).ravel()
+
+    def value(k):
+        found = np.searchsorted(flat, (before + np.maximum(k, 0) + offsets).ravel(), side="right")
+        return target["rate"][np.minimum(found - np.repeat(np.arange(n) * rows, size.shape[1]), rows - 1)].reshape(size.shape)
+
+    lo, hi = value(lower), value(upper)
+    result = np.where(fraction == 0, lo, lo + (hi - lo) * fraction)
+    result[size == 0] = np.nan
+    return result
+
+
+def _savings(data, weights):
+    "(resample x scenario) total potential saving of each scenario"
+    rows = data["savings"]
+    saved = np.zeros((len(weights), len(rows["targets"])))
+    step = max(1, chunk_cells // max(len(rows["unit"]), 1))
+    for start in range(0, len(weights), step):
+        counts = weights[start:start + step, rows["unit"]]
+        for i, target in enumerate(rows["targets"]):
+            rate = np.nan_to_num(_percentiles(target, counts))[:, target["group"]]
+            potential = np.nan_to_num(np.clip(rows["actual"][i] - rows["basis"][i] * rate, 0, None))
+            saved[start:start + step, i] = (counts * potential).sum(axis=1)
+    return saved
+
+
+def statistics(data, weights):
+    "(resample x statistic) frame of every statistic for each row of `weights`"
+    columns = {}
+
+    sums = _ccg_sums(data, weights, data["sums"])
+    named = {name: sums[..., k] for k, name in enumerate(components + ["rows", "list size"])}
+    absent = (named["rows"] == 0) | ~data["has_list_size"]  # CCGs not in the maps
+    with np.errstate(divide="ignore", invalid="ignore"):
+        for measure, calculate in fold_measures.items():
+            values = calculate(named)
+            values[~np.isfinite(values) | absent] = np.nan
+            columns[("fold-difference", measure)] = np.nanmax(values, axis=1) / np.nanmin(values, axis=1)
+
+        yearly = []
+        for i in range(len(data["years"])):
+            ome, list_size = np.moveaxis(_ccg_sums(data, weights, data["change"][:, i, :]), -1, 0)
+            yearly.append(1000*ome / (list_size / data["month_counts"][:, i]))
+        change = yearly[-1] - yearly[0]
+    change[~np.isfinite(change)] = np.nan
+    columns[("change", "mean")] = np.nanmean(change, axis=1)
+    for j in np.flatnonzero(data["standard"]):
+        columns[("change", data["ccgs"][j])] = change[:, j]
+
+    for name, saved in zip(data["scenarios"], _savings(data, weights).T):
+        columns[("saving", name)] = saved
+
+    return pd.DataFrame(columns)
+
+
+def estimates(data):
+    """Statistics with every practice drawn once, which are those of the
+    CCG tables, the change table and `savings.savings`
+    """
+    return statistics(data, np.ones((1, len(data["ccg"])), dtype="int64")).iloc[0]
+
+
+_data = None
+
+
+def _load(data):
+    global _data
+    _data = data
+
+
+def _batch(seed, size):
+    return statistics(_data, draw(np.random.default_rng(seed), _data["ccg"], size))
+
+
+def resample(data, resamples=1000, seed=2018, batch=50, processes=None):
+    "(resample x statistic) frame of `resamples` bootstrap resamples of `prepare`d `data`"
+    sizes = [min(batch, resamples - start) for start in range(0, resamples, batch)]
+    seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+    with ProcessPoolExecutor(processes, initializer=_load, initargs=(data,)) as pool:
+        return pd.concat(pool.map(_batch, seeds, sizes), ignore_index=True)
+
+
+def bootstrap(df1, df2, list_sizes, resamples=1000, seed=2018, batch=50, processes=None, **kwargs):
+    """Point estimates and `resamples` bootstrap resamples of the statistics.
+
+    Other arguments are passed to `prepare`.
+    """
+    data = prepare(df1, df2, list_sizes, **kwargs)
+    return Bootstrap(estimates(data), resample(data, resamples, seed, batch, processes))
+
+
+def cached_bootstrap(sql, sources, df1, df2, list_sizes, resamples=1000, seed=2018, batch=50, processes=None,
+                     **kwargs):
+    """`bootstrap`, with the resamples kept by `caching.cached_build` and
+    drawn again only when `sql`, the `sources` or the arguments change.
+    """
+    from caching import cached_build
+
+    data = prepare(df1, df2, list_sizes, **kwargs)
+    point = estimates(data)
+    arguments = sorted(dict(kwargs, resamples=resamples, seed=seed, batch=batch).items())
+    key = "{}\n-- bootstrap {!r}".format(sql, arguments)
+
+    def build():
+        # one row per resample and statistic, as Feather needs string column names
+        samples = resample(data, resamples, seed, batch, processes).rename_axis("resample")
+        samples = samples.melt(ignore_index=False).reset_index()
+        return samples.rename(columns={"variable_0": "kind", "variable_1": "statistic"})
+
+    samples = cached_build("bootstrap", key, sources, build)
+    samples = samples.pivot(index="resample", columns=["kind", "statistic"], values="value")
+    return Bootstrap(point, samples.reindex(columns=point.index).rename_axis(None))
+
+
+def intervals(result, level=0.95):
+    "Point estimate and percentile confidence interval of each statistic"
+    tail = (1 - level) / 2
+    # order statistics rather than interpolation, as some fold-differences are infinite
+    return pd.DataFrame({
+        "estimate": result.point,
+        "lower": result.samples.quantile(tail, interpolation="lower"),
+        "upper": result.samples.quantile(1 - tail, interpolation="higher"),
+    })
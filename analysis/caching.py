@@ -0,0 +1,93 @@
+"""Typed columnar copies of the BigQuery extracts cached as CSV.
+
+Each copy is a Feather file stored next to the CSV cache, named after a
+hash of the SQL text, the size and modification time of the source files
+and `schema_version`. Changing the query, refreshing the CSV or changing how
+columns are typed gives a new name, so a stale copy is never read; it is
+deleted when the new copy is written. Results with no source files aren't
+cached, as nothing would tell when they went stale.
+
+If OPIOIDS_LOCAL_DATA is set, missing extracts are rebuilt by running the
+query locally (see `localsql`) rather than in BigQuery.
+"""
+import glob
+import hashlib
+import os
+
+import pandas as pd
+from ebmdatalab import bq
+
+import compact
+import localsql
+from loading import read_shards, schema
+
+# how cached frames are typed: bump `format_version` when an encoding in
+# compact.py changes without changing its kinds or the loader's dtypes
+format_version = 2
+schema_version = "{}:{}:{}".format(
+    format_version,
+    sorted(compact.kinds.items()),
+    sorted((col, str(pd.api.types.pandas_dtype(dtype))) for col, dtype in schema.items()),
+)
+
+
+def _stem(path):
+    "Strip all extensions from a file name, e.g. `x.csv.gz` -> `x`"
+    directory, name = os.path.split(path)
+    return os.path.join(directory, name.split(".")[0])
+
+
+def cache_key(sql, paths):
+    "Hash of the query text, the size and mtime of each source file and `schema_version`"
+    digest = hashlib.sha1(sql.encode("utf8"))
+    digest.update(schema_version.encode("utf8"))
+    for path in sorted(paths):
+        stat = os.stat(path)
+        digest.update("{}:{}:{}".format(path, stat.st_size, stat.st_mtime_ns).encode())
+    return digest.hexdigest()[:12]
+
+
+def cached_build(stem, sql, sources, build):
+    """Return the cached copy for `sql` and `sources` if there is one,
+    otherwise call `build` and cache its result. With no `sources` the
+    result is built every time.
+    """
+    if not sources:
+        return build()
+    if all(os.path.exists(path) for path in sources):
+        path = "{}.{}.feather".format(stem, cache_key(sql, sources))
+        if os.path.exists(path):
+            return pd.read_feather(path)
+    df = build()
+    path = "{}.{}.feather".format(stem, cache_key(sql, sources))
+    for stale in glob.glob("{}.*.feather".format(stem)):
+        os.remove(stale)
+    df.reset_index(drop=True).to_feather(path)
+    return df
+
+
+def cached_read(sql, csv_path, parse_dates=(), **kwargs):
+    """Drop-in for `bq.cached_read` that keeps a typed copy of the result.
+
+    Columns in `parse_dates` are converted with `pd.to_datetime` before the
+    copy is written, so warm starts don't parse them again.
+    """
+
+    def build():
+        if localsql.data_directory:
+            df = localsql.cached_read(sql, csv_path)
+        else:
+            df = bq.cached_read(sql, csv_path=csv_path, **kwargs)
+        for col in parse_dates:
+            df[col] = pd.to_datetime(df[col])
+        return df
+
+    return cached_build(_stem(csv_path), sql, [csv_path], build)
+
+
+def cached_shards(sql, pattern="opioid*gz", name="opioid_practice"):
+    "`read_shards` for the extract of `sql`, with a typed copy of the result"
+    sources = sorted(glob.glob(pattern))
+    if not sources and localsql.data_directory:
+        sources = localsql.write_shards(sql, pattern)
+    return cached_build(name, sql, sources, lambda: read_shards(pattern))
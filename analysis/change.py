@@ -0,0 +1,115 @@
+"""Change in OME per 1000 by CCG between any two periods.
+
+The change section compared 2016 with 2017 only: it summed the practice
+rows by year, from 2016, and dropped 2018 as a part year. Here OME and the
+list sizes of the prescribing practices are summed once to a CCG x month
+table (`monthly_ome`, from the CCG cube) and cumulated with
+`rolling.cumulate`, so OME per 1000 for every CCG and every calendar year,
+or every 12 month window, is one slice of the cumulative sums
+(`ome_per_1000`). `changes` then takes the difference between every pair
+of periods in one step:
+
+    monthly = monthly_ome(cube, ccg_pop)
+    yearly = ome_per_1000(monthly)                  # CCG x year
+    rolling = ome_per_1000(monthly, by="window")    # CCG x 12 months to each month
+    moves = changes(yearly)
+    pair(moves, 2016, 2017)                         # as `change2`
+    year_on_year(moves)
+    year_on_year(changes(rolling), step=12)         # each window on the year before
+
+OME per 1000 is as in the notebook: the period's total OME over the mean
+monthly list size of the practices prescribing in the CCG, over the months
+the CCG has both.
+"""
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from orgs import mask
+from rolling import cumulate
+
+Changes = namedtuple("Changes", ["change", "percent"])
+
+
+def monthly_ome(cube, list_sizes):
+    """OME and prescribing list size of each CCG with a standard code and
+    month, for the months it has both
+    """
+    cube = cube.loc[mask(cube, "standard_ccg")]
+    ome = cube.groupby(["pct", "month"], observed=True)["total_ome"].sum().astype("float64").reset_index()
+    ome["pct"] = ome["pct"].astype(str)
+    return ome.merge(list_sizes[["pct", "month", "prescribing_list_size"]], on=["pct", "month"])
+
+
+def _periods(rolling, by, months):
+    "Labels, and window ends as month positions, of each period with data"
+    first = rolling.months[0]
+    if by == "year":
+        years = rolling.months.year.unique()
+        ends = (years - first.year) * 12 + 12 - first.month  # each December
+        return pd.Index(years, name="year"), np.asarray(ends), 12
+    if by == "window":
+        return pd.Index(rolling.months[months - 1:], name="end"), np.arange(months - 1, len(rolling.months)), months
+    raise ValueError("periods are by 'year' or 'window', not {!r}".format(by))
+
+
+def ome_per_1000(monthly, by="year", months=12, complete=True):
+    """OME per 1000 patients of each CCG in `monthly` (from `monthly_ome`)
+    for each calendar year (`by="year"`) or each window of `months` months
+    (`by="window"`, labelled by its last month).
+
+    With `complete`, years that the data doesn't cover in full, such as a
+    year to date, are left out.
+    """
+    rolling = cumulate(monthly, ["pct"], ["total_ome", "prescribing_list_size"])
+    labels, ends, length = _periods(rolling, by, months)
+    stop = np.minimum(ends + 1, len(rolling.months))
+    start = np.maximum(ends + 1 - length, 0)
+    if complete:
+        full = (ends + 1 - length >= 0) & (ends + 1 <= len(rolling.months))
+        labels, start, stop = labels[full], start[full], stop[full]
+
+    # (CCG x period x value) sums and (CCG x period) months with data, at once
+    sums = rolling.sums[:, stop] - rolling.sums[:, start]
+    counts = rolling.counts[:, stop] - rolling.counts[:, start]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        per_1000 = 1000 * sums[..., 0] / (sums[..., 1] / counts)
+    per_1000[counts == 0] = np.nan
+    return pd.DataFrame(per_1000, index=rolling.keys.rename("pct"), columns=labels)
+
+
+def changes(per_1000):
+    """Change and % change of each CCG between every pair of periods (columns)
+    of `per_1000`, earlier to later, with columns indexed by `from` and `to`
+    """
+    values = per_1000.to_numpy(dtype="float64")
+    before, after = np.triu_indices(values.shape[1], 1)
+    change = values[:, after] - values[:, before]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        percent = 100 * change / values[:, before]
+    columns = pd.MultiIndex.from_arrays(
+        [per_1000.columns[before], per_1000.columns[after]], names=["from", "to"]
+    )
+    return Changes(
+        pd.DataFrame(change, index=per_1000.index, columns=columns),
+        pd.DataFrame(percent, index=per_1000.index, columns=columns),
+    )
+
+
+def pair(changes, start, end):
+    "Change and %change of each CCG from `start` to `end`, as `change2`"
+    return pd.DataFrame({
+        "change": changes.change[(start, end)],
+        "%change": changes.percent[(start, end)],
+    })
+
+
+def year_on_year(changes, step=1):
+    """Changes between each period and the one `step` periods later: the
+    next year, or with windows `step=12`, the window a year later
+    """
+    columns = changes.change.columns
+    periods = list(dict.fromkeys(list(columns.get_level_values("from")) + list(columns.get_level_values("to"))))
+    following = list(zip(periods[:-step], periods[step:]))
+    return Changes(changes.change[following], changes.percent[following])
@@ -0,0 +1,135 @@
+"""Choropleth maps of CCG measures from one conversion of the boundaries.
+
+`GeoDataFrame.plot` converts every polygon to matplotlib patches, and adds
+a colour bar, each time a measure is mapped. Here `ccg_shapes` converts the
+boundaries to matplotlib paths once per process, each map panel is a
+`PathCollection` of those same paths, and mapping a measure only sets the
+collection's colour array and norm (`update`).
+
+A figure is declared as a spec: its grids (keyword arguments of
+`GridSpec`), and for each panel the measure, position, label and colour
+scale, and optionally its title size. Panels in the same `group` share one
+colour scale, with one colour bar beside the last of them; other panels
+each have their own:
+
+    spec = {"figsize": (12, 7), "grids": {"map": {"nrows": 1, "ncols": 1}},
+            "panels": [{"measure": "change", "at": ("map", 0, 0), "scale": "centred"}]}
+    plot_choropleths(change2, spec)
+"""
+from collections import namedtuple
+
+import matplotlib.gridspec as gridspec
+import matplotlib.pyplot as plt
+import numpy as np
+import shapely
+from matplotlib.collections import PathCollection
+from matplotlib.colors import Normalize, to_rgba
+from matplotlib.path import Path
+
+import geometry
+
+Shapes = namedtuple("Shapes", ["names", "paths", "bounds"])
+
+# colour scale limits from the values of the panels sharing a scale
+scales = {
+    "own": lambda values: (np.nanmin(values), np.nanmax(values)),
+    "from zero": lambda values: (0, np.nanmax(values) * 1.05),
+    # the largest fall at one end and its opposite at the other, so zero is in the centre
+    "centred": lambda values: (np.nanmin(values), -np.nanmin(values)),
+}
+
+# shapes of each path and tolerance made in this process
+_shapes = {}
+
+
+def _path(polygons):
+    "One compound path of every ring of `polygons`"
+    rings = shapely.get_rings(shapely.get_parts(polygons))
+    vertices, codes = [], []
+    for ring in rings:
+        coords = shapely.get_coordinates(ring)
+        ring_codes = np.full(len(coords), Path.LINETO, dtype=Path.code_type)
+        ring_codes[0], ring_codes[-1] = Path.MOVETO, Path.CLOSEPOLY
+        vertices.append(coords)
+        codes.append(ring_codes)
+    return Path(np.concatenate(vertices), np.concatenate(codes))
+
+
+def to_shapes(gdf):
+    "Shapes of the geometries of `gdf`, by its index, with their (x0, y0, x1, y1) bounds"
+    geometries = np.asarray(gdf.geometry)
+    return Shapes(gdf.index, [_path(polygons) for polygons in geometries], shapely.bounds(geometries))
+
+
+def ccg_shapes(tolerance=geometry.default_tolerance, path="ccgs.json"):
+    "Shapes of the CCG boundaries from `geometry.boundaries`, made once"
+    if (path, tolerance) not in _shapes:
+        _shapes[(path, tolerance)] = to_shapes(geometry.boundaries(tolerance, path))
+    return _shapes[(path, tolerance)]
+
+
+def _values(shapes, data, measure):
+    "Values of `measure` in the order of the shapes, masked where missing"
+    return np.ma.masked_invalid(data[measure].reindex(shapes.names).to_numpy(dtype="float64", na_value=np.nan))
+
+
+def draw(ax, shapes, values, norm, cmap="OrRd", edgecolor="black", linewidth=0.1):
+    """Add a collection of `shapes` coloured by `values` to `ax`, scaled to
+    the shapes with a value
+    """
+    collection = PathCollection(shapes.paths, cmap=cmap, linewidth=linewidth)
+    update(collection, values, norm, edgecolor)
+    ax.add_collection(collection, autolim=False)
+    bounds = shapes.bounds[~np.ma.getmaskarray(values)]
+    if len(bounds):
+        ax.update_datalim(np.concatenate([bounds[:, :2], bounds[:, 2:]]))
+    ax.autoscale_view()
+    return collection
+
+
+def update(collection, values, norm, edgecolor="black"):
+    """Recolour `collection` with `values` on the scale `norm`; shapes
+    without a value are not drawn, as by `GeoDataFrame.plot`
+    """
+    collection.set_array(values)
+    collection.set_norm(norm)
+    edges = np.tile(to_rgba(edgecolor), (len(values), 1))
+    edges[np.ma.getmaskarray(values), 3] = 0
+    collection.set_edgecolor(edges)
+
+
+def plot_choropleths(data, spec, shapes=None):
+    """Figure of the panels of `spec` mapping measures of `data`, a table
+    indexed by CCG name, on `shapes` (by default `ccg_shapes()`).
+    """
+    if shapes is None:
+        shapes = ccg_shapes()
+    fig = plt.figure(figsize=spec["figsize"])
+    grids = {name: gridspec.GridSpec(figure=fig, **kwargs) for name, kwargs in spec["grids"].items()}
+    panels = spec["panels"]
+    values = [_values(shapes, data, panel["measure"]) for panel in panels]
+
+    # one norm per group of panels, or per panel, and the panel with its colour bar
+    groups = [panel.get("group", i) for i, panel in enumerate(panels)]
+    norms, last = {}, {}
+    for i, (panel, group) in enumerate(zip(panels, groups)):
+        if group not in norms:
+            members = [values[j].filled(np.nan) for j, g in enumerate(groups) if g == group]
+            norms[group] = Normalize(*scales[panel.get("scale", "own")](np.concatenate(members)))
+        last[group] = i
+
+    for i, (panel, group) in enumerate(zip(panels, groups)):
+        name, row, col = panel["at"]
+        ax = fig.add_subplot(grids[name][row, col])
+        collection = draw(ax, shapes, values[i], norms[group], spec.get("cmap", "OrRd"))
+        ax.set_aspect(1.63)  # aspect for correct lat/long
+        if "label" in panel:
+            ax.set_title(panel["label"] + panel["measure"], size=panel.get("title_size", 20))
+        ax.axis("off")
+        if last[group] == i:
+            colorbar = fig.colorbar(collection, ax=ax)
+            if "tick_size" in spec:
+                colorbar.ax.tick_params(labelsize=spec["tick_size"])
+    if spec.get("tight"):
+        fig.tight_layout()
+    return fig
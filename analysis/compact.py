@@ -0,0 +1,162 @@
+"""Choose compact dtypes for the numeric columns of the practice-level frame.
+
+Each column has a kind:
+
+* counts (`items`, `quantity`) are held in the smallest integer type that
+  covers the observed range;
+* money (`net_cost`, `actual_cost`) is always held as whole pence in the
+  smallest integer type that covers the range, fractions of a penny being
+  rounded away;
+* measures (`total_ome`) are held as float32.
+
+Money has this one compacted encoding, so a money column is pence if it is
+an integer column and pounds, as read, if it isn't; `decode` turns either
+into float64 pounds. `validate` refuses a compacted frame with money in any
+other form, as its units would be mixed.
+"""
+import numpy as np
+import pandas as pd
+from pandas.api.types import is_integer_dtype
+
+kinds = {
+    "items": "count",
+    "quantity": "count",
+    "total_ome": "measure",
+    "net_cost": "money",
+    "actual_cost": "money",
+}
+
+# in order of preference; the first one wide enough is used
+int_dtypes = [pd.Int8Dtype(), pd.Int16Dtype(), pd.Int32Dtype(), pd.Int64Dtype()]
+float32_max = np.finfo(np.float32).max
+
+
+def _as_float(col):
+    return pd.to_numeric(col).astype("float64").to_numpy()
+
+
+def _smallest_int(lo, hi):
+    for dtype in int_dtypes:
+        info = np.iinfo(dtype.numpy_dtype)
+        if info.min <= lo and hi <= info.max:
+            return dtype
+    return None
+
+
+def choose_dtype(col, kind):
+    "Smallest dtype that holds the values of `col` exactly, given its kind"
+    values = _as_float(col)
+    values = values[~np.isnan(values)]
+    if kind == "money":
+        values = np.round(values * 100)  # whole pence
+    if kind == "measure":
+        if len(values) and np.abs(values).max() > float32_max:
+            return np.dtype("float64")
+        return np.dtype("float32")
+    if len(values) == 0:
+        return int_dtypes[0]
+    if not np.array_equal(np.round(values, 6), np.round(values)):
+        return np.dtype("float64")
+    dtype = _smallest_int(np.round(values.min()), np.round(values.max()))
+    if dtype is None:
+        return int_dtypes[-1] if kind == "money" else np.dtype("float64")
+    return dtype
+
+
+def plan(df):
+    "Map each numeric column of `df` to its compact dtype"
+    return {col: choose_dtype(df[col], kind) for col, kind in kinds.items() if col in df}
+
+
+def widen(a, b):
+    "Combine two plans into one whose dtypes hold the values of both"
+    combined = dict(a)
+    for col, dtype in b.items():
+        if col not in combined or combined[col] == dtype:
+            combined[col] = dtype
+        elif is_integer_dtype(combined[col]) and is_integer_dtype(dtype):
+            combined[col] = max(combined[col], dtype, key=lambda t: t.itemsize)
+        elif kinds.get(col) == "money":
+            combined[col] = int_dtypes[-1]  # money is only ever integer pence
+        elif not is_integer_dtype(combined[col]) and not is_integer_dtype(dtype):
+            combined[col] = max(combined[col], dtype, key=lambda t: t.itemsize)
+        else:
+            combined[col] = np.dtype("float64")
+    return combined
+
+
+def compact(df, dtypes=None):
+    """Cast the numeric columns of `df` to `dtypes`, or to the dtypes chosen by
+    `plan`. Columns already compacted are recast if their dtype differs.
+    """
+    if dtypes is None:
+        dtypes = plan(df)
+    df = df.copy()
+    for col, dtype in dtypes.items():
+        if df[col].dtype == dtype:
+            continue
+        values = decode_column(df[col])
+        if kinds[col] == "money" and is_integer_dtype(dtype):
+            values = (values * 100).round()
+        if is_integer_dtype(dtype):
+            values = values.round()
+        df[col] = values.astype(dtype)
+    return df
+
+
+def decode_column(col):
+    "Values of a numeric column as float64, with integer (pence) money converted to pounds"
+    values = pd.Series(_as_float(col), index=col.index, name=col.name)
+    if kinds.get(col.name) == "money" and is_integer_dtype(col.dtype):
+        values = values / 100
+    return values
+
+
+def decode(df):
+    """Copy of `df` with its numeric columns held as float64, and money in
+    pounds, ready for calculations
+    """
+    df = df.copy()
+    for col in kinds:
+        if col in df:
+            df[col] = decode_column(df[col])
+    return df
+
+
+def totals(df, by="pct"):
+    "Column totals in float64 pounds, by `by` and nationally"
+    columns = [col for col in kinds if col in df]
+    grouped = decode(df.groupby(by, observed=True)[columns].sum())
+    grouped.loc["national"] = grouped.sum()
+    return grouped
+
+
+def validate(compacted, reference_totals, by="pct", rtol=1e-5):
+    """Check totals of the compacted frame against float64 reference totals
+    from `totals`, raising ValueError if any differ by more than `rtol`, or
+    if any money column isn't held as integer pence.
+
+    Returns the largest relative error of each column.
+    """
+    pounds = [
+        col for col, kind in kinds.items()
+        if kind == "money" and col in compacted and not is_integer_dtype(compacted[col].dtype)
+    ]
+    if pounds:
+        raise ValueError(
+            "money columns must be compacted to integer pence, not {}".format(
+                {col: str(compacted[col].dtype) for col in pounds}
+            )
+        )
+    actual = totals(compacted, by=by)
+    actual, expected = actual.align(reference_totals, join="outer")
+    scale = expected.abs().where(expected != 0, 1)
+    errors = ((actual - expected).abs() / scale).fillna(0).max()
+    bad = errors[errors > rtol]
+    if len(bad):
+        raise ValueError(
+            "compacted totals differ from the float64 reference: {}".format(
+                bad.to_dict()
+            )
+        )
+    return errors
@@ -0,0 +1,138 @@
+"""Practice prescribing restated on the CCGs of one boundary vintage.
+
+The prescribing data carries the CCG code of each practice in each month,
+so CCGs merged since appear under their old codes: Leeds North, West and
+South and East (02V, 03C, 03G) until April 2018, NHS Leeds CCG (15F) after.
+The boundaries in `ccgs.json` are the 195 CCGs of April 2018 and
+`ccg_for_map.csv` those of April 2017, so rows under codes of another
+vintage have no boundary and drop out of the maps.
+
+`ccg_successors.csv` lists each merger as the old code, the code it became
+and the month it took effect. `crosswalk` gives each practice the CCG it
+was in at the vintage month, from the list sizes, or else the CCG of its
+nearest month carried forward through the mergers. It also gives each CCG
+code its successor at the vintage. `restate` then recodes a practice x
+month table by its practice, falling back on its CCG code. Each distinct
+practice and code is looked up once, and the result is broadcast to the
+rows by their categorical codes:
+
+    walk = crosswalk(pop, read_successors(), boundary_vintage)
+    restated = restate(df1, walk)          # pct as at April 2018
+    reconcile(ccg_dim, walk, df1["pct"])   # what each code maps to
+
+Later geographies (the 2020 and 2021 mergers, sub-ICB locations) are
+further rows of `ccg_successors.csv` and a later vintage.
+"""
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from orgs import evaluate, rules
+
+Crosswalk = namedtuple("Crosswalk", ["vintage", "practices", "codes"])
+
+# vintages of the boundary files
+boundary_vintage = "2018-04-01"  # ccgs.json
+ons_vintage = "2017-04-01"  # ccg_for_map.csv (CCG17)
+
+
+def read_successors(path="ccg_successors.csv"):
+    "Merged CCG codes, the code each became and the month it took effect"
+    return pd.read_csv(path, dtype={"code": str, "successor": str}, parse_dates=["month"])
+
+
+def _timestamp(month, like):
+    "`month` as a Timestamp comparable with the datetime column `like`"
+    month = pd.Timestamp(month)
+    tz = getattr(like.dtype, "tz", None)
+    if tz is None:
+        return month.tz_localize(None)
+    return month.tz_localize(tz) if month.tz is None else month.tz_convert(tz)
+
+
+def resolve(codes, successors, vintage):
+    """Code at `vintage` of each of `codes` (an Index of distinct codes),
+    following the mergers of `successors` that took effect by then
+    """
+    merged = successors.loc[successors["month"] <= _timestamp(vintage, successors["month"])]
+    merged = merged.set_index("code")["successor"]
+    resolved = pd.Series(np.asarray(codes, dtype=object), index=codes)
+    for _ in range(len(merged) + 1):  # one step per merger in a chain
+        following = resolved.map(merged).fillna(resolved)
+        if following.equals(resolved):
+            break
+        resolved = following
+    return resolved
+
+
+def crosswalk(pop, successors, vintage=boundary_vintage):
+    """CCG at `vintage` of each practice in `pop` (the practice list sizes)
+    and of each CCG code in `pop` and `successors`.
+
+    A practice is in the CCG it was listed under at `vintage`; a practice
+    not listed that month takes its CCG from its latest earlier month, or
+    its first later one, carried forward through the mergers.
+    """
+    vintage = _timestamp(vintage, pop["month"])
+    rows = pop[["practice", "CCG", "month"]].dropna()
+    after = (rows["month"] > vintage).to_numpy()
+    distance = np.abs((rows["month"] - vintage).dt.days.to_numpy())
+    nearest = rows.iloc[np.lexsort([distance, after])].drop_duplicates("practice")
+    codes = pd.Index(pd.unique(pd.concat([
+        rows["CCG"].astype(object), successors["code"], successors["successor"],
+    ]).dropna()))
+    codes = resolve(codes, successors, vintage)
+    practices = pd.Series(codes.reindex(nearest["CCG"].astype(object)).to_numpy(), index=nearest["practice"].astype(object))
+    return Crosswalk(vintage, practices, codes)
+
+
+def _lookup(col, mapping):
+    "Value of `mapping` for each of `col`, looked up once per distinct value; missing where it has none"
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        codes, uniques = col.cat.codes.to_numpy(), col.cat.categories
+    else:
+        codes, uniques = pd.factorize(col)
+    values = np.append(mapping.reindex(np.asarray(uniques, dtype=object)).to_numpy(dtype=object), np.nan)
+    return values[codes]  # code -1, a missing value, takes the trailing NaN
+
+
+def restate(df, walk, column="pct", practice="practice"):
+    """Copy of `df`, a practice x month table, with `column` the CCG each
+    row's practice was in at the crosswalk's vintage. Rows whose practice
+    isn't in the crosswalk keep their code, carried forward through the
+    mergers. Rows under codes that aren't standard CCG codes are kept as
+    they are.
+    """
+    codes = _lookup(df[practice], walk.practices) if practice in df else np.full(len(df), np.nan, dtype=object)
+    standard = evaluate(df[column], rules["standard_ccg"][1])
+    codes[~standard] = df[column].astype(object).to_numpy()[~standard]
+    missing = pd.isnull(codes)
+    if missing.any():
+        own = df[column].iloc[np.flatnonzero(missing)]
+        carried = _lookup(own, walk.codes)
+        codes[missing] = np.where(pd.isnull(carried), own.astype(object).to_numpy(), carried)
+    df = df.copy()
+    df[column] = pd.Categorical(codes)
+    return df
+
+
+def reconcile(ccgs, walk, data_codes=None):
+    """Each CCG code of `ccgs` (the CCG dimension), whether it is in
+    `data_codes`, the code it has at the crosswalk's vintage, and whether
+    that code has a boundary: the CCGs the maps would lose and those the
+    crosswalk recovers
+    """
+    table = ccgs.set_index("code")[["name", "has_boundary"]].copy()
+    if data_codes is not None:
+        table["in_data"] = table.index.isin(pd.unique(np.asarray(data_codes, dtype=object)))
+    table["vintage_code"] = walk.codes.reindex(table.index).fillna(pd.Series(table.index, index=table.index))
+    target = table.reindex(table["vintage_code"])
+    table["vintage_name"] = target["name"].to_numpy()
+    table["vintage_has_boundary"] = target["has_boundary"].fillna(False).to_numpy(dtype=bool)
+    table["status"] = np.select(
+        [table["has_boundary"].fillna(False).to_numpy(dtype=bool), table["vintage_has_boundary"].to_numpy()],
+        ["mapped", "merged into a mapped CCG"],
+        "no boundary",
+    )
+    return table
@@ -0,0 +1,93 @@
+"""CCG x month sums of the practice-level data.
+
+The CCG tables and maps only ever need practice data summed to CCG level,
+so `build_cube` sums `df1` once by CCG, practice status, month, chemical and
+long acting/high dose flags, and `build_list_sizes` sums the list sizes by
+CCG and month. Both are small enough to cache with `caching.cached_build`,
+and each CCG table is then a filter and a sum of these rather than another
+pass over the practice rows.
+
+Practice status is kept as a dimension so that the maps can still be
+limited to active practices.
+"""
+import pandas as pd
+
+from compact import decode
+from listsizes import join_list_sizes
+from measures import ccg_measures
+from orgs import mask, select
+from rolling import cumulate, window_means, window_sums
+
+dimensions = ["pct", "status_code", "month", "chem_substance", "Is_LA", "Is_High_LA"]
+values = ["items", "total_ome", "actual_cost"]
+
+
+def build_cube(df1):
+    "Sum the `values` of `df1` by each of `dimensions`"
+    cube = df1.groupby(dimensions, observed=True, dropna=False)[values].sum()
+    return cube.reset_index()
+
+
+def build_list_sizes(df1, pop):
+    """CCG x month list sizes.
+
+    `total_list_size` is the list size of all practices in the CCG according
+    to `pop`. `prescribing_list_size` is the list size of only the practices
+    in `df1`, under the CCG they prescribed under that month.
+    """
+    ccg = pop.groupby(["CCG", "month"])["total_list_size"].sum().rename_axis(["pct", "month"])
+    practices = df1[["pct", "practice", "month"]].drop_duplicates()
+    practices = join_list_sizes(practices, pop)
+    practices["pct"] = practices["pct"].astype(str)
+    prescribing = practices.groupby(["pct", "month"])["total_list_size"].sum()
+    return pd.concat([ccg, prescribing.rename("prescribing_list_size")], axis=1).reset_index()
+
+
+def standard_practices(cube):
+    "Rows for active practices in CCGs with standard codes, e.g. 00C"
+    return select(cube, "standard_ccg", "active")
+
+
+def rolling_ccg_sums(cube, list_sizes):
+    """Rolling sums, from `rolling.cumulate`, of the `values` of active
+    practices by CCG, chemical and flags, and of the CCG list sizes.
+    """
+    rows = decode(standard_practices(cube))  # costs in pounds, as ccg_measures expects
+    sums = cumulate(rows, ["pct", "chem_substance", "Is_LA", "Is_High_LA"], values)
+    sizes = cumulate(list_sizes.dropna(subset=["total_list_size"]), ["pct"], ["total_list_size"])
+    return sums, sizes
+
+
+def ccg_measures_at(rolling_sums, months=6, end=None):
+    """CCG measures, as `measures.ccg_measures`, over the `months` months up
+    to `end` (default the latest month) of `rolling_ccg_sums`. The list
+    sizes are averaged over the same months as the prescribing.
+    """
+    sums, sizes = rolling_sums
+    if end is None:
+        end = sums.months[-1]  # the list sizes may run to a later month
+    rows = window_sums(sums, months, end).reset_index()
+    popccg = window_means(sizes, months, end).rename_axis("CCG").reset_index()
+    return ccg_measures(rows, popccg)
+
+
+def latest_ccg_measures(cube, list_sizes, months=6):
+    """CCG measures, as `measures.ccg_measures`, for active practices over
+    the latest `months` months of `cube`.
+    """
+    return ccg_measures_at(rolling_ccg_sums(cube, list_sizes), months)
+
+
+def ome_per_1000_by_year(cube, list_sizes, since=2016):
+    """OME per 1000 patients of each CCG with a standard code, for each year
+    from `since`: the year's total OME over the mean monthly list size of the
+    practices prescribing in the CCG.
+    """
+    cube = cube.loc[mask(cube, "standard_ccg") & (cube["month"].dt.year >= since)]
+    ome = cube.groupby(["pct", "month"], observed=True)["total_ome"].sum().astype("float64").reset_index()
+    ome["pct"] = ome["pct"].astype(str)
+    monthly = ome.merge(list_sizes[["pct", "month", "prescribing_list_size"]], on=["pct", "month"])
+    monthly["year"] = monthly["month"].dt.year
+    yearly = monthly.groupby(["pct", "year"]).agg({"prescribing_list_size": "mean", "total_ome": "sum"})
+    per_1000 = 1000*yearly["total_ome"]/yearly["prescribing_list_size"]
+    return per_1000.unstack()
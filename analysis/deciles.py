@@ -0,0 +1,74 @@
+"""Monthly percentiles of practice measures.
+
+`deciles` sorts each measure once, by month and then value, and reads every
+percentile of every month from the sorted values by position. The result
+is a (month x measure x percentile) array, which the charts and the savings
+calculations index directly. Percentiles are interpolated linearly and
+ignore missing values, as `DataFrame.quantile` does.
+"""
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+Deciles = namedtuple("Deciles", ["months", "measures", "percentiles", "values"])
+
+percentiles = np.arange(1, 10) / 10
+
+# the measures charted, and those used for the savings targets
+measures = [
+    "Total OME (per 1000)",
+    "High dose items (per 1000)",
+    "Percent high dose (by items)",
+    "Percent high dose (by OME)",
+    "Total cost (per 1000)",
+    "Cost high dose opioids (per 1000)",
+    "Cost high dose opioids (per item)",
+]
+
+
+def deciles(df, measures=measures, percentiles=percentiles, by="month"):
+    "Percentiles of each of `measures` in `df` for each value of `by`"
+    codes, months = pd.factorize(df[by], sort=True)
+    q = np.asarray(percentiles, dtype="float64")
+    values = np.full((len(months), len(measures), len(q)), np.nan)
+    for i, measure in enumerate(measures):
+        x = df[measure].to_numpy(dtype="float64", na_value=np.nan)
+        present = ~np.isnan(x)
+        group = codes[present]
+        x = x[present]
+        # sort once, by month then value
+        x = x[np.lexsort((x, group))]
+        counts = np.bincount(group, minlength=len(months))
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        position = (counts[:, None] - 1) * q[None, :]
+        lower = np.floor(position).astype("int64")
+        upper = np.minimum(lower + 1, counts[:, None] - 1)
+        fraction = position - lower
+        has_values = counts > 0
+        lo = x[(starts[:, None] + lower)[has_values]]
+        hi = x[(starts[:, None] + upper)[has_values]]
+        with np.errstate(invalid="ignore"):
+            values[has_values, i, :] = np.where(fraction[has_values] == 0, lo, lo + (hi - lo) * fraction[has_values])
+    return Deciles(pd.Index(months), list(measures), q, values)
+
+
+def series(dec, measure, percentile):
+    "One percentile of one measure, indexed by month"
+    i = dec.measures.index(measure)
+    j = int(np.argmin(np.abs(dec.percentiles - percentile)))
+    return pd.Series(dec.values[:, i, j], index=dec.months, name=measure)
+
+
+def to_long(dec):
+    "Long format frame with month, percentile, measure, value and decile number"
+    months, measures, percentiles = np.meshgrid(
+        np.arange(len(dec.months)), np.arange(len(dec.measures)), np.arange(len(dec.percentiles)), indexing="ij"
+    )
+    return pd.DataFrame({
+        "month": dec.months[months.ravel()],
+        "percentile": dec.percentiles[percentiles.ravel()],
+        "measure": np.asarray(dec.measures, dtype=object)[measures.ravel()],
+        "value": dec.values.ravel(),
+        "index": np.round(dec.percentiles[percentiles.ravel()] * 10).astype(int),
+    })
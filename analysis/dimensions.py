@@ -0,0 +1,114 @@
+"""Integer keys for practices and CCGs, with their codes and names.
+
+CCGs are named differently in each source: by code in the prescribing and
+list size data, by code and name in `ccg_names.csv`, by ONS code in
+`ccg_for_map.csv` and by name in the `ccgs.json` boundaries. The dimension
+tables built here hold every code and name of each practice and CCG
+against one int32 key, with the first and last month it has a list size.
+Fact tables carry the keys as int32 columns (`add_keys`), and names are
+looked up through them (`label`), which reports any codes that don't match
+rather than dropping them silently.
+
+Keys are stable: passing the previous dimension table as `previous` keeps
+the keys of the codes already in it and numbers new codes after them.
+"""
+import json
+
+import numpy as np
+import pandas as pd
+
+key_dtype = "int32"
+
+
+def _keys(codes, previous=None):
+    "Dimension table index for `codes`, keeping the keys of `previous`"
+    codes = pd.Index(pd.unique(np.asarray(codes, dtype=object))).dropna()
+    known = pd.Index([], dtype=object) if previous is None else pd.Index(previous["code"])
+    new = codes.difference(known).sort_values()
+    all_codes = known.append(new)
+    return pd.DataFrame({"code": all_codes}, index=pd.Index(np.arange(len(all_codes)), name="key"))
+
+
+def _validity(pop, by):
+    return pop.groupby(by)["month"].agg(first_month="min", last_month="max")
+
+
+def map_names(path="ccgs.json"):
+    "Names of the CCGs with a boundary in the `ccgs.json` API download"
+    with open(path) as f:
+        features = json.load(f)["features"]
+    return pd.Index([f["properties"]["name"] for f in features if f["geometry"] is not None])
+
+
+def ccg_dimension(names, for_map=None, boundaries=None, pop=None, previous=None):
+    """CCG dimension table, indexed by key.
+
+    `names` has the `code` and `name` of each CCG, `for_map` the ONS codes
+    (`CCG17CD`) against our codes (`CCG17CDH`), `boundaries` the names of the
+    CCGs we have a boundary for (`map_names`) and `pop` the practice list
+    sizes, from which each CCG's first and last month are taken.
+    """
+    codes = [names["code"]]
+    if pop is not None:
+        codes.append(pop["CCG"])
+    dim = _keys(pd.concat(codes), previous)
+    dim = dim.join(names.drop_duplicates("code").set_index("code")[["name"]], on="code")
+    if for_map is not None:
+        ons = for_map.drop_duplicates("CCG17CDH").set_index("CCG17CDH")["CCG17CD"].rename("ons_code")
+        dim = dim.join(ons, on="code")
+    if boundaries is not None:
+        dim["has_boundary"] = dim["name"].isin(boundaries)
+    if pop is not None:
+        dim = dim.join(_validity(pop, "CCG"), on="code")
+    return dim
+
+
+def practice_dimension(pop, ccgs, previous=None):
+    """Practice dimension table, indexed by key, with the key of the CCG
+    each practice was in at its last month in `pop`.
+    """
+    dim = _keys(pop["practice"], previous)
+    latest = pop.sort_values("month").drop_duplicates("practice", keep="last").set_index("practice")
+    dim["ccg_key"] = encode(latest["CCG"].reindex(dim["code"]), ccgs)
+    return dim.join(_validity(pop, "practice"), on="code")
+
+
+def encode(codes, dim):
+    "int32 key of each of `codes` in `dim`, or -1 where it has none"
+    if isinstance(codes.dtype, pd.CategoricalDtype):
+        # look up each category once; missing values have code -1, so key -1
+        keys = np.append(encode(pd.Series(codes.cat.categories), dim), -1)
+        return keys[codes.cat.codes.to_numpy()].astype(key_dtype)
+    positions = pd.Index(dim["code"]).get_indexer(codes)
+    return np.where(positions >= 0, dim.index.to_numpy()[positions], -1).astype(key_dtype)
+
+
+def add_keys(df, practices=None, ccgs=None):
+    "Add int32 `practice_key` and `ccg_key` columns for the practice and pct codes of `df`"
+    if practices is not None:
+        df["practice_key"] = encode(df["practice"], practices)
+    if ccgs is not None:
+        df["ccg_key"] = encode(df["pct"], ccgs)
+    return df
+
+
+def label(df, dim, column="name", key="ccg_key"):
+    """Add `column` of `dim` to `df` by its `key` column.
+
+    Rows whose key or `column` is missing are dropped, and their codes
+    printed, rather than dropped silently as a merge would.
+    """
+    values = dim[column].reindex(df[key].to_numpy())
+    missing = values.isnull().to_numpy()
+    if missing.any():
+        codes = df.loc[missing, "pct"] if "pct" in df else df.loc[missing, key]
+        print("no {} for {} rows: {}".format(column, missing.sum(), ", ".join(sorted(map(str, set(codes))))))
+    df = df.loc[~missing].copy()
+    df[column] = values.to_numpy()[~missing]
+    return df
+
+
+def practice_ccgs(practice, practices, ccgs):
+    "Code of the latest CCG of each of `practice`, or missing where it has none"
+    keys = practices["ccg_key"].reindex(encode(practice, practices)).to_numpy()
+    return ccgs["code"].reindex(keys).to_numpy()
@@ -0,0 +1,240 @@
+"""Figures for the paper.
+
+The stacked area figures share one aggregate of `dfl`, made by `aggregate`.
+Each figure filters it, ranks chemicals by total OME over all years, groups
+the tail into "Other", and pivots all three measures in one go. The decile
+charts and maps are drawn from the tables built in the notebook.
+"""
+import matplotlib.gridspec as gridspec
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+import seaborn as sns
+
+measures = ["items_per_1000", "total_ome_per_1000", "cost_per_1000"]
+
+# title, y axis label and measure of each panel
+panels = [
+    ("(a)  Total prescriptions for {}", "Prescriptions per 1000 population", "items_per_1000"),
+    ("(b)  Total Oral Morphine Equivalency (mg) for {}", "Oral Morphine equivalency (mg) per 1000 population", "total_ome_per_1000"),
+    ("(c)  Total cost of {}", "Cost per 1000 population (2017 equivalent GBP)", "cost_per_1000"),
+]
+
+stacked_area_figures = {
+    "all": {
+        "description": "all opioid-containing preparations",
+        "top_n": 11,
+        "palette": "tab20",
+    },
+    "long_acting": {
+        "description": "long-acting opioid preparations",
+        "predicate": lambda df: df["Is_LA"] == True,  # noqa: E712
+    },
+    "high_dose": {
+        "description": "high-dose, long-acting opioid preparations",
+        "predicate": lambda df: df["Is_High_LA"] == "High dose",
+    },
+    "expand_other": {
+        "description": "opioid-containing preparations",
+        "skip": 11,
+        "top_n": 11,
+        "other": "Others",
+    },
+    "low_dose": {
+        "description": "non-high-dose, long-acting opioid preparations",
+        "predicate": lambda df: (df["Is_LA"] == True) & (df["Is_High_LA"] != "High dose"),  # noqa: E712
+    },
+}
+
+
+def aggregate(dfl):
+    "Sum the measures of `dfl` by year, chemical and long acting/high dose flags"
+    return dfl.groupby(["year", "chem_substance", "Is_LA", "Is_High_LA"])[measures].sum().reset_index()
+
+
+def ranked_pivot(agg, predicate=None, top_n=12, skip=0, other="Other"):
+    """Year x (measure, chemical) sums of the rows of `agg` matching `predicate`.
+
+    Chemicals are ranked by total OME over all years. The first `skip` are
+    left out, the next `top_n` are kept and the rest are grouped as `other`,
+    which comes last.
+    """
+    if predicate is not None:
+        agg = agg.loc[predicate(agg)]
+    ranking = agg.groupby("chem_substance")["total_ome_per_1000"].sum()
+    ranking = ranking.sort_values(ascending=False).iloc[skip:]
+    chemical = pd.Series(
+        np.where(np.arange(len(ranking)) < top_n, ranking.index, other), index=ranking.index
+    )
+    agg = agg.loc[agg["chem_substance"].isin(chemical.index)]
+    pivot = agg.assign(chemical=agg["chem_substance"].map(chemical)).pivot_table(
+        index="year", columns="chemical", values=measures, aggfunc="sum"
+    )
+    totals = pivot["total_ome_per_1000"].sum()
+    order = sorted(totals.index, key=lambda chem: (chem == other, -totals[chem]))
+    return pivot.reindex(columns=pd.MultiIndex.from_product([measures, order]))
+
+
+def plot_stacked_area(pivot, description, palette="Set3"):
+    "Three panel stacked area figure, one panel per measure, of a `ranked_pivot`"
+    with sns.axes_style("whitegrid", {"grid.color": ".9"}), sns.color_palette(palette, n_colors=14):
+        fig = plt.figure(figsize=(15, 20))
+        for i, (title, ylabel, measure) in enumerate(panels):
+            ax = plt.subplot(3, 1, i + 1)  # layout and position of subplot
+            pivot[measure].plot(ax=ax, kind="area", linewidth=0)
+            ax.set_xticks(np.arange(1998, 2017, step=1))
+            ax.set_xlabel("Year", size="14")
+            ax.set_ylabel(ylabel, size="14")
+            ax.tick_params(labelsize=12)
+            ax.set_title(title.format(description), size="17")
+            handles, labels = ax.get_legend_handles_labels()
+            box = ax.get_position()
+            ax.set_position([box.x0, box.y0, box.width * 0.8, box.height])
+            ax.legend(reversed(handles), reversed(labels), loc="center left", fontsize="12", bbox_to_anchor=(1, .62))
+    return fig
+
+
+def stacked_area_figure(agg, name):
+    "Plot one of the `stacked_area_figures` from an `aggregate` of `dfl`"
+    spec = dict(stacked_area_figures[name])
+    description = spec.pop("description")
+    palette = spec.pop("palette", "Set3")
+    return plot_stacked_area(ranked_pivot(agg, **spec), description, palette)
+
+
+def plot_all_stacked_areas(dfl):
+    "Plot every one of the `stacked_area_figures` from one aggregate of `dfl`"
+    agg = aggregate(dfl)
+    return {name: stacked_area_figure(agg, name) for name in stacked_area_figures}
+
+
+# measure, grid position, y axis label and title of each decile chart panel
+decile_panels = [
+    ("Total OME (per 1000)", 0, 0, "Oral Morphine Equivalency (mg) per 1000 patients", "(a)  Total OME for all opioid-containing preparations"),
+    ("High dose items (per 1000)", 0, 1, "Items per 1000 patients", "(b)  High dose items"),
+    ("Percent high dose (by items)", 1, 0, "Percent", "(c)  Percent long-acting opioids prescribed as high dose (by items)"),
+    ("Percent high dose (by OME)", 1, 1, "Percent", "(d)  Percent long-acting opioids prescribed as high dose (by OME)"),
+    ("Total cost (per 1000)", 2, 0, "Cost per 1000 patients (GBP)", "(e)  Total cost for all opioid-containing preparations"),
+    ("Cost high dose opioids (per 1000)", 2, 1, "Cost per 1000 patients (GBP)", "(f)  Cost for all high dose opioids"),
+]
+
+
+def plot_deciles(dec):
+    "Monthly practice decile charts from a `deciles.Deciles` array"
+    with sns.axes_style("whitegrid", {"grid.color": ".9"}):
+        fig = plt.figure(figsize=(18, 20))
+        gs = gridspec.GridSpec(3, 2)  # grid layout for subplots
+        for measure, row, col, ylabel, title in decile_panels:
+            ax = plt.subplot(gs[row, col])
+            values = dec.values[:, dec.measures.index(measure), :]
+            for j, percentile in enumerate(dec.percentiles):  # plot each decile line
+                if np.isclose(percentile, 0.5):
+                    ax.plot(dec.months, values[:, j], "b-", linewidth=0.7)
+                else:
+                    ax.plot(dec.months, values[:, j], "b--", linewidth=0.4)
+            ax.set_ylabel(ylabel, size=14, alpha=0.6)
+            ax.set_title(title, size=17)
+            ax.set_ylim([0, 1.05 * np.nanmax(values[:, -1])])
+            if ylabel == "Percent":  # set y axis limit only for percentage measure
+                ax.set_ylim([0, 70])
+            ax.tick_params(labelsize=12)
+            ax.set_xlim([dec.months.min(), dec.months.max()])  # full date range
+        plt.subplots_adjust(wspace=0.13, hspace=0.16)
+    return fig
+
+
+def load_ccgs(path="ccgs.json", tolerance=0):
+    """CCG boundaries from our API, without the federations, which have no
+    geometry, simplified at `tolerance` (see geometry.py)
+    """
+    from geometry import boundaries
+
+    # from our API https://openprescribing.net/api/1.0/org_location/?org_type=ccg
+    return boundaries(tolerance, path)
+
+
+def _panels(grid, panels, **kwargs):
+    "Map panel specs of (measure, row, column, label) in `grid`"
+    return [dict(measure=measure, at=(grid, row, col), label=label, **kwargs) for measure, row, col, label in panels]
+
+
+# measure, grid position and panel label of each map
+map_panels = [
+    ("Total OME (per 1000)", 0, 0, "(a)  "),
+    ("Total cost (per 1000)", 0, 1, "(b)  "),
+    ("High dose items (per 1000)", 1, 0, "(c)  "),
+    ("Percent high dose (by items)", 1, 1, "(d)  "),
+]
+share_map_panels = [
+    ("% Fentanyl of high dose OME", 0, 0, "(e)  "),
+    ("% Morphine of high dose OME", 0, 1, "(f)  "),
+    ("% Oxycodone of high dose OME", 0, 2, "(g)  "),
+]
+
+# choropleth specs (see choropleth.py) of the map figures: maps (a)-(d) each
+# have their own colour scale, and maps (e)-(g) share one from zero
+map_figures = {
+    "maps": {
+        "figsize": (16, 30),
+        "grids": {"maps": {"nrows": 4, "ncols": 2, "wspace": 0.05, "hspace": 0.05}},
+        "panels": _panels("maps", map_panels),
+        "tick_size": 14,
+    },
+    "share_maps": {
+        "figsize": (17, 6),
+        # adjust ratios to allow all plots to appear same size despite the third having a legend.
+        "grids": {"shares": {"nrows": 1, "ncols": 3, "width_ratios": [4, 4, 5]}},
+        "panels": _panels("shares", share_map_panels, scale="from zero", group="shares"),
+        "tick_size": 16,
+        "tight": True,
+    },
+    "all_maps": {
+        "figsize": (16, 30),
+        "grids": {
+            "maps": {"nrows": 4, "ncols": 2, "bottom": 0.3, "wspace": 0.05, "hspace": 0.05},
+            "shares": {"nrows": 1, "ncols": 3, "width_ratios": [4, 4, 5], "top": 0.3, "wspace": 0.05},
+        },
+        "panels": _panels("maps", map_panels) + _panels("shares", share_map_panels, scale="from zero", group="shares", title_size=18),
+        "tick_size": 14,
+    },
+    "change_map": {
+        "figsize": (12, 7),
+        "grids": {"map": {"nrows": 1, "ncols": 1}},
+        "panels": [{"measure": "change", "at": ("map", 0, 0), "scale": "centred"}],
+        "cmap": "coolwarm",
+    },
+}
+
+
+def plot_map_figure(data, name, shapes=None):
+    "One of the `map_figures` of the CCG measures in `data`, indexed by CCG name"
+    from choropleth import plot_choropleths
+
+    return plot_choropleths(data, map_figures[name], shapes)
+
+
+def plot_maps(data, shapes=None):
+    "Maps (a)-(d) of CCG measures, each with its own colour scale"
+    return plot_map_figure(data, "maps", shapes)
+
+
+def plot_share_maps(data, shapes=None):
+    "Maps (e)-(g) of the share of high dose OME by chemical, on one colour scale"
+    return plot_map_figure(data, "share_maps", shapes)
+
+
+def plot_change_map(data, column="change", shapes=None):
+    "Map of the change in OME per 1000 by CCG, centred on zero"
+    return plot_map_figure(data.rename(columns={column: "change"}), "change_map", shapes)
+
+
+def plot_all_maps(spending, change, shapes=None):
+    """Every map figure, from one conversion of the boundaries: `spending`
+    has the CCG measures and `change` the change in OME per 1000
+    """
+    from choropleth import ccg_shapes
+
+    shapes = shapes if shapes is not None else ccg_shapes()
+    maps = {name: plot_map_figure(spending, name, shapes) for name in ["maps", "share_maps", "all_maps"]}
+    maps["change_map"] = plot_change_map(change, shapes=shapes)
+    return maps
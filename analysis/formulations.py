@@ -0,0 +1,124 @@
+"""Formulation of each drug, as classified by the formulation query.
+
+The query takes the text between the chemical and the strength of the drug
+name (`Morph Sulf_Tab 10mg` -> `Tab`) and maps it to a formulation with a
+CASE of IN lists and LIKE patterns. Here the same CASE is the table
+`rules`, applied in order: a value listed in a rule takes that rule's
+formulation unless an earlier rule's pattern matches it, which is
+precomputed as one dict lookup; only the values not listed are tested
+against the patterns. Values no rule matches are their own formulation.
+
+Each distinct drug name is classified once and the result broadcast by
+the codes of the names, so whole extracts can be reclassified locally.
+With the Parquet copies used by `localsql`, the first year of each
+chemical and formulation, `by_formulation.zip`, can be rebuilt and checked:
+
+    python formulations.py [--data bq] [--expected by_formulation.zip]
+"""
+import argparse
+import re
+
+import numpy as np
+import pandas as pd
+
+# text between the chemical and the strength, as REGEXP_EXTRACT in the query
+form = re.compile(r"[^_]+_(.*?)(?:[0-9]+.*)?$")
+
+# formulation, values matched exactly (IN) and LIKE patterns, in CASE order
+rules = [
+    ("Cream/Gel", ["Vag Crm", "Vag Gel", "Oily Crm", "Crm", "Gel", "Lot", "Soln", "Gel Sach", "Oint", "Intrasite Gel"], []),
+    ("Lozenge/Sublingual tab", ["Tab Buccal", "Buccal Film", "Tab Subling", "Disper Tab", "Orodisper Tab", "Loz",
+                                "Tab Sublingual", "Oral Lyophilisate"], []),
+    ("Soluble Tab/Powder", ["Tab Solb", "Eff Tab", "Solb Tab", "Tab Eff", "Pdr Sach", "Eff Pdr Sach", "Susp Gran Sach"], []),
+    ("Tab/Cap", ["Cap", "Cap E/C", "Capl"], ["%Tab", "%Cap"]),
+    ("Liquid", ["Liq Spec", "Oral Soln", "Sod Oral Soln", "Elix", "Liq", "Oral Susp", "Tinct", "Liq Conc", "Oral Dps",
+                "Oral Soln Conc", "Oral Conc", "Mix", "Elix BPC Inc Duty", "Methadone HCl Mix"], ["%Susp%"]),
+    ("Injectible", ["I/V Inf", "Syr", "Inj", "(S)", "Lact Inj", "P", "Morph Sulf", "Morph Sulph", "Implant"], ["%Inj"]),
+    ("Patch", ["Patch", "Patches", "TransdermalPatch", "Transdermal Patch", "T/Derm Patch"], []),
+    ("Suppository", ["Lact Suppos", "Suppos"], []),
+    ("Inhalation", ["Reefer"], ["%Nsl Spy%"]),
+]
+
+
+def like(pattern):
+    "Compiled regular expression matching what the SQL LIKE `pattern` does"
+    parts = re.split(r"([%_])", pattern)
+    return re.compile("".join({"%": ".*", "_": "."}.get(part, re.escape(part)) for part in parts) + r"\Z", re.S)
+
+
+patterns = [(formulation, [like(p) for p in likes]) for formulation, _, likes in rules]
+
+
+def _first_pattern(value, upto=len(rules)):
+    "Formulation of the first of the first `upto` rules whose patterns match `value`"
+    for formulation, compiled in patterns[:upto]:
+        if any(p.match(value) for p in compiled):
+            return formulation
+    return None
+
+
+# values listed in a rule, and their formulation, unless an earlier
+# rule's pattern takes them first
+exact = {}
+for i, (formulation, values, _) in enumerate(rules):
+    for value in values:
+        if value not in exact:
+            exact[value] = _first_pattern(value, i) or formulation
+
+
+def mid_string(drug_name):
+    "The text between the chemical and the strength of `drug_name`, right trimmed"
+    if not isinstance(drug_name, str):
+        return None
+    match = form.search(drug_name)
+    return match.group(1).rstrip() if match else None
+
+
+def formulation(mid):
+    "Formulation of one `mid_string`"
+    if mid is None:
+        return None
+    if mid in exact:
+        return exact[mid]
+    return _first_pattern(mid) or mid
+
+
+def classify(drug_names):
+    "Formulation of each of `drug_names`, classifying each distinct name once"
+    drug_names = pd.Series(drug_names)
+    if isinstance(drug_names.dtype, pd.CategoricalDtype):
+        codes, uniques = drug_names.cat.codes.to_numpy(), drug_names.cat.categories
+    else:
+        codes, uniques = pd.factorize(drug_names)
+    forms = np.array([formulation(mid_string(name)) for name in uniques] + [None], dtype=object)
+    return pd.Series(forms[codes], index=drug_names.index, name="formulation")
+
+
+def first_years(trends, converter):
+    """First year each chemical was prescribed in each formulation, from the
+    yearly `trends` by drug name and `converter` (opioid_converter), as the
+    formulation query gives.
+    """
+    names = converter[["drug_name", "chem_substance"]].drop_duplicates()
+    df = trends[["year", "drug_name"]].drop_duplicates().merge(names, on="drug_name")
+    df["formulation"] = classify(df["drug_name"]).to_numpy()
+    tbl = df.groupby(["chem_substance", "formulation"], dropna=False)["year"].min().rename("min_year")
+    return tbl.reset_index().sort_values(["chem_substance", "formulation"]).reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    import localsql
+
+    parser = argparse.ArgumentParser(description="Rebuild the first year of each formulation locally")
+    parser.add_argument("--data", default=localsql.data_directory or "bq", help="directory of Parquet tables")
+    parser.add_argument("--expected", default="by_formulation.zip")
+    args = parser.parse_args()
+    con = localsql.connect(args.data)
+    trends = localsql.run("SELECT DISTINCT year, drug_name FROM helen.trends_from_pca_final_2017", con)
+    converter = localsql.run("SELECT DISTINCT drug_name, chem_substance FROM richard.opioid_converter", con)
+    # an empty formulation reads back from the CSV as missing
+    tbl = first_years(trends, converter).replace({"formulation": {"": np.nan}})
+    tbl = tbl.sort_values(["chem_substance", "formulation"]).reset_index(drop=True)
+    expected = pd.read_csv(args.expected).sort_values(["chem_substance", "formulation"]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(tbl, expected[tbl.columns], check_dtype=False)
+    print("{} chemical and formulation first years match {}".format(len(tbl), args.expected))
@@ -0,0 +1,98 @@
+"""CCG boundaries, parsed once and kept simplified at several tolerances.
+
+Reading `ccgs.json` with geopandas parses the GeoJSON each time a map is
+drawn, and the maps then draw every vertex of the full resolution
+boundaries. `boundary_table` parses it once, drops the federations, which
+have no geometry, and simplifies the boundaries at each of `tolerances`
+(in degrees). They are simplified as a coverage (`shapely.coverage_simplify`),
+so neighbouring CCGs keep one shared edge, without gaps or overlaps. The
+table is cached as WKB in a Feather file by `caching.cached_build`, keyed on
+the tolerances and the size and time of `ccgs.json`, and the GeoDataFrame
+of each tolerance is made once per process:
+
+    boundaries(0.001)                     # GeoDataFrame indexed by CCG name
+    join(spending2)                       # with the measures of each CCG
+    render(lambda gdf: gdf.plot(column="change"), change2)  # joined and drawn
+
+The map figures themselves are drawn by `choropleth`, from paths made once
+from these boundaries.
+"""
+import json
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from caching import cached_build
+
+# tolerances cached, 0 being the boundaries as downloaded
+tolerances = [0, 0.0005, 0.001, 0.005]
+# tolerance of the maps: about 100m, well under a pixel of a map at 300 dpi
+default_tolerance = 0.001
+
+# GeoDataFrame of each path and tolerance made in this process
+_boundaries = {}
+
+
+def _parse(path):
+    "Properties and shapely geometry of each feature of `path` with a geometry"
+    with open(path) as f:
+        features = [feature for feature in json.load(f)["features"] if feature["geometry"] is not None]
+    properties = pd.DataFrame([feature["properties"] for feature in features])
+    return properties, np.array([shapely.geometry.shape(feature["geometry"]) for feature in features])
+
+
+def simplify(geometries, tolerance):
+    """`geometries` simplified as a coverage, or one by one preserving
+    topology where shapely is too old for that
+    """
+    if tolerance == 0:
+        return geometries
+    if hasattr(shapely, "coverage_simplify"):
+        return shapely.coverage_simplify(geometries, tolerance)
+    return shapely.simplify(geometries, tolerance, preserve_topology=True)
+
+
+def boundary_table(path="ccgs.json", tolerances=tolerances):
+    "Properties and WKB geometry of each CCG in `path` at each of `tolerances`"
+
+    def build():
+        properties, geometries = _parse(path)
+        return pd.concat([
+            properties.assign(tolerance=float(tolerance), wkb=shapely.to_wkb(simplify(geometries, tolerance)))
+            for tolerance in tolerances
+        ], ignore_index=True)
+
+    stem = path.rsplit(".", 1)[0] + "_geometry"
+    return cached_build(stem, "tolerances {}".format(list(tolerances)), [path], build)
+
+
+def boundaries(tolerance=default_tolerance, path="ccgs.json"):
+    """GeoDataFrame of the CCG boundaries in `path` simplified at `tolerance`,
+    indexed by name, as `figures.load_ccgs`. Tolerances not cached are
+    simplified from the full boundaries.
+    """
+    import geopandas as gpd
+
+    if (path, tolerance) not in _boundaries:
+        table = boundary_table(path)
+        rows = table.loc[table["tolerance"] == float(tolerance)]
+        if rows.empty:
+            rows = table.loc[table["tolerance"] == 0]
+            geometries = simplify(shapely.from_wkb(rows["wkb"].to_numpy()), tolerance)
+        else:
+            geometries = shapely.from_wkb(rows["wkb"].to_numpy())
+        _boundaries[(path, tolerance)] = gpd.GeoDataFrame(
+            rows.drop(columns=["tolerance", "wkb"]).set_index("name"), geometry=geometries, crs="EPSG:4326"
+        )
+    return _boundaries[(path, tolerance)]
+
+
+def join(data, tolerance=default_tolerance, path="ccgs.json"):
+    "Boundaries of the CCGs with the measures in `data`, indexed by CCG name"
+    return boundaries(tolerance, path).join(data)
+
+
+def render(plot, data, tolerance=default_tolerance, path="ccgs.json"):
+    "Draw `plot`, given a GeoDataFrame, of the measures in `data` on the boundaries"
+    return plot(join(data, tolerance, path))
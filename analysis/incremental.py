@@ -0,0 +1,172 @@
+"""Add new months of practice data to stored monthly results.
+
+Instead of reloading the whole practice-level extract each month, each new
+shard is processed on its own and its results are stored by month:
+
+    refresh/manifest.json            shards and months already processed
+    refresh/practice/YYYY-MM.feather practice measures (as `df2`)
+    refresh/deciles/YYYY-MM.feather  practice deciles of each measure
+    refresh/ccg/YYYY-MM.feather      sums by CCG, chemical and flags, for
+                                     active practices with standard CCG codes
+    refresh/list_sizes/YYYY-MM.feather  CCG list sizes
+
+Each shard must hold whole months. Shards already in the manifest, with
+the same size and modification time, are skipped without being read, as
+are months already processed. The CCG measures for the latest N months are
+then built from the stored CCG sums alone.
+
+    python incremental.py opioid_201807.csv.gz [--list-sizes practice_list_size.zip]
+"""
+import argparse
+import functools
+import glob
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+import compact
+import deciles
+from loading import read_shards, unify_categories
+from measures import ccg_measures, practice_measures
+from orgs import select
+
+store = "refresh"
+
+
+def _path(store, part, month=None):
+    if month is None:
+        return os.path.join(store, part)
+    return os.path.join(store, part, "{}.feather".format(month))
+
+
+def load_manifest(store=store):
+    "Shards and months already processed"
+    path = _path(store, "manifest.json")
+    if not os.path.exists(path):
+        return {"shards": {}, "months": []}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_manifest(manifest, store):
+    path = _path(store, "manifest.json")
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+
+def _shard_key(path):
+    stat = os.stat(path)
+    return "{}:{}".format(stat.st_size, stat.st_mtime_ns)
+
+
+def _month_key(month):
+    return month.strftime("%Y-%m")
+
+
+def _write(df, store, part, month):
+    directory = _path(store, part)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    df.reset_index(drop=True).to_feather(_path(store, part, month))
+
+
+def process_month(df1, pop, month, store=store):
+    "Store the practice measures, deciles and CCG sums of one month of `df1`"
+    key = _month_key(month)
+    df2 = practice_measures(df1, pop.loc[pop["month"] == month])
+    _write(df2, store, "practice", key)
+
+    dec = deciles.deciles(df2)
+    table = pd.DataFrame(dec.values[0], index=dec.measures, columns=dec.percentiles.astype(str))
+    _write(table.T.rename_axis("percentile").reset_index(), store, "deciles", key)
+
+    standard = select(df1, "standard_ccg", "active")
+    ccg = standard.groupby(["pct", "chem_substance", "Is_LA", "Is_High_LA"], observed=True)[["items", "total_ome", "actual_cost"]].sum()
+    _write(ccg.reset_index(), store, "ccg", key)
+
+    list_sizes = pop.loc[pop["month"] == month].groupby("CCG")["total_list_size"].sum()
+    _write(list_sizes.reset_index(), store, "list_sizes", key)
+
+
+def refresh(shards, pop, store=store):
+    """Process every month in `shards` not already in the store's manifest.
+
+    `pop` is the practice list size table, as loaded in the notebook.
+    Returns the months processed.
+    """
+    manifest = load_manifest(store)
+    if not os.path.exists(store):
+        os.makedirs(store)
+    processed = []
+    for path in shards:
+        key = _shard_key(path)
+        if manifest["shards"].get(path) == key:
+            print("skipping {}, already processed".format(path))
+            continue
+        df1 = read_shards(path)
+        for month in sorted(df1["month"].unique()):
+            month = pd.Timestamp(month)
+            if _month_key(month) in manifest["months"]:
+                print("skipping {}, already processed".format(_month_key(month)))
+                continue
+            process_month(df1.loc[df1["month"] == month], pop, month, store)
+            manifest["months"] = sorted(manifest["months"] + [_month_key(month)])
+            processed.append(_month_key(month))
+            _save_manifest(manifest, store)
+        manifest["shards"][path] = key
+        _save_manifest(manifest, store)
+    return processed
+
+
+def _history(store, part, months=None):
+    if months is None:
+        months = load_manifest(store)["months"]
+    frames = [pd.read_feather(_path(store, part, month)) for month in months]
+    # each month was compacted on its own values; cast all to dtypes that hold every month
+    dtypes = functools.reduce(compact.widen, [
+        {col: frame[col].dtype for col in compact.kinds if col in frame} for frame in frames
+    ], {})
+    frames = [compact.compact(frame, dtypes) for frame in frames]
+    unify_categories(frames)
+    return pd.concat(frames, ignore_index=True)
+
+
+def practice_history(store=store):
+    "Practice measures for every stored month, as `df2`"
+    return _history(store, "practice")
+
+
+def decile_history(store=store):
+    "Practice deciles for every stored month, as `deciles.deciles` returns"
+    months = load_manifest(store)["months"]
+    tables = [pd.read_feather(_path(store, "deciles", month)).set_index("percentile") for month in months]
+    values = np.stack([table.T.to_numpy() for table in tables])
+    return deciles.Deciles(
+        pd.to_datetime(months).tz_localize("UTC"),
+        list(tables[0].columns),
+        tables[0].index.astype(float).to_numpy(),
+        values,
+    )
+
+
+def latest_ccg_measures(store=store, months=6):
+    "CCG measures for the latest `months` months in the store"
+    window = load_manifest(store)["months"][-months:]
+    rows = _history(store, "ccg", window)
+    popccg = _history(store, "list_sizes", window).groupby("CCG")["total_list_size"].mean().reset_index()
+    return ccg_measures(rows, popccg)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add new months of practice data to the stored results")
+    parser.add_argument("shards", nargs="*", help="new shards (default all opioid*gz)")
+    parser.add_argument("--list-sizes", default="practice_list_size.zip")
+    parser.add_argument("--store", default=store)
+    args = parser.parse_args()
+    pop = pd.read_csv(args.list_sizes)
+    pop["month"] = pd.to_datetime(pop["month"])
+    months = refresh(args.shards or sorted(glob.glob("opioid*gz")), pop, args.store)
+    print("processed {} new months".format(len(months)))
@@ -0,0 +1,80 @@
+"""Practice list sizes held as a dense practice x month array.
+
+Joining list sizes to the practice data with `merge` hashes the string
+practice codes and months of both frames every time. `index_list_sizes`
+instead numbers each practice in `pop` and each month from the first, and
+stores the list sizes in a (practice x month) array, so `lookup` is a
+gather from that array: the practice codes are looked up once per category
+and the months are turned into offsets arithmetically.
+"""
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+ListSizes = namedtuple("ListSizes", ["practices", "start", "sizes", "present"])
+
+
+def _month_numbers(months):
+    months = pd.DatetimeIndex(months)
+    return np.asarray(months.year * 12 + months.month - 1, dtype="int64")
+
+
+def index_list_sizes(pop):
+    """Dense index of the `total_list_size` of each practice and month in `pop`.
+
+    Raises ValueError if a practice has more than one list size in a month.
+    """
+    ids, practices = pd.factorize(pop["practice"])
+    months = _month_numbers(pop["month"])
+    start = months.min()
+    offsets = months - start
+    width = offsets.max() + 1
+    if len(np.unique(ids * width + offsets)) < len(pop):
+        raise ValueError("more than one list size for a practice and month")
+    values = pop["total_list_size"].to_numpy()
+    sizes = np.zeros((len(practices), width), dtype=values.dtype)
+    present = np.zeros((len(practices), width), dtype=bool)
+    sizes[ids, offsets] = values
+    present[ids, offsets] = True
+    return ListSizes(practices, start, sizes, present)
+
+
+def _practice_ids(index, practice):
+    "Row of each of `practice` in the index, or -1 if it has none"
+    if isinstance(practice.dtype, pd.CategoricalDtype):
+        ids = index.practices.get_indexer(practice.cat.categories)
+        codes = practice.cat.codes.to_numpy()
+        return np.where(codes >= 0, ids[codes], -1)
+    return index.practices.get_indexer(practice)
+
+
+def lookup(index, practice, month):
+    """List size of each `practice` in each `month`, and whether it has one.
+
+    Returns two arrays the length of `practice`; list sizes missing from the
+    index are 0 where `found` is False.
+    """
+    ids = _practice_ids(index, practice)
+    offsets = _month_numbers(month) - index.start
+    valid = (ids >= 0) & (offsets >= 0) & (offsets < index.sizes.shape[1])
+    sizes = np.zeros(len(ids), dtype=index.sizes.dtype)
+    found = np.zeros(len(ids), dtype=bool)
+    sizes[valid] = index.sizes[ids[valid], offsets[valid]]
+    found[valid] = index.present[ids[valid], offsets[valid]]
+    return sizes, found
+
+
+def join_list_sizes(df, pop):
+    """Rows of `df` with a list size, with the list size of the practice
+    that month as `total_list_size`: the same as an inner merge with `pop`
+    on practice and month.
+
+    `pop` is the list size table or an index of it from `index_list_sizes`.
+    """
+    if not isinstance(pop, ListSizes):
+        pop = index_list_sizes(pop)
+    sizes, found = lookup(pop, df["practice"], df["month"])
+    df = df.loc[found].reset_index(drop=True)
+    df["total_list_size"] = sizes[found]
+    return df
@@ -0,0 +1,139 @@
+"""Load the practice-level opioid extract from its `opioid*gz` shards."""
+import glob
+import resource
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+import compact
+
+# numeric columns are read as float64 and then compacted, see compact.py
+schema = {
+    "pct": "category",
+    "practice": "category",
+    "status_code": "category",
+    "chem_substance": "category",
+    "bnf_code": "category",
+    "Is_LA": "category",
+    "Is_High_LA": "category",
+    "items": np.float64,
+    "quantity": np.float64,
+    "total_ome": np.float64,
+    "net_cost": np.float64,
+    "actual_cost": np.float64,
+}
+
+
+def as_true_false(val):
+    "Convert to true/false strings"
+    if isinstance(val, str):
+        if not val:
+            val = None
+        elif str(val).lower() == "true":
+            val = True
+        else:
+            val = False
+    else:
+        if np.isnan(val):
+            val = None
+        else:
+            if val:
+                val = True
+            else:
+                val = False
+    return val
+
+
+converters = {"Is_LA": as_true_false, "Is_High_LA": as_true_false}
+boolean_columns = list(converters)
+
+
+def as_boolean(col):
+    """Vectorised equivalent of the `as_true_false` converter.
+
+    The converter is evaluated once per distinct value and the result is
+    broadcast back over the column, giving a nullable boolean column.
+    """
+    codes, uniques = pd.factorize(col)
+    lookup = [as_true_false(val) for val in uniques] + [None]
+    # missing values have code -1, which picks up the trailing None
+    values = pd.array(lookup, dtype="boolean").take(codes)
+    return pd.Series(values, index=col.index, name=col.name)
+
+
+def peak_memory():
+    "Peak resident set size of this process, in bytes"
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # reported in kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def unify_categories(chunks):
+    """Give every categorical column the same categories in all chunks, so
+    that a single concat keeps them categorical.
+    """
+    columns = [
+        col for col, dtype in chunks[0].dtypes.items() if dtype.name == "category"
+    ]
+    for col in columns:
+        categories = union_categoricals(
+            [chunk[col] for chunk in chunks], ignore_order=True
+        ).categories
+        for chunk in chunks:
+            chunk[col] = chunk[col].cat.set_categories(categories)
+
+
+def read_shards(pattern="opioid*gz", chunksize=250000, dtype=None, verbose=True):
+    """Read every shard matching `pattern` in chunks and concatenate once.
+
+    Returns a single frame with one set of categories per categorical column
+    and numeric columns compacted as described in compact.py. Totals of the
+    compacted columns are checked against the float64 values as read.
+    Prints throughput and the process's peak memory when `verbose` is set.
+    """
+    if dtype is None:
+        dtype = schema
+    start = time.time()
+    chunks = []
+    dtypes = {}
+    reference = None
+    for path in sorted(glob.glob(pattern)):
+        if verbose:
+            print("loading {}....".format(path))
+        reader = pd.read_csv(
+            path,
+            dtype=dtype,
+            chunksize=chunksize,
+            low_memory=False,
+        )
+        for chunk in reader:
+            chunk["month"] = pd.to_datetime(chunk["month"], utc=True)
+            for col in boolean_columns:
+                if col in chunk:  # not in extracts by BNF code
+                    chunk[col] = as_boolean(chunk[col])
+            chunk_totals = compact.totals(chunk)
+            if reference is None:
+                reference = chunk_totals
+            else:
+                reference = reference.add(chunk_totals, fill_value=0)
+            chunk_dtypes = compact.plan(chunk)
+            dtypes = compact.widen(dtypes, chunk_dtypes)
+            chunks.append(compact.compact(chunk, chunk_dtypes))
+    if not chunks:
+        raise IOError("no files match {}".format(pattern))
+    chunks = [compact.compact(chunk, dtypes) for chunk in chunks]
+    unify_categories(chunks)
+    df = pd.concat(chunks, ignore_index=True)
+    compact.validate(df, reference)
+    del chunks
+    elapsed = time.time() - start
+    if verbose:
+        print(
+            "{:,} rows in {:.1f}s ({:,.0f} rows/sec), peak memory {:.0f}MB".format(
+                len(df), elapsed, len(df) / elapsed, peak_memory() / 1e6
+            )
+        )
+    return df
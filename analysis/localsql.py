@@ -0,0 +1,197 @@
+"""Run the BigQuery extraction queries locally, with DuckDB over Parquet.
+
+With Parquet copies of the source tables laid out by dataset,
+
+    bq/hscic/normalised_prescribing_standard.parquet   (or a directory of parts)
+    bq/hscic/practice_statistics_all_years.parquet
+    bq/hscic/practices.parquet
+    bq/hscic/ccgs.parquet
+    bq/richard/opioid_converter.parquet
+    bq/helen/trends_from_pca_final_2017.parquet
+    bq/helen/opioid_prescribing_2010_2018.parquet
+
+each table is a view named as in BigQuery, and the notebook's SQL runs
+unchanged after `translate` shims the BigQuery dialect:
+
+    the `ebmdatalab.` project prefix and backticks are dropped
+    REGEXP_EXTRACT(x, r'...') becomes regexp_extract(x, '...', 1)
+    double-quoted string literals become single-quoted
+    GROUP BY names of SELECT aliases become their positions, as DuckDB
+    doesn't resolve a name to the alias when it is also an input column
+
+Setting OPIOIDS_LOCAL_DATA to the directory makes `caching.cached_read` and
+`caching.cached_shards` rebuild missing extracts this way instead of
+from BigQuery:
+
+    OPIOIDS_LOCAL_DATA=bq jupyter notebook
+"""
+import glob
+import os
+import re
+import time
+
+import pandas as pd
+
+data_directory = os.environ.get("OPIOIDS_LOCAL_DATA")
+
+# BigQuery dataset and table of each source table
+tables = [
+    ("hscic", "normalised_prescribing_standard"),
+    ("hscic", "practice_statistics_all_years"),
+    ("hscic", "practices"),
+    ("hscic", "ccgs"),
+    ("richard", "opioid_converter"),
+    ("helen", "trends_from_pca_final_2017"),
+    ("helen", "opioid_prescribing_2010_2018"),
+]
+
+
+def _parquet(directory, dataset, table):
+    "Path or glob of the Parquet copy of a table, or None if there isn't one"
+    path = os.path.join(directory, dataset, table)
+    if os.path.isdir(path):
+        return os.path.join(path, "*.parquet")
+    if os.path.exists(path + ".parquet"):
+        return path + ".parquet"
+    return None
+
+
+def connect(directory=None):
+    "DuckDB connection with a view for each table with a Parquet copy in `directory`"
+    import duckdb
+
+    directory = directory or data_directory
+    con = duckdb.connect()
+    for dataset, table in tables:
+        path = _parquet(directory, dataset, table)
+        if path is None:
+            continue
+        con.execute("CREATE SCHEMA IF NOT EXISTS {}".format(dataset))
+        con.execute("CREATE VIEW {}.{} AS SELECT * FROM read_parquet('{}')".format(dataset, table, path))
+    return con
+
+
+_clause = re.compile(r"\b(SELECT|FROM|GROUP\s+BY|HAVING|ORDER\s+BY|LIMIT|UNION|WINDOW|QUALIFY)\b|[(),]", re.IGNORECASE)
+_string = re.compile(r"'(?:[^'\\]|\\.)*'|\"((?:[^\"\\]|\\.)*)\"")
+_regexp_extract = re.compile(r"REGEXP_EXTRACT\s*\(\s*([^,]+?)\s*,\s*r?'((?:[^'\\]|\\.)*)'\s*\)", re.IGNORECASE)
+
+
+def _without_comments(sql):
+    "`sql` with comments removed, leaving string literals alone"
+    return re.sub(
+        r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|--[^\n]*|#[^\n]*",
+        lambda m: m.group(0) if m.group(0)[0] in "'\"" else "",
+        sql,
+    )
+
+
+def _output_name(item):
+    "Name of the column a SELECT list item gives, if it has one"
+    item = re.sub(r"^\s*DISTINCT\s+", "", item.strip(), flags=re.IGNORECASE)
+    match = re.search(r"\bAS\s+(\w+)$", item, re.IGNORECASE) or re.match(r"^(?:\w+\.)*(\w+)$", item)
+    return match.group(1).lower() if match else None
+
+
+def _spans(start, stop, commas):
+    "(start, stop) of each comma separated item between `start` and `stop`"
+    bounds = [start] + [c for c in commas if start <= c < stop] + [stop]
+    return [(a + (i > 0), b) for i, (a, b) in enumerate(zip(bounds[:-1], bounds[1:]))]
+
+
+def _group_by_ordinals(sql):
+    """Replace names in GROUP BY clauses that are also SELECT aliases with
+    the alias's position. BigQuery resolves such names to the alias, where
+    DuckDB finds them ambiguous, e.g. `GROUP BY pct` with `COALESCE(p.pct,
+    q2.pct) AS pct` and two tables with a pct column.
+    """
+    # clause keywords, commas and closing parentheses, with their depth;
+    # string literals are blanked so their contents aren't matched
+    masked = re.sub(r"'(?:[^'\\]|\\.)*'", lambda m: "'" + " " * (len(m.group(0)) - 2) + "'", sql)
+    tokens, depth = [], 0
+    for m in _clause.finditer(masked):
+        token = re.sub(r"\s+", " ", m.group(0).upper())
+        if token == "(":
+            depth += 1
+            continue
+        tokens.append((depth, token, m.start(), m.end()))
+        if token == ")":
+            depth -= 1
+
+    edits = []
+    for i, (level, token, _, select_end) in enumerate(tokens):
+        if token != "SELECT":
+            continue
+        # this SELECT's own tokens, up to the end of its query
+        own, stop = [], len(sql)
+        for other in tokens[i + 1:]:
+            if other[0] < level or (other[0] == level and other[1] in (")", "SELECT", "UNION")):
+                stop = other[2]
+                break
+            if other[0] == level:
+                own.append(other)
+        clauses = [t for t in own if t[1] != ","]
+        commas = [t[2] for t in own if t[1] == ","]
+        if [t[1] for t in clauses[:1]] != ["FROM"]:
+            continue
+        names = [_output_name(sql[a:b]) for a, b in _spans(select_end, clauses[0][2], commas)]
+        for j, clause in enumerate(clauses):
+            if clause[1] != "GROUP BY":
+                continue
+            group_end = clauses[j + 1][2] if j + 1 < len(clauses) else stop
+            for a, b in _spans(clause[3], group_end, commas):
+                name = sql[a:b].strip().lower()
+                if re.match(r"^\w+$", name) and name in names:
+                    edits.append((a, b, re.sub(r"\w+", str(names.index(name) + 1), sql[a:b], count=1)))
+
+    for a, b, text in sorted(edits, reverse=True):
+        sql = sql[:a] + text + sql[b:]
+    return sql
+
+
+def translate(sql):
+    "The BigQuery standard SQL `sql` in DuckDB's dialect"
+    sql = _without_comments(sql).replace("`", "")
+    sql = re.sub(r"\bebmdatalab\.", "", sql)
+    # BigQuery returns the first capturing group; raw strings need no escaping
+    sql = _regexp_extract.sub(lambda m: "regexp_extract({}, '{}', 1)".format(m.group(1), m.group(2)), sql)
+    # double quotes delimit strings in BigQuery and identifiers in DuckDB
+    sql = _string.sub(
+        lambda m: m.group(0) if m.group(1) is None else "'{}'".format(m.group(1).replace("'", "''")), sql
+    )
+    return _group_by_ordinals(sql)
+
+
+def run(sql, con=None, verbose=True):
+    "Result of the BigQuery query `sql`, run locally, printing the time taken"
+    con = con or connect()
+    start = time.time()
+    result = con.sql(translate(sql))
+    df = result.df()
+    for col, type_ in zip(result.columns, result.types):
+        if str(type_).startswith("TIMESTAMP") and "TIME ZONE" not in str(type_):  # BigQuery timestamps are UTC
+            df[col] = df[col].dt.tz_localize("UTC")
+    if verbose:
+        print("{:,} rows in {:.1f}s".format(len(df), time.time() - start))
+    return df
+
+
+def cached_read(sql, csv_path, con=None):
+    "As `bq.cached_read`, but running `sql` locally when `csv_path` doesn't exist"
+    if os.path.exists(csv_path):
+        return pd.read_csv(csv_path)
+    print("running query for {} locally".format(csv_path))
+    df = run(sql, con)
+    df.to_csv(csv_path, index=False)
+    return df
+
+
+def write_shards(sql, pattern="opioid*gz", rows=1000000, con=None):
+    """Run `sql` locally and write its result in gzipped CSV shards of
+    `rows` rows, named after `pattern` (e.g. opioid_000.csv.gz), as exported
+    from BigQuery.
+    """
+    df = run(sql, con)
+    prefix = pattern.split("*")[0].rstrip("_")
+    for i, start in enumerate(range(0, max(len(df), 1), rows)):
+        df.iloc[start:start + rows].to_csv("{}_{:03d}.csv.gz".format(prefix, i), index=False)
+    return sorted(glob.glob(pattern))
@@ -0,0 +1,98 @@
+"""Calculated fields for the practice-level data, e.g. total OME per 1000."""
+import numpy as np
+import pandas as pd
+
+from compact import decode
+from listsizes import join_list_sizes
+
+# chemical whose share of high dose OME is mapped, and the share's column
+high_dose_shares = {
+    "Fentanyl": "% Fentanyl of high dose OME",
+    "Morphine Sulfate": "% Morphine of high dose OME",
+    "Oxycodone Hydrochloride": "% Oxycodone of high dose OME",
+}
+
+
+def add_flag_columns(df):
+    "Add items, OME and cost columns for long acting and high dose rows only"
+    la = (df["Is_LA"] == True).fillna(False)  # noqa: E712
+    high = (df["Is_High_LA"] == True).fillna(False)  # noqa: E712
+    df.loc[la, "Items Long Acting"] = df["items"]
+    df.loc[high, "Items High Dose"] = df["items"]
+    df.loc[la, "OME Long Acting"] = df["total_ome"]
+    df.loc[high, "OME High Dose"] = df["total_ome"]
+    df.loc[la, "Cost Long Acting"] = df["actual_cost"]
+    df.loc[high, "Cost High Dose"] = df["actual_cost"]
+    return df
+
+
+def add_rates(df):
+    "Add percentages high dose, and measures per 1000 patients on the list"
+    df["Percent high dose (by OME)"] = 100*df["OME High Dose"]/df["OME Long Acting"]
+    df["Percent high dose (by items)"] = 100*df["Items High Dose"]/df["Items Long Acting"]
+    df["Total OME (per 1000)"] = 1000*df["Total OME"]/df.total_list_size
+    df["Total items (per 1000)"] = 1000*df["Total Items"]/df.total_list_size
+    df["Total cost (per 1000)"] = 1000*df["Total Cost"]/df.total_list_size
+    df["Cost high dose opioids (per 1000)"] = 1000*df["Cost High Dose"]/df.total_list_size
+    df["High dose items (per 1000)"] = 1000*df["Items High Dose"]/df.total_list_size
+    df["Long acting items (per 1000)"] = 1000*df["Items Long Acting"]/df.total_list_size
+    df["High dose OME (per 1000)"] = 1000*df["OME High Dose"]/df.total_list_size
+    df["Long acting OME (per 1000)"] = 1000*df["OME Long Acting"]/df.total_list_size
+    return df
+
+
+def practice_measures(df1, pop):
+    """Practice measures for each row of `df1`, joined to the practice's list
+    size that month. Rows without a list size are dropped. `pop` is the list
+    size table or an index of it from `listsizes.index_list_sizes`.
+
+    Each row keeps `pct`, the CCG it was prescribed under that month.
+    """
+    df = decode(df1)  # costs are held as pence in df1
+
+    # tidy data
+    df = df.drop(["quantity", "net_cost"], axis=1).reset_index(drop=True)
+    df = add_flag_columns(df)
+
+    df2 = df.rename(columns={"total_ome": "Total OME",
+                             "items": "Total Items",
+                             "actual_cost": "Total Cost"})
+
+    df2 = join_list_sizes(df2, pop)
+    add_rates(df2)
+    df2["Cost high dose opioids (per item)"] = df2["Cost High Dose"]/df2["Items High Dose"]
+    return df2
+
+
+def ccg_list_sizes(pop, start):
+    "Mean monthly list size of each CCG over the months after `start`"
+    popccg = pop.loc[pop["month"] > start]
+    popccg = popccg.groupby(["CCG", "month"])["total_list_size"].sum()  # sum across CCGs
+    return pd.DataFrame(popccg.groupby("CCG").mean()).reset_index()  # average across months
+
+
+def ccg_measures(rows, popccg):
+    """CCG measures from practice-level `rows`, summed over the months they
+    cover, and CCG list sizes `popccg` averaged over the same months.
+    """
+    # group to ccg level and combine the months
+    df4 = rows.groupby(["pct", "chem_substance", "Is_LA", "Is_High_LA"], observed=True)[["items", "total_ome", "actual_cost"]].sum()
+    df4 = decode(df4).reset_index()
+    high = (df4["Is_High_LA"] == True).fillna(False).to_numpy()  # noqa: E712
+    for chem, share in high_dose_shares.items():
+        df4[share] = np.where((df4["chem_substance"] == chem) & high, df4["total_ome"], 0)
+    df4["practice_count"] = 1
+
+    # aggregate chem substances
+    df = df4.drop("chem_substance", axis=1).groupby(["pct", "Is_LA", "Is_High_LA"], observed=True).sum().reset_index()
+    df = add_flag_columns(df).drop(["Is_LA", "Is_High_LA"], axis=1)
+    df = df.groupby("pct", observed=True).sum().reset_index()
+
+    df3 = df.rename(columns={"total_ome": "Total OME",
+                             "items": "Total Items",
+                             "actual_cost": "Total Cost"})
+    df3 = df3.merge(popccg[["CCG", "total_list_size"]], right_on="CCG", left_on="pct").drop("CCG", axis=1)
+    add_rates(df3)
+    for share in high_dose_shares.values():
+        df3[share] = 100*df3[share]/df3["OME High Dose"]
+    return df3
@@ -0,0 +1,117 @@
+"""Oral morphine equivalents (OME) of prescribing by BNF code.
+
+The extraction queries join `opioid_converter` on each row and compute
+`quantity*dose_per_unit*new_ome_multiplier` in the aggregation. Here the
+converter is loaded once and indexed by BNF code: `index_converter` keeps
+one OME per unit (`dose_per_unit*new_ome_multiplier`), chemical and pair
+of LA / High-LA flags per code in arrays, and `convert` finds the position
+of each row's code, once per distinct code, and gathers from them:
+
+    converter = index_converter(cached_read(converter_sql, "opioid_converter.csv"))
+    rx = convert(rx, converter)        # adds total_ome and the flags
+    df1 = aggregate(rx, converter)     # as the practice-level extract
+
+`index_converter` takes alternative multipliers, by chemical or by BNF
+code, and `high_dose` redraws the high dose flags at another daily OME
+threshold, so neither needs a new extract.
+"""
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+import compact
+from loading import as_boolean
+
+Converter = namedtuple("Converter", ["codes", "chem_substance", "ome_per_unit", "is_la", "is_high_la", "daily_ome"])
+
+converter_sql = "SELECT * FROM ebmdatalab.richard.opioid_converter"
+
+# columns of the converter a conversion depends on
+columns = ["bnf_code", "chem_substance", "Is_LA", "Is_High_LA", "dose_per_unit", "new_ome_multiplier", "LA_daily_OME"]
+
+
+def index_converter(converter, multipliers=None):
+    """Per BNF code arrays of `converter` (the opioid_converter table).
+
+    `multipliers` replaces `new_ome_multiplier`: a Series indexed by
+    `bnf_code` or by `chem_substance`, as its index is named; codes it
+    doesn't cover keep their multiplier. `LA_daily_OME` is scaled to the
+    new multipliers. Raises ValueError if a code has
+    more than one conversion.
+    """
+    converter = converter[[col for col in columns if col in converter]].drop_duplicates()
+    if converter["bnf_code"].duplicated().any():
+        raise ValueError("more than one conversion for BNF codes {}".format(
+            sorted(converter.loc[converter["bnf_code"].duplicated(), "bnf_code"].unique())
+        ))
+    original = converter["new_ome_multiplier"].astype("float64")
+    multiplier = original
+    if multipliers is not None:
+        key = "bnf_code" if multipliers.index.name == "bnf_code" else "chem_substance"
+        multiplier = converter[key].map(multipliers).astype("float64").fillna(original)
+    daily_ome = converter["LA_daily_OME"] if "LA_daily_OME" in converter else pd.Series(np.nan, index=converter.index)
+    daily_ome = daily_ome.astype("float64") * multiplier / original
+    return Converter(
+        pd.Index(converter["bnf_code"]),
+        pd.Categorical(converter["chem_substance"]),
+        converter["dose_per_unit"].to_numpy(dtype="float64") * multiplier.to_numpy(),
+        as_boolean(converter["Is_LA"]).array,
+        as_boolean(converter["Is_High_LA"]).array,
+        daily_ome.to_numpy(dtype="float64", na_value=np.nan),
+    )
+
+
+def high_dose(converter, threshold):
+    """`converter` with long acting codes whose daily OME is at least
+    `threshold` mg flagged as high dose. Codes without a daily OME keep
+    their flag.
+    """
+    known = ~np.isnan(converter.daily_ome)
+    flags = converter.is_high_la.copy()
+    flags[known] = converter.is_la[known] & (converter.daily_ome[known] >= threshold)
+    return converter._replace(is_high_la=flags)
+
+
+def positions(converter, bnf_code):
+    "Position of each of `bnf_code` in the converter, or -1 if it isn't there"
+    if isinstance(bnf_code.dtype, pd.CategoricalDtype):
+        ids = converter.codes.get_indexer(bnf_code.cat.categories)
+        codes = bnf_code.cat.codes.to_numpy()
+    else:
+        codes, uniques = pd.factorize(bnf_code)
+        ids = converter.codes.get_indexer(uniques)
+    return np.where(codes >= 0, np.append(ids, -1)[codes], -1)
+
+
+def convert(df, converter, quantity="quantity"):
+    """Copy of `df` with the chemical, LA and High-LA flags and `total_ome`
+    of each row from its `bnf_code`. Rows whose code isn't in the converter
+    have missing values, as a left join with it.
+    """
+    ids = positions(converter, df["bnf_code"])
+    missing = ids < 0
+    df = df.copy()
+    df["chem_substance"] = converter.chem_substance.take(ids, allow_fill=True)
+    for col, flags in [("Is_LA", converter.is_la), ("Is_High_LA", converter.is_high_la)]:
+        df[col] = flags.take(ids, allow_fill=True)
+    factor = np.where(missing, np.nan, converter.ome_per_unit[ids])
+    df["total_ome"] = compact.decode_column(df[quantity]).to_numpy() * factor
+    return df
+
+
+def aggregate(df, converter, by=("pct", "practice", "status_code", "month"), quantity="quantity"):
+    """Rows of `df` by BNF code converted and summed by `by` and the
+    chemical and flags, as in the practice-level extract, with the numeric
+    columns compacted.
+    """
+    df = convert(df, converter, quantity)
+    keys = [col for col in by if col in df] + ["chem_substance", "Is_LA", "Is_High_LA"]
+    values = [col for col in compact.kinds if col in df]
+    # grouped by the codes of the keys, as pandas drops missing categories
+    # with observed=True whatever dropna is
+    factorized = [pd.factorize(df[col], use_na_sentinel=False) for col in keys]
+    summed = compact.decode(df[values]).groupby([codes for codes, _ in factorized], sort=False).sum(min_count=1)
+    for level, (col, (_, uniques)) in enumerate(zip(keys, factorized)):
+        summed[col] = uniques.take(summed.index.get_level_values(level))
+    return compact.compact(summed[keys + values].reset_index(drop=True))
@@ -0,0 +1,48 @@
+"""Filters on practices and CCGs, evaluated once per distinct value.
+
+The organisation columns (`pct`, `status_code`, and `setting` in the
+practice setting extract) have a few hundred distinct values at most, so
+each rule in `rules` is evaluated once per distinct value and the result
+broadcast to the rows by the column's codes, rather than once per row:
+
+    standard = select(df1, "standard_ccg", "active")
+"""
+import re
+
+import numpy as np
+import pandas as pd
+
+standard_ccg_code = re.compile(r"([0-9]{2})([A-Za-z])")
+
+# column each rule tests, and the test of one value of it
+rules = {
+    "standard_ccg": ("pct", lambda code: standard_ccg_code.match(code) is not None),  # e.g. 00C
+    "active": ("status_code", lambda status: status == "A"),
+    "closed": ("status_code", lambda status: status == "C"),
+    "dormant": ("status_code", lambda status: status == "D"),
+    "gp": ("setting", lambda setting: setting == 4),  # GP practices
+}
+
+
+def evaluate(col, test):
+    "`test` of each value of `col`, calling it once per distinct value; missing values fail"
+    if isinstance(col.dtype, pd.CategoricalDtype):
+        codes, uniques = col.cat.codes.to_numpy(), col.cat.categories
+    else:
+        codes, uniques = pd.factorize(col)
+    passed = np.array([bool(test(value)) for value in uniques] + [False])
+    return passed[codes]  # code -1, a missing value, takes the trailing False
+
+
+def mask(df, *names):
+    "Boolean array of the rows of `df` passing all of the `rules` in `names`"
+    passed = np.ones(len(df), dtype=bool)
+    for name in names:
+        col, test = rules[name]
+        passed &= evaluate(df[col], test)
+    return passed
+
+
+def select(df, *names):
+    "Rows of `df` passing all of the `rules` in `names`"
+    return df.loc[mask(df, *names)]
@@ -0,0 +1,107 @@
+"""Render every figure for the paper from data saved by the notebook.
+
+The notebook saves the tables the figures are drawn from with
+`save_figure_data`. This script then draws each figure in its own worker
+process, with the Agg backend, and writes it in each requested format:
+
+    python render.py [--data figure_data.pickle] [--out figures]
+                     [--formats pdf png] [--dpi 300] [--processes N]
+"""
+import argparse
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import matplotlib
+
+matplotlib.use("Agg")
+matplotlib.rcParams["pdf.fonttype"] = 42
+matplotlib.rcParams["ps.fonttype"] = 42
+
+import matplotlib.pyplot as plt  # noqa: E402
+
+import figures  # noqa: E402
+
+
+def _stacked_area(name):
+    return lambda data: figures.stacked_area_figure(data["agg"], name)
+
+
+def _map(plot, table):
+    return lambda data: plot(data[table])
+
+
+# file name (without extension) and how to draw each figure from the saved data
+FIGURES = {
+    "opioids_Figure1_revisedv2": _stacked_area("all"),
+    "opioids_Figure2_revised": _stacked_area("high_dose"),
+    "opioids_long_acting": _stacked_area("long_acting"),
+    "opioids_expand_other": _stacked_area("expand_other"),
+    "opioids_low_dose": _stacked_area("low_dose"),
+    "opioids_Figure3ad_revised": _map(figures.plot_maps, "spending2"),
+    "opioids_Figure3eg_revised": _map(figures.plot_share_maps, "spending2"),
+    "opioids_Figure3ag_revised": lambda data: figures.plot_map_figure(data["spending2"], "all_maps"),
+    "opioids_Figure4_revised": lambda data: figures.plot_deciles(data["dec"]),
+    "opioids_ccg_change": _map(figures.plot_change_map, "change2"),
+    "opioids_ccg_change_12_months": _map(figures.plot_change_map, "change_window"),
+    "opioids_ccg_change_2018_ccgs": _map(figures.plot_change_map, "change2_2018"),
+}
+
+_data = None
+
+
+def save_figure_data(path="figure_data.pickle", **tables):
+    """Save the tables the figures are drawn from: `agg` (the stacked area
+    aggregate of `dfl`), `dec` (practice deciles), and `spending2`,
+    `change2`, `change_window` (the latest 12 months on the 12 before) and
+    `change2_2018` (on the April 2018 CCGs), the CCG measures indexed by
+    CCG name.
+    """
+    with open(path, "wb") as f:
+        pickle.dump(tables, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _load(path):
+    global _data
+    with open(path, "rb") as f:
+        _data = pickle.load(f)
+
+
+def render(name, out="figures", formats=("pdf", "png"), dpi=300):
+    "Draw one figure and save it in each format; returns the seconds taken"
+    start = time.time()
+    fig = FIGURES[name](_data)
+    for fmt in formats:
+        fig.savefig(os.path.join(out, "{}.{}".format(name, fmt)), transparent=True, dpi=dpi)
+    plt.close(fig)
+    return time.time() - start
+
+
+def render_all(data="figure_data.pickle", out="figures", formats=("pdf", "png"), dpi=300, names=None, processes=None):
+    """Render the figures in `names` (default all) in a process pool,
+    printing the time taken by each one and overall.
+    """
+    if not os.path.exists(out):
+        os.makedirs(out)
+    start = time.time()
+    with ProcessPoolExecutor(processes, initializer=_load, initargs=(data,)) as pool:
+        futures = {
+            pool.submit(render, name, out, formats, dpi): name
+            for name in names or FIGURES
+        }
+        for future in as_completed(futures):
+            print("{}: {:.1f}s".format(futures[future], future.result()))
+    print("all figures: {:.1f}s".format(time.time() - start))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("names", nargs="*", help="figures to render (default all)")
+    parser.add_argument("--data", default="figure_data.pickle")
+    parser.add_argument("--out", default="figures")
+    parser.add_argument("--formats", nargs="+", default=["pdf", "png"])
+    parser.add_argument("--dpi", type=int, default=300)
+    parser.add_argument("--processes", type=int)
+    args = parser.parse_args()
+    render_all(args.data, args.out, args.formats, args.dpi, args.names, args.processes)
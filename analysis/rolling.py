@@ -0,0 +1,107 @@
+"""Sums and means over windows of N months, at any window end.
+
+`cumulate` sums the values of each group (e.g. each CCG, or each CCG and
+chemical) for every month and takes cumulative sums along the months, in
+one pass over the data. The sum over any window is then the difference of
+two cumulative sums, so `window_sums` and `window_means` can be asked for
+any window length and end month without going back to the rows:
+
+    ome = cumulate(ccg, ["pct", "type"], ["total_ome"])
+    window_sums(ome, months=6)                     # latest 6 months
+    window_sums(ome, months=6, end="2017-06-01")   # 6 months to June 2017
+
+`in_window` is the matching row filter, for data that isn't summed.
+"""
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+Rolling = namedtuple("Rolling", ["keys", "months", "values", "sums", "counts"])
+
+
+def _month_numbers(months):
+    months = pd.DatetimeIndex(months)
+    return np.asarray(months.year * 12 + months.month - 1, dtype="int64")
+
+
+def _groups(df, by):
+    """Group number of each row of `df` by the columns `by`, and the keys of
+    the groups with rows, sorted with missing values last, as
+    `groupby(by, observed=True, dropna=False)` numbers them.
+
+    pandas 1.5 numbers the rows with a missing categorical key NaN, so the
+    groups are numbered from the codes of each column instead.
+    """
+    codes, uniques = [], []
+    for col in by:
+        col_codes, col_uniques = pd.factorize(df[col], sort=True)
+        codes.append(np.where(col_codes < 0, len(col_uniques), col_codes))  # missing values last
+        uniques.append(col_uniques.insert(len(col_uniques), np.nan))
+    shape = [len(col_uniques) for col_uniques in uniques]
+    ids, present = pd.factorize(np.ravel_multi_index(codes, shape), sort=True)
+    levels = [col_uniques.take(level) for col_uniques, level in zip(uniques, np.unravel_index(present, shape))]
+    if len(by) == 1:
+        return ids, levels[0].rename(by[0])
+    return ids, pd.MultiIndex.from_arrays(levels, names=by)
+
+
+def cumulate(df, by, values, month="month"):
+    """Cumulative monthly sums of `values` in `df` for each group of `by`.
+
+    `sums` is a (group x month x value) array with a leading month of zeros,
+    and `counts` the cumulative number of months each group has rows in.
+    Rows with missing keys make groups of their own.
+    """
+    ids, keys = _groups(df, by)
+    numbers = _month_numbers(df[month])
+    start = numbers.min()
+    width = numbers.max() - start + 1
+    cells = ids * (width + 1) + (numbers - start + 1)
+    size = len(keys) * (width + 1)
+    sums = np.stack([
+        np.bincount(cells, weights=df[value].to_numpy(dtype="float64", na_value=0), minlength=size)
+        for value in values
+    ], axis=-1).reshape(len(keys), width + 1, len(values))
+    counts = np.bincount(np.unique(cells), minlength=size).reshape(len(keys), width + 1)
+    first = df[month].min()
+    months = pd.date_range(first - pd.DateOffset(days=first.day - 1), periods=width, freq="MS")
+    return Rolling(keys, months, list(values), sums.cumsum(axis=1), counts.cumsum(axis=1))
+
+
+def _bounds(rolling, months, end):
+    "Positions in the cumulative arrays before and at the end of the window"
+    if end is None:
+        stop = len(rolling.months)
+    else:
+        stop = int(_month_numbers([pd.Timestamp(end)])[0] - _month_numbers(rolling.months[:1])[0]) + 1
+    start = stop - months
+    return min(max(start, 0), len(rolling.months)), min(max(stop, 0), len(rolling.months))
+
+
+def window_sums(rolling, months=6, end=None):
+    """Sums of each group over the `months` months up to `end` (default the
+    latest month), for the groups with rows in the window.
+    """
+    start, stop = _bounds(rolling, months, end)
+    present = rolling.counts[:, stop] > rolling.counts[:, start]
+    sums = rolling.sums[present, stop] - rolling.sums[present, start]
+    return pd.DataFrame(sums, index=rolling.keys[present], columns=rolling.values)
+
+
+def window_means(rolling, months=6, end=None):
+    "Monthly means of each group over the months it has rows in the window"
+    start, stop = _bounds(rolling, months, end)
+    present = rolling.counts[:, stop] > rolling.counts[:, start]
+    sums = window_sums(rolling, months, end)
+    return sums.div(rolling.counts[present, stop] - rolling.counts[present, start], axis=0)
+
+
+def in_window(month, months=6, end=None):
+    "Whether each of `month` is in the `months` months up to `end` (default the latest)"
+    if end is None:
+        end = month.max()
+    end = pd.Timestamp(end)
+    if end.tz is None and getattr(month.dtype, "tz", None) is not None:
+        end = end.tz_localize(month.dtype.tz)
+    return (month > end - pd.DateOffset(months=months)) & (month <= end)
@@ -0,0 +1,116 @@
+"""Potential savings if practices prescribed at target levels.
+
+Each scenario in `scenarios` compares an actual value of each practice
+(e.g. the cost of high dose opioids) with a target: a percentile of a rate
+(e.g. cost per 1000 patients) among practices that month, times the
+practice's list size or items. The percentile can be taken over all
+practices, within each CCG or within each chemical. `savings` evaluates
+every scenario in one pass over the rows of `df2`: the target percentiles
+of each rate are computed together, and the savings are summed by scenario
+and CCG with one `bincount`.
+
+A practice's potential saving is its actual value less the target, or
+nothing if it is already below the target.
+"""
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+from deciles import deciles
+from rolling import in_window
+
+Savings = namedtuple("Savings", ["actual", "potential"])
+
+# actual value, rate of the target, the column the rate is per (and per
+# how many), the percentile of the rate used as the target, and whether
+# the percentile is taken within each "ccg" or "chem_substance"
+scenarios = {
+    "high dose items": {
+        "actual": "Items High Dose",
+        "rate": "High dose items (per 1000)",
+        "basis": ("total_list_size", 1000),
+        "percentile": 0.1,
+    },
+    "high dose cost": {
+        "actual": "Cost High Dose",
+        "rate": "Cost high dose opioids (per 1000)",
+        "basis": ("total_list_size", 1000),
+        "percentile": 0.1,
+    },
+    "high dose cost at cost per item": {
+        "actual": "Cost High Dose",
+        "rate": "Cost high dose opioids (per item)",
+        "basis": ("Items High Dose", 1),
+        "percentile": 0.1,
+    },
+}
+
+
+def target_groups(df, within, ccg):
+    "Group number of each row: its month, and its CCG or chemical if `within`"
+    month = pd.factorize(df["month"], sort=True)[0]
+    if within is None:
+        return month
+    other = pd.factorize(ccg if within == "ccg" else df[within], sort=True)[0]  # missing values are -1
+    return month * (other.max() + 2) + other + 1
+
+
+def targets(df, scenarios=scenarios, ccg=None):
+    """(scenario x row) array of the target rate of each row. Targets that
+    can't be calculated, because no practice in the group has the rate,
+    are 0.
+    """
+    specs = list(scenarios.values())
+    result = np.zeros((len(specs), len(df)))
+    rates = {}
+    for i, spec in enumerate(specs):
+        rates.setdefault((spec["rate"], spec.get("within")), []).append(i)
+    # one percentile calculation per rate and grouping, for all its percentiles
+    for (rate, within), rows in rates.items():
+        group = target_groups(df, within, ccg)
+        percentiles = sorted({specs[i]["percentile"] for i in rows})
+        dec = deciles(pd.DataFrame({"group": group, rate: df[rate].to_numpy()}), [rate], percentiles, by="group")
+        codes = pd.factorize(group, sort=True)[0]
+        for i in rows:
+            result[i] = dec.values[codes, 0, percentiles.index(specs[i]["percentile"])]
+    return np.nan_to_num(result)
+
+
+def savings(df, scenarios=scenarios, ccg="pct", months=6, end=None):
+    """Actual values and potential savings of each of `scenarios`, summed
+    by CCG, over the `months` months of `df` up to `end` (default the latest).
+
+    `ccg` is the column of `df` holding the CCG each row was prescribed
+    under; with `ccg=None` everything is summed as one column, "All".
+    """
+    window = np.asarray(in_window(df["month"], months, end))
+    df = df.loc[window]
+    ccg = np.full(len(df), "All", dtype=object) if ccg is None else df[ccg].to_numpy(dtype=object)
+
+    target = targets(df, scenarios, ccg)
+    specs = list(scenarios.values())
+    actual = np.stack([df[spec["actual"]].to_numpy(dtype="float64", na_value=np.nan) for spec in specs])
+    basis = np.stack([
+        df[spec["basis"][0]].to_numpy(dtype="float64", na_value=np.nan) / spec["basis"][1] for spec in specs
+    ])
+    potential = np.nan_to_num(np.clip(actual - basis * target, 0, None))
+    actual = np.nan_to_num(actual)
+
+    codes, ccgs = pd.factorize(pd.Series(ccg).fillna("unknown"), sort=True)
+    cells = (np.arange(len(specs))[:, None] * len(ccgs) + codes[None, :]).ravel()
+
+    def matrix(values):
+        sums = np.bincount(cells, weights=values.ravel(), minlength=len(specs) * len(ccgs))
+        return pd.DataFrame(
+            sums.reshape(len(specs), len(ccgs)),
+            index=pd.Index(list(scenarios), name="scenario"),
+            columns=pd.Index(ccgs, name="ccg"),
+        )
+
+    return Savings(matrix(actual), matrix(potential))
+
+
+def totals(result):
+    "Actual value and potential saving of each scenario, over all CCGs"
+    return pd.DataFrame({"actual_value": result.actual.sum(axis=1), "potential_saving": result.potential.sum(axis=1)})
@@ -0,0 +1,111 @@
+"""Sensitivity of the results to the OME multipliers and high dose threshold.
+
+The high dose flags and multipliers are fixed in `opioid_converter`, and
+so in the practice-level extract. Here they are redrawn locally for each
+point of a grid of daily OME thresholds (see `ome.high_dose`) and sets of
+multipliers (see `ome.index_converter`), from one extract of practice
+prescribing by BNF code:
+
+    rows = by_bnf_code(rx)      # summed once by CCG, status, month and code
+    result = sensitivity(rows, converter, ccg_pop, thresholds=(90, 120))
+    result.ccg.loc[(90, "converter")]
+
+For each grid point the rows are converted and summed to the CCG cube
+(`cube.build_cube`'s grain), from which the summary tables by year and by
+chemical and the CCG measures over the latest months are calculated. The
+points run in a process pool, each worker holding the rows once.
+"""
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+import itertools
+
+import numpy as np
+import pandas as pd
+
+import compact
+from cube import ccg_measures_at, rolling_ccg_sums
+from ome import aggregate, high_dose, index_converter
+from summary import summary_tables
+
+Sensitivity = namedtuple("Sensitivity", ["by_year", "by_chemical", "ccg"])
+
+# the CCG cube's grain, less the converter's columns
+by = ["pct", "status_code", "month"]
+
+# summary table measures, as totals rather than per 1000
+totals = {
+    "OME": "total_ome",
+    "Items": "items",
+    "Cost": "actual_cost",
+}
+
+
+def by_bnf_code(rx):
+    "Sums of the practice prescribing `rx` by CCG, practice status, month and BNF code"
+    values = [col for col in compact.kinds if col in rx]
+    sums = compact.decode(rx).groupby(by + ["bnf_code"], observed=True)[values].sum(min_count=1)
+    return compact.compact(sums.reset_index())
+
+
+def _summary(cube):
+    "Summary tables by year and by chemical of a CCG cube"
+    dfl = compact.decode(cube)
+    dfl["year"] = dfl["month"].dt.year
+    dfl["Is_LA"] = dfl["Is_LA"].fillna(False).astype(bool)
+    dfl["Is_High_LA"] = np.where(dfl["Is_High_LA"].fillna(False), "High dose", "Others")
+    return summary_tables(dfl, [["year"], ["chem_substance"]], measures=totals)
+
+
+def point(rows, converter, list_sizes, threshold=None, multipliers=None, months=6, end=None):
+    """Summary tables and CCG measures at one grid point: `converter` (the
+    opioid_converter table) with `multipliers`, and high dose flags at
+    `threshold` mg daily OME, or as in the converter if None.
+    """
+    indexed = index_converter(converter, multipliers)
+    if threshold is not None:
+        indexed = high_dose(indexed, threshold)
+    cube = aggregate(rows, indexed, by=by)
+    by_year, by_chemical = _summary(cube)
+    ccg = ccg_measures_at(rolling_ccg_sums(cube, list_sizes), months, end).set_index("pct")
+    return by_year, by_chemical, ccg
+
+
+_data = None
+
+
+def _load(data):
+    global _data
+    _data = data
+
+
+def _point(threshold, name):
+    data = _data
+    return point(
+        data["rows"], data["converter"], data["list_sizes"], threshold, data["multiplier_sets"][name],
+        data["months"], data["end"],
+    )
+
+
+def sensitivity(rows, converter, list_sizes, thresholds=(90, 120), multiplier_sets=None, months=6, end=None,
+                processes=None):
+    """Summary tables and CCG measures for every combination of `thresholds`
+    and `multiplier_sets`, each indexed by threshold and multiplier set. A
+    threshold of None keeps the converter's flags, labelled "converter".
+
+    `rows` are from `by_bnf_code`, `list_sizes` from `cube.build_list_sizes`.
+    `multiplier_sets` maps names to multipliers for `ome.index_converter`;
+    by default only the converter's own, named "converter".
+    """
+    multiplier_sets = multiplier_sets or {"converter": None}
+    grid = list(itertools.product(thresholds, multiplier_sets))
+    data = {
+        "rows": rows, "converter": converter, "list_sizes": list_sizes, "multiplier_sets": multiplier_sets,
+        "months": months, "end": end,
+    }
+    with ProcessPoolExecutor(processes, initializer=_load, initargs=(data,)) as pool:
+        results = list(pool.map(_point, *zip(*grid)))
+    keys = [("converter" if threshold is None else threshold, name) for threshold, name in grid]
+    return Sensitivity(*[
+        pd.concat([result[i] for result in results], keys=keys, names=["threshold", "multipliers"])
+        for i in range(3)
+    ])
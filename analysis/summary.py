@@ -0,0 +1,84 @@
+"""Summary tables of the long term trends data (`dfl`).
+
+Each table gives, for every measure, the total, the long acting and high
+dose parts of it, and the high dose part as a percentage of long acting.
+`aggregate` sums `dfl` once at a grain fine enough for every table wanted,
+and `rollup` then builds each table from that small aggregate.
+"""
+import pandas as pd
+
+measures = {
+    "OME per 1000": "total_ome_per_1000",
+    "Items per 1000": "items_per_1000",
+    "Cost per 1000": "cost_per_1000",
+}
+
+breakdowns = {
+    "High Dose": lambda df: df["Is_High_LA"] == "High dose",
+    "Long Acting": lambda df: df["Is_LA"] == True,  # noqa: E712
+}
+
+
+def aggregate(dfl, by, measures=measures):
+    """Sum every measure and breakdown of `dfl` by the columns in `by`.
+
+    Columns are (measure, breakdown) pairs, with "Total" for the whole.
+    """
+    parts = {}
+    masks = {name: mask(dfl).fillna(False).to_numpy() for name, mask in breakdowns.items()}
+    for measure, col in measures.items():
+        values = dfl[col].fillna(0).to_numpy()
+        parts[(measure, "Total")] = values
+        for name, mask in masks.items():
+            parts[(measure, name)] = values * mask
+    wide = pd.DataFrame(parts, index=dfl.index)
+    wide.columns = pd.MultiIndex.from_tuples(wide.columns)
+    keys = [dfl[col] for col in by]
+    return wide.groupby(keys).sum()
+
+
+def rollup(base, key, derived=None):
+    """Summary table by `key` from an `aggregate`d frame.
+
+    `derived` maps new column names to (column, mapping) pairs, so a table
+    can be grouped by a relabelling of one of the aggregated columns; rows
+    whose value is missing from the mapping are dropped.
+    """
+    index = base.index.to_frame(index=False)
+    for name, (col, mapping) in (derived or {}).items():
+        index[name] = index[col].map(mapping)
+    keys = [index[col].to_numpy() for col in key]
+    tab = base.reset_index(drop=True).groupby(keys).sum()
+    tab.index.names = key
+    for measure in tab.columns.levels[0]:
+        tab[(measure, "% High Dose")] = (
+            100 * tab[(measure, "High Dose")] / tab[(measure, "Long Acting")]
+        )
+    return tab.sort_index(axis=1, ascending=False)
+
+
+def summary_tables(dfl, keys, measures=measures, derived=None):
+    """Summary tables of `dfl` for each grouping key in `keys`, computed from
+    a single aggregation of `dfl`.
+    """
+    derived = derived or {}
+    by = []
+    for key in keys:
+        for col in key:
+            col = derived[col][0] if col in derived else col
+            if col not in by:
+                by.append(col)
+    base = aggregate(dfl, by, measures)
+    return [rollup(base, key, derived) for key in keys]
+
+
+def top_chemicals(base, year, n, measure=("OME per 1000", "Long Acting")):
+    """Map each chemical prescribed in `year` to itself if it is in the top
+    `n` by `measure` that year, otherwise to "Other".
+    """
+    ranked = base.xs(year, level="year")[measure].groupby(level="chem_substance").sum()
+    ranked = ranked.sort_values(ascending=False)
+    return pd.Series(
+        [chem if i < n else "Other" for i, chem in enumerate(ranked.index)],
+        index=ranked.index,
+    )
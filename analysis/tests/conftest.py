@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the analysis modules import each other by name, as the notebook does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,30 @@
+import numpy as np
+
+from bootstrap import draw
+
+# CCG of each of 10 practices, in no particular order
+ccg = np.array([2, 0, 1, 0, 2, 2, 1, 0, 2, 1])
+
+
+def test_draw_is_reproducible_under_a_seed_sequence():
+    first, second = (
+        [draw(np.random.default_rng(child), ccg, 20) for child in np.random.SeedSequence(2018).spawn(3)]
+        for _ in range(2)
+    )
+    for a, b in zip(first, second):
+        np.testing.assert_array_equal(a, b)
+    assert not np.array_equal(first[0], first[1])  # each child draws its own resamples
+
+
+def test_draw_resamples_practices_within_their_ccg():
+    counts = draw(np.random.default_rng(np.random.SeedSequence(2018)), ccg, 200)
+    assert counts.shape == (200, len(ccg))
+    for code, size in enumerate(np.bincount(ccg)):
+        assert (counts[:, ccg == code].sum(axis=1) == size).all()
+
+
+def test_draw_picks_every_practice_of_a_ccg():
+    counts = draw(np.random.default_rng(np.random.SeedSequence(2018)), ccg, 2000)
+    assert (counts.sum(axis=0) > 0).all()
+    # each practice is drawn about once per resample on average
+    np.testing.assert_allclose(counts.mean(axis=0), 1, atol=0.1)
@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import compact
+
+
+def practice_rows(n=2000, seed=0):
+    "Rows like the practice-level extract, with costs in whole pence"
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "pct": rng.choice(["00C", "00D", "00J"], n),
+        "items": rng.integers(0, 100, n).astype("float64"),
+        "quantity": rng.integers(0, 30000, n).astype("float64"),
+        "total_ome": rng.random(n) * 1000,
+        "net_cost": rng.integers(0, 10000, n) / 100,
+        "actual_cost": rng.integers(0, 1000000, n) / 100,
+    })
+
+
+def test_plan_chooses_smallest_exact_dtypes():
+    dtypes = compact.plan(practice_rows())
+    assert dtypes["items"] == pd.Int8Dtype()
+    assert dtypes["quantity"] == pd.Int16Dtype()
+    assert dtypes["net_cost"] == pd.Int16Dtype()  # up to 9,999 pence
+    assert dtypes["actual_cost"] == pd.Int32Dtype()  # up to 999,999 pence
+    assert dtypes["total_ome"] == np.dtype("float32")
+
+
+def test_decode_round_trip():
+    df = practice_rows()
+    decoded = compact.decode(compact.compact(df))
+    for col in ["items", "quantity", "net_cost", "actual_cost"]:
+        pd.testing.assert_series_equal(decoded[col], df[col])
+    np.testing.assert_allclose(decoded["total_ome"], df["total_ome"], rtol=1e-6)
+
+
+def test_missing_values_survive_round_trip():
+    df = practice_rows(10)
+    df.loc[[2, 5], ["items", "actual_cost"]] = np.nan
+    decoded = compact.decode(compact.compact(df))
+    pd.testing.assert_series_equal(decoded["items"], df["items"])
+    pd.testing.assert_series_equal(decoded["actual_cost"], df["actual_cost"])
+
+
+def test_totals_agree_after_narrowing():
+    df = practice_rows()
+    reference = compact.totals(df)
+    compacted = compact.compact(df)
+    errors = compact.validate(compacted, reference)
+    assert (errors <= 1e-5).all()
+    pd.testing.assert_frame_equal(
+        compact.totals(compacted).drop(columns="total_ome"),
+        reference.drop(columns="total_ome"),
+    )
+
+
+def test_groupby_sums_do_not_overflow():
+    df = practice_rows()
+    compacted = compact.compact(df)
+    assert compacted["items"].dtype == pd.Int8Dtype()
+    sums = compacted.groupby("pct")[["items", "quantity", "actual_cost"]].sum()
+    expected = df.groupby("pct")[["items", "quantity"]].sum()
+    assert (sums[["items", "quantity"]] > [np.iinfo("int8").max, np.iinfo("int16").max]).all().all()
+    assert (sums[["items", "quantity"]].astype("float64") == expected).all().all()
+    assert (sums["actual_cost"].astype("float64") == (df["actual_cost"] * 100).round().groupby(df["pct"]).sum()).all()
+
+
+def test_money_is_rounded_to_whole_pence():
+    df = pd.DataFrame({"pct": ["00C", "00C"], "actual_cost": [1.234, 2.0]})
+    compacted = compact.compact(df)
+    assert compacted["actual_cost"].tolist() == [123, 200]
+    with pytest.raises(ValueError):
+        compact.validate(compacted, compact.totals(df))
+
+
+def test_validate_rejects_money_in_pounds():
+    df = practice_rows(10)
+    pounds = compact.compact(df, {"actual_cost": np.dtype("float64")})
+    with pytest.raises(ValueError, match="integer pence"):
+        compact.validate(pounds, compact.totals(df))
+
+
+def test_widen_keeps_money_integer():
+    assert compact.widen({"items": pd.Int8Dtype()}, {"items": pd.Int16Dtype()}) == {"items": pd.Int16Dtype()}
+    assert compact.widen({"items": pd.Int8Dtype()}, {"items": np.dtype("float64")}) == {"items": np.dtype("float64")}
+    widened = compact.widen({"actual_cost": pd.Int16Dtype()}, {"actual_cost": np.dtype("float64")})
+    assert widened == {"actual_cost": pd.Int64Dtype()}
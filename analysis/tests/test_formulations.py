@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from formulations import classify, formulation, like, mid_string
+
+
+@pytest.mark.parametrize("drug_name, mid", [
+    ("Morph Sulf_Tab 10mg", "Tab"),                  # text between the chemical and the strength
+    ("Oxycod HCl_Oral Soln 5mg/5ml", "Oral Soln"),
+    ("Fentanyl_Transdermal Patch", "Transdermal Patch"),  # no strength
+    ("Morph Sulf_Tab\t10mg", "Tab"),                 # RTRIM removes any trailing whitespace
+    ("Morph Sulf_Tab  \t 10mg", "Tab"),
+    ("Co-codamol_Cap 30mg/500mg", "Cap"),            # from the first underscore, up to the first digit
+    ("Diamorph HCl_Inj 5mg Amp", "Inj"),
+    ("Pethidine_Inj_Pfs 50mg", "Inj_Pfs"),
+    ("Morph Sulf_10mg/5ml", ""),
+    ("Codeine Phos", None),                          # REGEXP_EXTRACT gives NULL without a match
+    (np.nan, None),
+    (None, None),
+])
+def test_mid_string(drug_name, mid):
+    assert mid_string(drug_name) == mid
+
+
+@pytest.mark.parametrize("mid, expected", [
+    ("Tab", "Tab/Cap"),
+    ("Tab Buccal", "Lozenge/Sublingual tab"),
+    ("Disper Tab", "Lozenge/Sublingual tab"),  # listed before the Tab/Cap patterns
+    ("M/R Tab", "Tab/Cap"),                     # LIKE '%Tab'
+    ("Oral Susp S/F", "Liquid"),                # LIKE '%Susp%'
+    ("Implant", "Injectible"),
+    ("Nsl Spy", "Inhalation"),                  # LIKE '%Nsl Spy%', as % also matches nothing
+    ("Lollipop", "Lollipop"),                   # unmatched values are their own formulation
+    (None, None),
+])
+def test_formulation(mid, expected):
+    assert formulation(mid) == expected
+
+
+def test_like_matches_as_sql():
+    assert like("%Tab").match("M/R Tab")
+    assert not like("%Tab").match("Tab Buccal")
+    assert like("_ab").match("Tab")
+    assert like("100%").match("100% Cream")
+    assert like("a.b").match("a.b") and not like("a.b").match("axb")
+
+
+def test_classify_once_per_name():
+    names = pd.Series(["Morph Sulf_Tab 10mg", None, "Fentanyl_Patch 12mcg", "Morph Sulf_Tab 10mg"], dtype="category")
+    result = classify(names)
+    assert result.tolist() == ["Tab/Cap", None, "Patch", "Tab/Cap"]
+    assert result.index.equals(names.index)
@@ -0,0 +1,77 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from rolling import cumulate, in_window, window_means, window_sums
+
+
+def monthly_rows(n=500, seed=0):
+    "Rows by CCG, chemical and month, some with missing keys"
+    rng = np.random.default_rng(seed)
+    df = pd.DataFrame({
+        "pct": rng.choice(["00C", "00D", "00J", None], n),
+        "chem_substance": rng.choice(["Morphine Sulfate", "Oxycodone Hydrochloride", None], n),
+        "month": pd.to_datetime("2016-01-01") + pd.to_timedelta(rng.integers(0, 24, n) * 31, unit="D"),
+        "total_ome": rng.random(n) * 100,
+    })
+    df["month"] = df["month"].dt.to_period("M").dt.to_timestamp()
+    return df
+
+
+def expected_sums(df, by, months, end=None):
+    rows = df.loc[in_window(df["month"], months, end)]
+    keys = [rows[col].astype(object).fillna("missing") for col in by]
+    return rows.groupby(keys)[["total_ome"]].sum()
+
+
+def labelled(sums, by):
+    "`sums` with missing keys labelled as in `expected_sums`"
+    keys = sums.index.to_frame(index=False).astype(object).fillna("missing")
+    return sums.set_axis(pd.MultiIndex.from_frame(keys) if len(by) > 1 else pd.Index(keys[by[0]]), axis=0).sort_index()
+
+
+@pytest.mark.parametrize("categorical", [False, True])
+@pytest.mark.parametrize("by", [["pct"], ["pct", "chem_substance"]])
+@pytest.mark.parametrize("end", [None, "2017-06-01"])
+def test_window_sums_match_groupby(categorical, by, end):
+    df = monthly_rows()
+    if categorical:
+        df[by] = df[by].astype("category")
+    sums = window_sums(cumulate(df, by, ["total_ome"]), months=6, end=end)
+    pd.testing.assert_frame_equal(labelled(sums, by), expected_sums(df, by, 6, end), check_names=False)
+
+
+@pytest.mark.parametrize("categorical", [False, True])
+def test_missing_keys_form_their_own_groups(categorical):
+    df = pd.DataFrame({
+        "pct": ["00C", "00C", None, "00D", None],
+        "chem_substance": ["Morphine Sulfate", None, "Morphine Sulfate", "Fentanyl", "Morphine Sulfate"],
+        "month": pd.to_datetime(["2017-01-01", "2017-02-01", "2017-02-01", "2017-03-01", "2017-03-01"]),
+        "total_ome": [1.0, 2.0, 3.0, 4.0, 5.0],
+    })
+    if categorical:
+        df["pct"] = df["pct"].astype("category")
+    sums = window_sums(cumulate(df, ["pct", "chem_substance"], ["total_ome"]), months=3)
+    assert sums["total_ome"].tolist() == [1.0, 2.0, 4.0, 8.0]  # missing keys sort last
+    assert sums.index.get_level_values("pct")[:3].tolist() == ["00C", "00C", "00D"]
+    assert pd.isna(sums.index.get_level_values("pct")[3])
+
+
+def test_window_means_count_months_with_rows():
+    df = pd.DataFrame({
+        "pct": ["00C", "00C", "00D"],
+        "month": pd.to_datetime(["2017-01-01", "2017-03-01", "2017-03-01"]),
+        "total_list_size": [100.0, 200.0, 50.0],
+    })
+    means = window_means(cumulate(df, ["pct"], ["total_list_size"]), months=3)
+    assert means["total_list_size"].to_dict() == {"00C": 150.0, "00D": 50.0}
+
+
+def test_groups_without_rows_in_the_window_are_left_out():
+    df = pd.DataFrame({
+        "pct": ["00C", "00D"],
+        "month": pd.to_datetime(["2016-01-01", "2017-03-01"]),
+        "total_ome": [1.0, 2.0],
+    })
+    sums = window_sums(cumulate(df, ["pct"], ["total_ome"]), months=6)
+    assert sums.index.tolist() == ["00D"]
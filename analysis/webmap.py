@@ -0,0 +1,179 @@
+"""Static, interactive web maps of the CCG measures.
+
+`export` writes a directory that any static file server can serve
+(`python -m http.server --directory web`), with no server-side code:
+
+    index.html          the page, from webmap.html: pick a measure and window
+    ccgs.topojson       the boundaries, simplified and quantized once
+    manifest.json       the measures, the windows and the CCG of each position
+    measures/<end>.bin  every measure of every CCG over the window to <end>
+
+The boundaries are the coverage-simplified ones of `geometry.boundaries`,
+written as TopoJSON (`topology`): each edge shared by two CCGs is stored
+once as an arc, with quantized, delta-encoded coordinates. Each window's
+file holds the measures of `cube.ccg_measures_at` as one little-endian
+float32 column per measure, in the order of the manifest's measures and
+of the CCGs of the topology, NaN where a CCG has no value. The page fetches
+the boundaries once and each window once, so switching the measure only
+recolours the map:
+
+    export("web", ccg_sums, ccg_dim)    # ccg_sums from cube.rolling_ccg_sums
+"""
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import shapely
+
+import geometry
+from cube import ccg_measures_at
+
+# tolerance of the boundaries in degrees, about 500m: a few pixels of a page-sized map
+web_tolerance = 0.005
+# points of the grid of quantized coordinates on each axis: about 100m
+# across England, well under the tolerance
+quantization = 10000
+
+
+def _rings(polygon, transform):
+    "Quantized closed rings of `polygon`, without repeated points, exterior first"
+    (kx, ky), (x0, y0) = transform["scale"], transform["translate"]
+    rings = []
+    for ring in [polygon.exterior, *polygon.interiors]:
+        coords = shapely.get_coordinates(ring)
+        points = np.column_stack([(coords[:, 0] - x0) / kx, (coords[:, 1] - y0) / ky]).round().astype("int64")
+        points = points[np.r_[True, (np.diff(points, axis=0) != 0).any(axis=1)]]
+        if len(points) < 4:  # collapsed to less than a triangle by quantizing
+            if not rings:
+                return []
+            continue
+        rings.append(points)
+    return rings
+
+
+def _keys(points):
+    "One integer for each quantized point"
+    return points[:, 0] * (quantization + 1) + points[:, 1]
+
+
+def _junctions(rings):
+    """Keys of the points where rings meet or part: those with more than two
+    distinct neighbours over all the rings
+    """
+    open_rings = [ring[:-1] for ring in rings]
+    keys = _keys(np.concatenate(open_rings))
+    before = _keys(np.concatenate([np.roll(ring, 1, axis=0) for ring in open_rings]))
+    after = _keys(np.concatenate([np.roll(ring, -1, axis=0) for ring in open_rings]))
+    pairs = np.unique(np.column_stack([np.concatenate([keys, keys]), np.concatenate([before, after])]), axis=0)
+    distinct, counts = np.unique(pairs[:, 0], return_counts=True)
+    return set(distinct[counts > 2].tolist())
+
+
+def _cut(ring, junctions):
+    "`ring` cut into arcs at `junctions`, or whole from its least point if it has none"
+    keys = _keys(ring[:-1]).tolist()
+    at = [i for i, key in enumerate(keys) if key in junctions]
+    if not at:
+        start = int(np.argmin(keys))
+        return [np.concatenate([ring[start:-1], ring[:start + 1]])]
+    ring = np.concatenate([ring[at[0]:-1], ring[:at[0] + 1]])
+    at = [i - at[0] for i in at] + [len(ring) - 1]
+    return [ring[a:b + 1] for a, b in zip(at[:-1], at[1:])]
+
+
+def topology(gdf, name="ccgs"):
+    """TopoJSON topology of the polygons of `gdf`, with the index as each
+    geometry's id and the other columns as its properties
+    """
+    x0, y0, x1, y1 = shapely.total_bounds(np.asarray(gdf.geometry))
+    transform = {
+        "scale": [(x1 - x0) / (quantization - 1) or 1, (y1 - y0) / (quantization - 1) or 1],
+        "translate": [x0, y0],
+    }
+    shapes = [[_rings(polygon, transform) for polygon in shapely.get_parts(polygons)] for polygons in gdf.geometry]
+    shapes = [[rings for rings in shape if rings] for shape in shapes]
+    junctions = _junctions([ring for shape in shapes for rings in shape for ring in rings])
+
+    arcs, ids = [], {}
+
+    def arc_ids(ring):
+        refs = []
+        for arc in _cut(ring, junctions):
+            key = arc.tobytes()
+            if key not in ids:
+                reverse = arc[::-1].tobytes()
+                if reverse in ids:
+                    refs.append(~ids[reverse])
+                    continue
+                ids[key] = len(arcs)
+                arcs.append(arc)
+            refs.append(ids[key])
+        return refs
+
+    geometries = []
+    properties = gdf.drop(columns=gdf.geometry.name)
+    for index, shape, props in zip(gdf.index, shapes, properties.to_dict("records")):
+        polygons = [[arc_ids(ring) for ring in rings] for rings in shape]
+        geometry_ = {"type": None} if not polygons else (
+            {"type": "Polygon", "arcs": polygons[0]} if len(polygons) == 1 else {"type": "MultiPolygon", "arcs": polygons}
+        )
+        geometry_.update(id=index, properties={key: None if pd.isnull(value) else value for key, value in props.items()})
+        geometries.append(geometry_)
+
+    return {
+        "type": "Topology",
+        "transform": transform,
+        "objects": {name: {"type": "GeometryCollection", "geometries": geometries}},
+        "arcs": [np.concatenate([arc[:1], np.diff(arc, axis=0)]).tolist() for arc in arcs],
+    }
+
+
+def window_ends(rolling_sums, months=6):
+    "Ends of each full window of `months` months of `rolling_ccg_sums`"
+    return rolling_sums[0].months[months - 1:]
+
+
+def window_measures(rolling_sums, names, months=6, end=None):
+    """Numeric measures of `cube.ccg_measures_at`, as float32, of the CCG
+    named by each of `names` (a Series of names by CCG code), in its order
+    """
+    df = ccg_measures_at(rolling_sums, months, end).set_index("pct")
+    return df.select_dtypes("number").astype("float32").reindex(names.index).set_axis(names.to_numpy())
+
+
+def export(out, rolling_sums, ccgs, months=6, tolerance=web_tolerance, path="ccgs.json"):
+    """Write the web map of the measures by CCG of `rolling_sums` (from
+    `cube.rolling_ccg_sums`), for each window of `months` months, to the
+    directory `out`. `ccgs` is the CCG dimension (`dimensions.ccg_dimension`),
+    joining CCG codes to the names of the boundaries.
+    """
+    gdf = geometry.boundaries(tolerance, path)
+    names = gdf.index.to_series()
+    codes = ccgs.dropna(subset=["name"]).drop_duplicates("name").set_index("name")["code"]
+    names = pd.Series(names.to_numpy(), index=codes.reindex(names).to_numpy())
+
+    os.makedirs(os.path.join(out, "measures"), exist_ok=True)
+    with open(os.path.join(out, "ccgs.topojson"), "w") as f:
+        json.dump(topology(gdf), f, separators=(",", ":"))
+
+    measures = window_measures(rolling_sums, names, months).columns
+    windows = []
+    for end in window_ends(rolling_sums, months):
+        table = window_measures(rolling_sums, names, months, end).reindex(columns=measures)
+        label = end.strftime("%Y-%m")
+        file = "measures/{}.bin".format(label)
+        table.to_numpy().T.astype("<f4").tofile(os.path.join(out, file))
+        windows.append({"end": label, "file": file})
+    manifest = {
+        "months": months,
+        "measures": list(measures),
+        "ccgs": list(names.to_numpy()),
+        "windows": windows,
+    }
+    with open(os.path.join(out, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=1)
+    shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), "webmap.html"),
+                os.path.join(out, "index.html"))
+    return manifest